@@ -1,301 +1,367 @@
-import time
-import json
-from flask import Flask, render_template, request, jsonify
-from config import (MQTT_TOPICS, MODBUS_HOSTS, SQLITE_DB, LOGGING_ENABLED, PREVIOUS_ENERGY)
-from database import initialize_database, execute_query, get_logging_state, set_logging_state
-from mqtt_handler import connect_mqtt, publish_mqtt, log_message
-from modbus_handler import *
-from datetime import datetime, timezone, timedelta  # Импортируем необходимые классы
-from cleanup import cleanup_logs, cleanup_historical_data
+import numpy as np
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from config import (HISTORY_TARGET_POINTS, ROLLUP_RESOLUTIONS, SSE_KEEPALIVE, SAMPLE_MAX_POINTS, RECENT_HOURS,
+                    RECENT_MAX_POINTS, ASSET_MAX_AGE)
+from database import initialize_database, execute_query
+from log import log_message, is_logging_enabled, set_logging_enabled, recent_logs, clear_logs as clear_log_entries
+from timeutils import now_ms, epoch_ms_to_local_iso, local_iso_to_epoch_ms
+from samples import sample_store
+from recent import recent_buffer
+from snapshot import snapshot_view, get_snapshot, wait_for_snapshot, stream_payload
+from rollups import select_resolution, query_rollups
+from export import EXPORT_FORMATS, export_stream
+from meters import meter_ids, meters_info
+from energy import energy_between, calculate_difference
+from metrics import render as render_metrics
+from assets import asset_url, find_asset, build as build_assets
+
+# Веб-интерфейс и API читают БД и последний снимок показаний: опрос счетчиков, запись показаний
+# в БД и публикацию в MQTT выполняет отдельный процесс (poller.py, команда pmp-poller).
+# Пишет в БД веб-процесс только по явным действиям пользователя - /toggle_logging и /clear_logs
+# (с сообщением об этом в журнал); поток-писатель воркера запускается при первом таком запросе.
+# Поэтому приложение можно запускать несколькими воркерами WSGI-сервера:
+#   gunicorn -k gthread -w 4 --threads 8 -b 0.0.0.0:5000 app:app
+# В воркерах /logs всегда читает журнал из БД: кольцевой буфер в памяти отвечает на /logs только
+# при запуске app.py одним процессом вместе с опросом (см. log.recent_logs)
 
 # Инициализация Flask
 app = Flask(__name__)
-
-# Функция для корректного вычитания с учетом переполнения
-def calculate_difference(new_value, old_value):
-    if new_value >= old_value:
-        return new_value - old_value
-    else:
-        if old_value < 65536:
-            return (65536 - old_value) + new_value
-        else:
-            return (old_value - 65536) + new_value
-
-# Функция для получения текущего времени в формате UTC+3
-def get_current_time_utc_plus_3():
-    return (datetime.now(timezone.utc) + timedelta(hours=3)).isoformat()
-
-# Сохранение сырых данных в SQLite
-def save_raw_data(data):
-    if any(data.get(key, 0) < 0 or data.get(key, 0) > 65535 for key in ["L1raw", "L2raw", "L3raw"]):
-        return  # Если данные невалидны, выходим
-
-    execute_query("""
-        INSERT INTO raw_data (id, L1raw, L2raw, L3raw, timestamp)
-        VALUES (1, ?, ?, ?, ?)
-        ON CONFLICT(id) DO UPDATE SET 
-            L1raw = excluded.L1raw,
-            L2raw = excluded.L2raw,
-            L3raw = excluded.L3raw,
-            timestamp = excluded.timestamp
-    """, (data.get("L1raw", 0), data.get("L2raw", 0), data.get("L3raw", 0), get_current_time_utc_plus_3()))
-
-# Сохранение исторических данных
-def save_historical_data(raw_data):
-    execute_query("""
-        INSERT INTO historical_data (L1history, L2history, L3history, timestamp)
-        VALUES (?, ?, ?, ?)
-    """, (raw_data["L1raw"], raw_data["L2raw"], raw_data["L3raw"], get_current_time_utc_plus_3()))
-
-# Обновление общих данных в SQLite
-def update_total_data(raw_data):
-    existing_raw_data = execute_query("SELECT * FROM raw_data WHERE id = 1", fetchone=True)
-    if not existing_raw_data:
-        return
-
-    old_L1raw, old_L2raw, old_L3raw = existing_raw_data[1:4]
-    if old_L1raw == old_L2raw == old_L3raw == 0:
-        save_raw_data(raw_data)
-        return
-
-    existing_total_data = execute_query("SELECT * FROM total_data WHERE id = 1", fetchone=True)
-    # log_message(f"Existing raw data - L1raw: {old_L1raw}, L2raw: {old_L2raw}, L3raw: {old_L3raw}")
-    # log_message(f"Existing total data - L1total: {existing_total_data[1]}, L2total: {existing_total_data[2]}, L3total: {existing_total_data[3]}")
-
-    L1Difference = calculate_difference(raw_data["L1raw"], old_L1raw)
-    L2Difference = calculate_difference(raw_data["L2raw"], old_L2raw)
-    L3Difference = calculate_difference(raw_data["L3raw"], old_L3raw)
-
-    # log_message(f"Calculated differences - L1: {L1Difference}, L2: {L2Difference}, L3: {L3Difference}")
-    L1Total = existing_total_data[1] + L1Difference
-    L2Total = existing_total_data[2] + L2Difference
-    L3Total = existing_total_data[3] + L3Difference
-
-    total_kWh = round((L1Total + L2Total + L3Total) / 1000, 2)
-    publish_mqtt(MQTT_TOPICS["total_kWh"], str(total_kWh))
-
-    # log_message(f"Updating totals - L1Total: {L1Total}, L2Total: {L2Total}, L3Total: {L3Total}, total_kWh: {total_kWh:.1f}")
-
-    execute_query("""
-        UPDATE total_data
-        SET L1total = ?, L2total = ?, L3total = ?, timestamp = ?
-        WHERE id = 1
-    """, (L1Total, L2Total, L3Total, get_current_time_utc_plus_3()))
-
-# Обработка данных и публикация в MQTT
-def process_and_publish_data():
-    global PREVIOUS_ENERGY
-
-    while True:
-        full_data = {}
-        raw_data = {"L1raw": 0, "L2raw": 0, "L3raw": 0}
-
-        total_power = 0.0  # Инициализация переменной для общей мощности
-
-        for phase, config in MODBUS_HOSTS.items():
-            data = read_modbus_data(config["host"], config["unit_id"])
-            if data is None:
-                continue
-
-            # Сохраняем сырые данные о мощности и энергии
-            raw_data[f"{phase}raw"] = data["Energy"]  # Сохраняем данные о энергии
-            total_power += round((data["Power"]), 2)  # Суммируем мощность
-
-            publish_mqtt(MQTT_TOPICS[f"Full_data_{phase}"], json.dumps({
-                f"{phase}U": data["Voltage"],
-                f"{phase}A": data["Current"],
-                f"{phase}W": data["Power"],
-                f"{phase}Wh": data["Energy"],
-                f"{phase}F_Wh": data["Energy_F"],
-                f"{phase}Hz": data["Frequency"],
-                f"{phase}Pf": data["PowerFactor"],
-                f"{phase}Alarm": data["AlarmStatus"]
-            }))
-
-            diff_energy = calculate_difference(data["Energy"], PREVIOUS_ENERGY[phase])
-            full_data.update({f"{phase}_diff_Energy": diff_energy})
-            # log_message(f"Energy difference for {phase}: {diff_energy} (new: {data['Energy']}, previous: {PREVIOUS_ENERGY[phase]})")
-            PREVIOUS_ENERGY[phase] = data["Energy"]
-
-        update_total_data(raw_data)
-        save_raw_data(raw_data)
-        save_historical_data(raw_data)
-
-        # Получение существующих сырых данных для проверки переполнения
-        existing_raw_data = {"L1raw": raw_data["L1raw"], "L2raw": raw_data["L2raw"], "L3raw": raw_data["L3raw"]}
-        overflow_results = {
-            "L1_overflow_error": int(calculate_difference(raw_data["L1raw"], existing_raw_data["L1raw"])),
-            "L2_overflow_error": int(calculate_difference(raw_data["L2raw"], existing_raw_data["L2raw"])),
-            "L3_overflow_error": int(calculate_difference(raw_data["L3raw"], existing_raw_data["L3raw"])),
-            "timestamp": get_current_time_utc_plus_3()
-        }
-        publish_mqtt(MQTT_TOPICS["overflow_error"], json.dumps(overflow_results))
-
-        cleanup_historical_data()
-        cleanup_logs()
-        # Публикация общей мощности в MQTT
-        publish_mqtt(MQTT_TOPICS["General-W"], str(round(total_power, 2)))
-
-        time.sleep(10) # <- Здесь задана задержка между опросами (10 секунд)
-
-# Получение сырых данных из БД
+app.jinja_env.globals["asset_url"] = asset_url
+
+# Часть снимка в теле ответа, возраст снимка и признак устаревания - в заголовках
+# X-Snapshot-Age (секунды, пусто, если снимка еще нет) и X-Snapshot-Stale (0/1)
+def _snapshot_response(part):
+    data, status = snapshot_view(part)
+    response = jsonify(data)
+    response.headers["X-Snapshot-Age"] = "" if status["age"] is None else str(status["age"])
+    response.headers["X-Snapshot-Stale"] = str(int(status["stale"]))
+    return response
+
+# Получение сырых данных из снимка последнего цикла опроса
 @app.route("/raw_data")
 def get_raw_data():
-    row = execute_query("SELECT * FROM raw_data ORDER BY timestamp DESC LIMIT 1", fetchone=True)
-    if row:
-        labels = ['id', 'L1raw', 'L2raw', 'L3raw', 'timestamp']
-        return jsonify(dict(zip(labels, row)))
-    return jsonify({})
+    return _snapshot_response("raw")
 
-# Получение общих данных из БД
+# Получение общих данных из снимка последнего цикла опроса
 @app.route("/total_data")
 def get_total_data():
-    row = execute_query("SELECT * FROM total_data ORDER BY timestamp DESC LIMIT 1", fetchone=True)
-    if row:
-        labels = ['id', 'L1total', 'L2total', 'L3total', 'timestamp']
-        return jsonify(dict(zip(labels, row)))
-    return jsonify({})
-# Получение данных для каждой фазы
+    return _snapshot_response("total")
+# Получение данных для каждого счетчика (из снимка, без обращения к Modbus)
 @app.route("/data")
 def get_data():
-    full_data = {}
-    for phase, config in MODBUS_HOSTS.items():
-        data = read_modbus_data(config["host"], config["unit_id"])
-        if data:
-            full_data[phase] = data
-    return jsonify(full_data)
-
-# Получение логов из БД
+    return _snapshot_response("phases")
+
+# Скользящая статистика показаний по окнам, активные и последние события правил (из снимка)
+@app.route("/stats")
+def get_stats():
+    return _snapshot_response("stats")
+
+# Метрики в текстовом формате Prometheus. Веб-процесс отдает свои (чтение БД, возраст снимка),
+# метрики опроса, записи и MQTT отдает процесс опроса на POLLER_METRICS_PORT
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Реестр счетчиков (для панели и внешних клиентов)
+@app.route("/meters")
+def get_meters():
+    return jsonify(meters_info())
+
+# Поток обновлений панели (Server-Sent Events): одно событие на каждый завершенный цикл опроса
+@app.route("/stream")
+def stream():
+    def events():
+        yield "retry: 5000\n\n"
+        snapshot = get_snapshot()
+        version = 0
+        if snapshot is not None:
+            version = snapshot.version
+            yield f"id: {version}\ndata: {stream_payload(snapshot)}\n\n"
+        while True:
+            snapshot = wait_for_snapshot(version, SSE_KEEPALIVE)
+            if snapshot is None:
+                yield ": keep-alive\n\n"  # Не дает прокси закрыть простаивающее соединение
+                continue
+            version = snapshot.version
+            yield f"id: {version}\ndata: {stream_payload(snapshot)}\n\n"
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Получение логов (из БД; из памяти - только при запуске app.py вместе с опросом, см. log.recent_logs)
 @app.route("/logs")
 def get_logs():
-    if not get_logging_state():  # Проверяем состояние логирования
+    if not is_logging_enabled():  # Проверяем состояние логирования (кэш в памяти)
         return jsonify([])  # Если логирование отключено, возвращаем пустой массив
 
     limit = request.args.get('limit', default=10, type=int)  # Получаем параметр limit
-    rows = execute_query(f"SELECT * FROM logs ORDER BY timestamp DESC LIMIT {limit}")
-    return jsonify([{"timestamp": row[0], "message": row[1]} for row in rows])
+    return jsonify(recent_logs(max(0, limit)))
 
 # Переключение логирования
 @app.route('/toggle_logging', methods=['POST'])
 def toggle_logging():
-    current_state = get_logging_state()
-    new_state = not current_state
-
-    set_logging_state(new_state)
+    new_state = not is_logging_enabled()
+    set_logging_enabled(new_state)  # Сохраняет в БД и обновляет кэш
 
     # Логируем событие
     message = 'Логирование включено' if new_state else 'Логирование отключено'
-    execute_query("INSERT INTO logs (message) VALUES (?)", (message,))
+    log_message(message, force=True)
 
     return jsonify({'logging_enabled': new_state})
 @app.route('/get_logging_state', methods=['GET'])
 def get_logging_state_route():
-    state = get_logging_state()
-    return jsonify({'logging_enabled': state})
+    return jsonify({'logging_enabled': is_logging_enabled()})
 # Очистка логов
 @app.route("/clear_logs", methods=["POST"])
 def clear_logs():
-    execute_query("DELETE FROM logs")
-    log_message("Logs cleared")  # Убедитесь, что функция log_message также записывает в базу данных
-    execute_query("INSERT INTO logs (message) VALUES (?)", ("Журнал очищен",))
+    clear_log_entries()
+    log_message("Журнал очищен", force=True)
     return jsonify({"status": "success", "message": "Журнал очищен"})
 
+# Собранные статические ресурсы (assets.py). Имя файла содержит хеш содержимого, поэтому
+# ответ кэшируется браузером навсегда; сжатый вариант выбирается по Accept-Encoding
+@app.route("/assets/<path:filename>")
+def assets(filename):
+    accepted = [encoding for encoding in ("br", "gzip") if encoding in request.accept_encodings]
+    found = find_asset(filename, accepted)
+    if found is None:
+        return jsonify({"error": "Файл не найден"}), 404
+    content, mimetype, encoding, etag = found
+    response = Response(content, mimetype=mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 # Главная страница
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_template("index.html", meters=meters_info())
 
 @app.route("/data_page", methods=["GET", "POST"])
 def data_page():
     if request.method == "POST":
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Ожидается JSON-объект"}), 400
         # Проверка на наличие данных для проверки ID
         if 'inputId1' in data and 'inputId2' in data:
             return check_data(data['inputId1'], data['inputId2'])
         # Проверка на наличие данных для запроса исторических данных
         elif 'dateStart' in data and 'dateStop' in data:
-            return get_historical_data(data['dateStart'], data['dateStop'])
-    return render_template("data_page.html")
-
-def get_historical_data(date_start, date_stop):
-    print(f"Запрос исторических данных с {date_start} по {date_stop}")  # Логирование входящих данных
-    # Преобразование строк в объекты datetime
-    start_datetime = datetime.fromisoformat(date_start.replace("Z", "+00:00"))
-    stop_datetime = datetime.fromisoformat(date_stop.replace("Z", "+00:00"))
-
-    rows = execute_query("""
-        SELECT * FROM historical_data 
-        WHERE timestamp BETWEEN ? AND ? 
-        ORDER BY id ASC
-    """, (start_datetime.isoformat(), stop_datetime.isoformat()))
-
-    result = []
-    for row in rows:
-        result.append({
-            "id": row[0],
-            "L1history": row[1],
-            "L2history": row[2],
-            "L3history": row[3],
-            "timestamp": row[4]
-        })
+            return get_historical_data(data['dateStart'], data['dateStop'], data.get('points'))
+    return render_template("data_page.html", meters=meters_info())
+
+def get_historical_data(date_start, date_stop, points=None):
+    # Преобразование строк в миллисекунды Unix (время без смещения считается местным)
+    try:
+        start_ms = local_iso_to_epoch_ms(date_start)
+        stop_ms = local_iso_to_epoch_ms(date_stop)
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "Даты dateStart и dateStop должны быть заданы в формате ISO 8601"}), 400
+    try:
+        points = int(points or HISTORY_TARGET_POINTS)
+    except (TypeError, ValueError):
+        points = 0
+    if points <= 0:
+        return jsonify({"error": "Параметр points должен быть положительным целым числом"}), 400
+
+    # Для длинных периодов отдаем агрегаты с разрешением, дающим около HISTORY_TARGET_POINTS точек
+    resolution = select_resolution(start_ms, stop_ms, points)
+    if resolution != "raw":
+        result = query_rollups(resolution, start_ms, stop_ms, meter_ids())
+        return jsonify(result) if result else jsonify({"error": "Нет данных для указанных временных рамок."})
+
+    # Диапазон каждого счетчика выбирается по первичному ключу (meter_id, ts).
+    # Выборки одного цикла имеют общую метку ts, она же служит ID строки
+    meters = meter_ids()
+    rows = execute_query(f"""
+        SELECT meter_id, ts, energy FROM meter_history
+        WHERE meter_id IN ({", ".join("?" for _ in meters)}) AND ts BETWEEN ? AND ?
+        ORDER BY ts ASC
+    """, (*meters, start_ms, stop_ms)) or []
+
+    samples = {}
+    for meter_id, ts, energy in rows:
+        row = samples.get(ts)
+        if row is None:
+            row = samples[ts] = {"id": ts, "ts": ts, "timestamp": epoch_ms_to_local_iso(ts)}
+        row[meter_id] = energy
+    result = list(samples.values())
     return jsonify(result) if result else jsonify({"error": "Нет данных для указанных временных рамок."})
 
+# Потоковая выгрузка истории в CSV/NDJSON:
+# /export?from=2025-01-01T00:00:00&to=2025-02-01T00:00:00&format=csv&resolution=raw&gzip=1
+@app.route("/export")
+def export_data():
+    fmt = request.args.get("format", "csv")
+    resolution = request.args.get("resolution", "raw")
+    compress = request.args.get("gzip", "0") in ("1", "true", "yes")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"Неизвестный формат: {fmt}"}), 400
+    if resolution != "raw" and resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"Неизвестное разрешение: {resolution}"}), 400
+    try:
+        start_ms = local_iso_to_epoch_ms(request.args["from"])
+        stop_ms = local_iso_to_epoch_ms(request.args["to"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Параметры from и to должны быть заданы в формате ISO 8601"}), 400
+
+    filename = f"history_{resolution}.{fmt}" + (".gz" if compress else "")
+    body = stream_with_context(export_stream(resolution, start_ms, stop_ms, meter_ids(), fmt, compress))
+    return Response(body, mimetype="application/gzip" if compress else EXPORT_FORMATS[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+_WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+# Длительность окна: секунды числом или с единицей (90s, 15m, 2h)
+def _parse_window(value):
+    value = value.strip().lower()
+    if value[-1:] in _WINDOW_UNITS:
+        return float(value[:-1]) * _WINDOW_UNITS[value[-1]]
+    return float(value)
+
+# Недавние показания для живых графиков из кольцевого буфера в памяти, без обращения к БД:
+# /recent?fields=Voltage,Power&window=1h[&points=600][&meters=L1,L2]
+# Если выборок в окне больше points, каждое поле отдается парами min/max по points/2 интервалам
+@app.route("/recent")
+def get_recent():
+    try:
+        window = _parse_window(request.args.get("window", "1h"))
+        points = min(RECENT_MAX_POINTS, int(request.args.get("points", RECENT_MAX_POINTS)))
+    except ValueError:
+        return jsonify({"error": "window - число секунд или 90s/15m/2h, points - целое число"}), 400
+    if not 0 < window <= RECENT_HOURS * 3600 or points < 2:
+        return jsonify({"error": f"window должно быть в пределах {RECENT_HOURS} ч, points - не меньше 2"}), 400
+
+    meters = meter_ids()
+    if request.args.get("meters"):
+        requested = request.args["meters"].split(",")
+        unknown = [meter_id for meter_id in requested if meter_id not in meters]
+        if unknown:
+            return jsonify({"error": f"Неизвестные счетчики: {', '.join(unknown)}"}), 400
+        meters = requested
+    fields = request.args["fields"].split(",") if request.args.get("fields") else None
+
+    now = now_ms()
+    return jsonify({"window": window, "points": points, "now": now,
+                    "meters": recent_buffer.series(meters, fields, int(window * 1000), now, points)})
+
+# Полные выборки счетчика (все поля) из сегментов, по колонкам:
+# /samples?meter=L1&from=2025-01-01T00:00:00&to=2025-01-02T00:00:00[&fields=Voltage,Power]
+@app.route("/samples")
+def get_samples():
+    meter_id = request.args.get("meter")
+    if meter_id not in meter_ids():
+        return jsonify({"error": f"Неизвестный счетчик: {meter_id}"}), 400
+    try:
+        start_ms = local_iso_to_epoch_ms(request.args["from"])
+        stop_ms = local_iso_to_epoch_ms(request.args["to"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Параметры from и to должны быть заданы в формате ISO 8601"}), 400
+    fields = request.args["fields"].split(",") if request.args.get("fields") else None
+
+    records = sample_store.read_range(meter_id, start_ms, stop_ms, fields)
+    if records is None:
+        return jsonify({"meter": meter_id, "fields": [], "ts": []})
+    # Длинные периоды прореживаются равномерно до SAMPLE_MAX_POINTS точек
+    step = -(-len(records) // SAMPLE_MAX_POINTS)
+    records = records[::step]
+    names = [name for name in records.dtype.names if name != "ts"]
+    result = {"meter": meter_id, "fields": names, "step": step, "ts": records["ts"].tolist()}
+    for name in names:
+        column = records[name]
+        # float32 хранит около 7 значащих цифр, лишние знаки двоичного представления отбрасываются
+        result[name] = np.round(column.astype(np.float64), 4).tolist() if column.dtype.kind == "f" else column.tolist()
+    return jsonify(result)
+
+# Выборка всех счетчиков с меткой ts (ID строки истории): {meter_id: (energy, energy_total)}
+def _history_sample(ts, meters):
+    rows = execute_query(f"""
+        SELECT meter_id, energy, energy_total FROM meter_history
+        WHERE meter_id IN ({", ".join("?" for _ in meters)}) AND ts = ?
+    """, (*meters, ts)) or []
+    return {meter_id: (energy, energy_total) for meter_id, energy, energy_total in rows}
+
+# Расход энергии за период по накопленной энергии (energy_total), независимо от длины периода:
+# /energy?from=2025-01-01T00:00:00&to=2025-02-01T00:00:00[&meters=L1,L2]
+@app.route("/energy")
+def get_energy():
+    try:
+        start_ms = local_iso_to_epoch_ms(request.args["from"])
+        stop_ms = local_iso_to_epoch_ms(request.args["to"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Параметры from и to должны быть заданы в формате ISO 8601"}), 400
+    if stop_ms < start_ms:
+        return jsonify({"error": "Начало периода позже окончания"}), 400
+
+    meters = meter_ids()
+    if request.args.get("meters"):
+        requested = request.args["meters"].split(",")
+        unknown = [meter_id for meter_id in requested if meter_id not in meters]
+        if unknown:
+            return jsonify({"error": f"Неизвестные счетчики: {', '.join(unknown)}"}), 400
+        meters = requested
+
+    result = energy_between(start_ms, stop_ms, meters)
+    for value in result.values():
+        for point in (value["start"], value["stop"]):
+            if point is not None:
+                point["timestamp"] = epoch_ms_to_local_iso(point["ts"])
+    total = sum(value["energy"] for value in result.values() if value["energy"] is not None)
+    return jsonify({
+        "from": epoch_ms_to_local_iso(start_ms),
+        "to": epoch_ms_to_local_iso(stop_ms),
+        "meters": result,
+        "energy": total,
+        "energy_kwh": round(total / 1000, 3)
+    })
+
 def check_data(id1, id2):
     if not id1 or not id2:
         return jsonify({"error": "Оба ID должны быть заданы!"}), 400
+    try:
+        id1, id2 = int(id1), int(id2)
+    except (TypeError, ValueError):
+        return jsonify({"error": "ID должны быть целыми числами"}), 400
 
-    result1 = execute_query("SELECT * FROM historical_data WHERE id = ?", (id1,), fetchone=True)
-    result2 = execute_query("SELECT * FROM historical_data WHERE id = ?", (id2,), fetchone=True)
+    meters = meter_ids()
+    newData = _history_sample(id1, meters)
+    oldData = _history_sample(id2, meters)
 
-    if not result1 or not result2:
+    if not newData or not oldData:
         return jsonify({"error": "Данные не найдены"}), 404
 
-    # Извлекаем старые и новые данные
-    newData = {
-        "L1history": result1[1],
-        "L2history": result1[2],
-        "L3history": result1[3]
-    }
-    oldData = {
-        "L1history": result2[1],
-        "L2history": result2[2],
-        "L3history": result2[3]
-    }
-
-    L1Difference = calculate_difference(newData["L1history"], oldData["L1history"])
-    L2Difference = calculate_difference(newData["L2history"], oldData["L2history"])
-    L3Difference = calculate_difference(newData["L3history"], oldData["L3history"])
+    # Разность накопленной энергии верна при любом числе переполнений 16-битного счетчика между выборками
+    differences = {}
+    for meter_id in meters:
+        if meter_id in newData and meter_id in oldData:
+            (new_raw, new_total), (old_raw, old_total) = newData[meter_id], oldData[meter_id]
+            if new_total is not None and old_total is not None:
+                differences[f"{meter_id}Difference"] = new_total - old_total
+            else:
+                differences[f"{meter_id}Difference"] = calculate_difference(new_raw, old_raw)
 
     # Возвращаем результаты
     return jsonify({
-        "result1": {
-            "id": result1[0],
-            "L1history": oldData["L1history"],
-            "L2history": oldData["L2history"],
-            "L3history": oldData["L3history"],
-            "timestamp": result1[4]
-        },
-        "result2": {
-            "id": result2[0],
-            "L1history": newData["L1history"],
-            "L2history": newData["L2history"],
-            "L3history": newData["L3history"],
-            "timestamp": result2[4]
-        },
-        "differences": {
-            "L1Difference": L1Difference,
-            "L2Difference": L2Difference,
-            "L3Difference": L3Difference
-        }
+        "result1": dict({meter_id: raw for meter_id, (raw, total) in newData.items()},
+                        id=id1, timestamp=epoch_ms_to_local_iso(id1)),
+        "result2": dict({meter_id: raw for meter_id, (raw, total) in oldData.items()},
+                        id=id2, timestamp=epoch_ms_to_local_iso(id2)),
+        "differences": differences
     })
 
-# Запуск Flask приложения
+# Запуск одним процессом для разработки: опрос в фоновом потоке и встроенный сервер Flask
 if __name__ == "__main__":
-    initialize_database()  # Проверка и создание базы данных
-    connect_mqtt()
     from threading import Thread
+    import poller
 
-    data_thread = Thread(target=process_and_publish_data)
+    initialize_database()  # Проверка и создание базы данных
+    build_assets()  # Один процесс: сборка не пересекается с другими воркерами
+    data_thread = Thread(target=poller.run)
     data_thread.daemon = True
     data_thread.start()
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000)
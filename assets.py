@@ -0,0 +1,188 @@
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+from config import ASSET_BUNDLES, ASSET_OUTPUT_DIR
+
+# Сборка статических ресурсов и их выдача.
+# Сборка - только командой pmp-build-assets (при установке и обновлении, до перезапуска
+# веб-сервиса): наборы ASSET_BUNDLES склеиваются, минифицируются (rjsmin/rcssmin), получают имя
+# с хешем содержимого и сжатые варианты .gz/.br. Имена файлов записываются в manifest.json,
+# файлы прежних сборок удаляются. Веб-процессы манифест только читают и сами ничего не собирают:
+# несколько воркеров не перезаписывают и не удаляют файлы друг друга.
+# Выдача: asset_url() в шаблонах дает адрес /assets/<имя с хешем>; содержимое по такому адресу
+# никогда не меняется, поэтому браузер кэширует его навсегда и при повторных визитах не
+# запрашивает вовсе.
+
+# Пакеты сборки (зависимости проекта) нужны только pmp-build-assets, веб-процессы их не импортируют
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+OUTPUT_DIR = os.path.join(ROOT, ASSET_OUTPUT_DIR)
+MANIFEST = os.path.join(OUTPUT_DIR, "manifest.json")
+URL_PREFIX = "/assets/"
+
+_SOURCE_MAP = re.compile(r"^\s*(?://|/\*)# sourceMappingURL=.*$", re.M)
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+_manifest = None
+_files = {}  # имя файла -> (содержимое, тип); файлы неизменяемые, читаются с диска один раз
+_lock = threading.Lock()
+
+
+# Относительные url() в CSS указывают на каталог исходного файла, а набор отдается из /assets
+def _rebase_css(source, text):
+    base = os.path.dirname(source)
+
+    def rebase(match):
+        url = match.group(2).strip()
+        if url.startswith(("data:", "/", "#")) or "://" in url:
+            return match.group(0)
+        return f'url("/static/{os.path.normpath(os.path.join(base, url)).replace(os.sep, "/")}")'
+    return _CSS_URL.sub(rebase, text)
+
+
+def _minify(source, text):
+    if ".min." in os.path.basename(source):
+        return text
+    if source.endswith(".js"):
+        return rjsmin.jsmin(text, keep_bang_comments=True)
+    if source.endswith(".css"):
+        return rcssmin.cssmin(text, keep_bang_comments=True)
+    return text
+
+
+# Содержимое набора: исходники без ссылок на source map (их в сборке нет), по очереди
+def bundle(name, sources):
+    parts = []
+    for source in sources:
+        with open(os.path.join(STATIC_DIR, source), encoding="utf-8") as f:
+            text = _SOURCE_MAP.sub("", f.read())
+        if source.endswith(".css"):
+            text = _rebase_css(source, text)
+        parts.append(_minify(source, text).strip())
+    # ";" между скриптами защищает от файлов без завершающей точки с запятой
+    return ("\n;\n" if name.endswith(".js") else "\n").join(parts).encode("utf-8") + b"\n"
+
+
+def _write(path, content):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+def build(bundles=ASSET_BUNDLES):
+    # Без минификации и brotli сборка молча получилась бы больше, поэтому она не выполняется
+    missing = [name for name, module in (("rjsmin", rjsmin), ("rcssmin", rcssmin), ("brotli", brotli))
+               if module is None]
+    if missing:
+        raise RuntimeError(f"Для сборки статических ресурсов не установлены пакеты: {', '.join(missing)}")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = {}
+    for name, sources in bundles.items():
+        content = bundle(name, sources)
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        filename = f"{stem}.{digest}{ext}"
+        entry = {"file": filename, "hash": digest, "size": len(content), "sources": sources}
+        _write(os.path.join(OUTPUT_DIR, filename), content)
+
+        # Сжатые варианты сохраняются, только если они меньше исходного файла
+        variants = {"gz": gzip.compress(content, 9, mtime=0), "br": brotli.compress(content, quality=11)}
+        for suffix, compressed in variants.items():
+            if len(compressed) < len(content):
+                _write(os.path.join(OUTPUT_DIR, f"{filename}.{suffix}"), compressed)
+                entry[suffix] = len(compressed)
+        manifest[name] = entry
+
+    # Файлы прежних сборок больше не нужны: страницы ссылаются только на файлы манифеста
+    current = {entry["file"] for entry in manifest.values()}
+    for filename in os.listdir(OUTPUT_DIR):
+        base = filename[:-3] if filename.endswith((".gz", ".br")) else filename
+        if base not in current and filename != "manifest.json" and not filename.endswith(".tmp"):
+            os.remove(os.path.join(OUTPUT_DIR, filename))
+    _write(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    return manifest
+
+
+# Манифест сборки (читается один раз на процесс). Без сборки или если в ней нет какого-то
+# набора из ASSET_BUNDLES - ошибка с подсказкой: собирать в веб-процессе нельзя
+def get_manifest():
+    global _manifest
+    if _manifest is not None:
+        return _manifest
+    with _lock:
+        if _manifest is None:
+            try:
+                with open(MANIFEST, encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                raise RuntimeError(f"Статические ресурсы не собраны ({MANIFEST}: {e}), "
+                                   f"выполните pmp-build-assets и перезапустите веб-сервис") from None
+            missing = [name for name in ASSET_BUNDLES if name not in manifest]
+            if missing:
+                raise RuntimeError(f"В сборке статических ресурсов нет наборов {', '.join(missing)}, "
+                                   f"выполните pmp-build-assets и перезапустите веб-сервис")
+            _manifest = manifest
+    return _manifest
+
+
+# Адрес набора для шаблонов: {{ asset_url('base.css') }}
+def asset_url(name):
+    return URL_PREFIX + get_manifest()[name]["file"]
+
+
+# Файл сборки для ответа: (содержимое, тип, кодирование или None, ETag) или None.
+# encodings - кодирования, которые принимает клиент, в порядке предпочтения сервера
+def find_asset(filename, encodings):
+    entries = {entry["file"]: entry for entry in get_manifest().values()}
+    entry = entries.get(filename)
+    if entry is None:
+        return None
+    encoding = next((name for name, suffix in (("br", "br"), ("gzip", "gz"))
+                     if name in encodings and suffix in entry), None)
+    suffix = {"br": ".br", "gzip": ".gz"}.get(encoding, "")
+    path = filename + suffix
+    cached = _files.get(path)
+    if cached is None:
+        # Файл могла удалить новая сборка, если веб-сервис после нее не перезапущен
+        try:
+            with open(os.path.join(OUTPUT_DIR, path), "rb") as f:
+                cached = _files[path] = (f.read(), mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        except FileNotFoundError:
+            return None
+    content, mimetype = cached
+    return content, mimetype, encoding, f"{entry['hash']}-{encoding or 'identity'}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка статических ресурсов (ASSET_BUNDLES в config.py)")
+    parser.parse_args()
+    try:
+        manifest = build()
+    except RuntimeError as e:
+        raise SystemExit(f"Ошибка: {e}")
+    for name, entry in manifest.items():
+        print(f"{name} -> {entry['file']}: {entry['size']} байт, gzip {entry.get('gz', '-')}, "
+              f"brotli {entry.get('br', '-')}")
+
+
+if __name__ == "__main__":
+    main()
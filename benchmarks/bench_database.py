@@ -0,0 +1,128 @@
+# Сравнение записи одного цикла опроса в SQLite:
+#   legacy - новое соединение и commit на каждый оператор (как было раньше, журнал DELETE)
+#   writer - поток-писатель, WAL и одна транзакция на цикл (database.write_batch)
+# Для каждого режима выводится задержка записи цикла, число транзакций и объем записи на диск.
+# Запуск: python benchmarks/bench_database.py --cycles 200 [--json результат.json]
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+LOG_MESSAGES_PER_CYCLE = 4
+METERS = ("L1", "L2", "L3")
+
+
+# Операторы одного цикла опроса (как в poller.process_cycle)
+def cycle_statements(i):
+    ts = 1735689600000 + i * 10000
+    statements = [
+        ("INSERT INTO meter_state (meter_id, raw, total, ts) VALUES (?, ?, ?, ?) "
+         "ON CONFLICT(meter_id) DO UPDATE SET raw = excluded.raw, total = total + 1, ts = excluded.ts",
+         (meter, i % 65536, 0, ts)) for meter in METERS
+    ]
+    statements += [
+        ("INSERT INTO meter_history (meter_id, ts, energy, power) VALUES (?, ?, ?, ?), (?, ?, ?, ?), (?, ?, ?, ?)",
+         tuple(value for meter in METERS for value in (meter, ts, i % 65536, 1.5))),
+        ("DELETE FROM meter_history WHERE meter_id = ? AND ts < ?", (METERS[0], ts - 72 * 3600 * 1000)),
+        ("DELETE FROM logs WHERE timestamp < datetime('now', '-24 hours')", ()),
+    ]
+    statements += [("INSERT INTO logs (message) VALUES (?)", (f"message {i}/{n}",)) for n in range(LOG_MESSAGES_PER_CYCLE)]
+    return statements
+
+
+# Байты, фактически записанные процессом на блочное устройство (Linux), иначе None
+def disk_write_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def run_legacy(path, cycles):
+    latencies = []
+    transactions = 0
+    for i in range(cycles):
+        started = time.perf_counter()
+        for query, params in cycle_statements(i):
+            conn = sqlite3.connect(path)
+            conn.execute(query, params)
+            conn.commit()
+            conn.close()
+            transactions += 1
+        latencies.append(time.perf_counter() - started)
+    return latencies, transactions
+
+
+def run_writer(path, cycles):
+    latencies = []
+    for i in range(cycles):
+        started = time.perf_counter()
+        with database.write_batch():
+            for query, params in cycle_statements(i):
+                database.execute_query(query, params)
+        latencies.append(time.perf_counter() - started)
+    database.close_database()
+    return latencies, cycles
+
+
+def measure(name, runner, cycles, directory):
+    path = os.path.join(directory, f"{name}.db")
+    database.SQLITE_DB = path
+    database.initialize_database()
+    if name == "legacy":
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+
+    written_before = disk_write_bytes()
+    latencies, transactions = runner(path, cycles)
+    written_after = disk_write_bytes()
+
+    latencies.sort()
+    result = {
+        "mode": name,
+        "cycles": cycles,
+        "transactions": transactions,
+        "transactions_per_cycle": round(transactions / cycles, 2),
+        "cycle_ms_mean": round(statistics.mean(latencies) * 1000, 3),
+        "cycle_ms_p50": round(latencies[len(latencies) // 2] * 1000, 3),
+        "cycle_ms_p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+    }
+    if written_before is not None:
+        result["disk_bytes_per_cycle"] = round((written_after - written_before) / cycles)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк записи цикла опроса в SQLite")
+    parser.add_argument("--cycles", type=int, default=200)
+    parser.add_argument("--dir", default=None, help="Каталог для тестовых БД (по умолчанию временный; для SD-карты укажите путь на ней)")
+    parser.add_argument("--json", default=None, help="Файл для сохранения результатов")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        results = [
+            measure("legacy", run_legacy, args.cycles, directory),
+            measure("writer", run_writer, args.cycles, directory),
+        ]
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+# Набор измерений горячих путей на локальных заглушках, без реального шлюза и брокера:
+#   poll - цикл опроса через симулятор Modbus (simulator.py, отдельный процесс): длительность
+#          цикла, отклонение старта от дедлайна, пропущенные дедлайны, переполнения счетчиков
+#   db   - записи одного цикла (meter_state, meter_history, агрегаты): циклов и строк в секунду
+#   mqtt - конвейер публикации до брокера-заглушки (mqtt_stub.py): сообщений в секунду
+#   http - пропускная способность и задержки p50/p95/p99 эндпоинтов /data, /logs, истории и /energy
+# Результат выводится в JSON; с --baseline прошлый.json печатаются изменения метрик.
+# Запуск: python benchmarks/bench_suite.py --gateways 2 --units 10 --json result.json
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import config  # noqa: E402
+import mqtt_stub  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values, scale=1000.0):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * scale, 3)
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99), "max": round(ordered[-1] * scale, 3),
+            "mean": round(sum(ordered) / len(ordered) * scale, 3)}
+
+
+# Настройки проекта подменяются до импорта модулей, которые копируют их при импорте
+def configure(workdir, gateways, units, modbus_port, mqtt_port):
+    config.SQLITE_DB = os.path.join(workdir, "bench.db")
+    config.MQTT_SPOOL_FILE = os.path.join(workdir, "mqtt_spool.jsonl")
+    config.SAMPLE_STORE_DIR = os.path.join(workdir, "samples")
+    config.RECENT_BUFFER_DIR = os.path.join(workdir, "recent")
+    config.MQTT_BROKER = "127.0.0.1"
+    config.MQTT_PORT = mqtt_port
+    config.MODBUS_GATEWAYS = {f"gw{index + 1}": {"host": "127.0.0.1", "port": modbus_port + index}
+                              for index in range(gateways)}
+    config.METERS = {f"gw{gateway + 1}u{unit}": {"gateway": f"gw{gateway + 1}", "unit_id": unit}
+                     for gateway in range(gateways) for unit in range(1, units + 1)}
+
+
+def start_simulator(gateways, units, port):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "simulator.py"), "--gateways", str(gateways),
+         "--units", str(units), "--port", str(port)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if process.stdout.readline().strip() != "ready":
+        process.kill()
+        raise RuntimeError("Симулятор Modbus не запустился")
+    return process
+
+
+def bench_poll(poller, scheduler, registry, duration, interval):
+    wraps = {"count": 0}
+    previous = {}
+    samples = []
+
+    def handle_cycle(readings):
+        for meter_id, data in readings.items():
+            if meter_id in previous and data["Energy"] < previous[meter_id]:
+                wraps["count"] += 1
+            previous[meter_id] = data["Energy"]
+        samples.append(len(readings))
+        poller.process_cycle(readings)
+
+    async def run():
+        try:
+            await asyncio.wait_for(scheduler.run_polling(handle_cycle, interval, registry), duration)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
+    stats = scheduler.poll_stats.as_dict()
+    recent = list(scheduler.poll_stats.recent)
+    return {
+        "interval_s": interval,
+        "cycles": stats["cycles"],
+        "missed_deadlines": stats["missed_deadlines"],
+        "meters": len(registry),
+        "readings_per_cycle": round(sum(samples) / len(samples), 2) if samples else 0,
+        "energy_wraps": wraps["count"],
+        "duration_ms": percentiles([duration for lag, duration in recent]),
+        "start_lag_ms": percentiles([lag for lag, duration in recent])
+    }
+
+
+def synthetic_readings(meters, cycle):
+    return {meter_id: {"Voltage": 230.0, "Current": 5.0, "Power": 1.15 + (cycle % 7) * 0.01,
+                       "Energy": (cycle * 3 + index) % 65536, "Energy_F": 12.3, "Frequency": 50.0,
+                       "PowerFactor": 0.95, "AlarmStatus": 0}
+            for index, meter_id in enumerate(meters)}
+
+
+def bench_db(poller, database, meters, cycles):
+    from rollups import update_rollups
+    latencies = []
+    base_ts = int(time.time() * 1000)
+    started = time.perf_counter()
+    for cycle in range(cycles):
+        readings = synthetic_readings(meters, cycle)
+        ts = base_ts + cycle
+        cycle_started = time.perf_counter()
+        with database.write_batch():
+            totals, differences = poller.update_meter_state(readings, ts)
+            poller.save_history(readings, ts, totals)
+            update_rollups(ts, readings, differences, totals)
+        latencies.append(time.perf_counter() - cycle_started)
+    elapsed = time.perf_counter() - started
+    rows_per_cycle = len(meters) * (2 + len(config.ROLLUP_RESOLUTIONS))
+    return {
+        "cycles": cycles,
+        "cycles_per_s": round(cycles / elapsed, 1),
+        "rows_per_s": round(cycles * rows_per_cycle / elapsed, 1),
+        "cycle_ms": percentiles(latencies)
+    }
+
+
+def bench_mqtt(mqtt_handler, broker, messages, timeout=60):
+    first = broker.as_dict()["messages"]
+    started = time.perf_counter()
+    for index in range(messages):
+        mqtt_handler.publish_mqtt(f"bench/{index}", str(index))
+    published = time.perf_counter() - started
+    deadline = time.monotonic() + timeout
+    while broker.as_dict()["messages"] - first < messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    delivered = broker.as_dict()["messages"] - first
+    return {
+        "messages": messages,
+        "delivered": delivered,
+        "enqueue_per_s": round(messages / published, 1),
+        "delivered_per_s": round(delivered / elapsed, 1),
+        "publisher": mqtt_handler.mqtt_stats()
+    }
+
+
+# Сырые выборки за последние hours часов и часовые/суточные агрегаты за days дней
+def prefill_history(database, meters, hours, days):
+    from rollups import bucket_start
+    now = int(time.time() * 1000)
+
+    def fill(conn):
+        for meter_id in meters:
+            conn.executemany(
+                "INSERT OR IGNORE INTO meter_history (meter_id, ts, energy, power, energy_total) VALUES (?, ?, ?, ?, ?)",
+                ((meter_id, now - step * 10000, step % 65536, 1.0, 10 ** 6 - step)
+                 for step in range(hours * 360, 0, -1)))
+            for resolution, seconds in (("1h", 3600), ("1d", 86400)):
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO rollup_{resolution} (meter_id, bucket, samples, power_min, power_max, "
+                    f"power_sum, energy, energy_total) VALUES (?, ?, ?, 0.5, 1.5, ?, ?, ?)",
+                    ((meter_id, bucket_start(now - step * seconds * 1000, seconds), seconds // 10, seconds // 10,
+                      seconds // 36, 10 ** 6 - step * seconds // 36)
+                     for step in range(days * 86400 // seconds, 0, -1)))
+    database.run_in_writer(fill).result()
+
+
+def bench_http(server_port, requests_count, concurrency, timeline):
+    from timeutils import epoch_ms_to_local_iso
+    now = int(time.time() * 1000)
+
+    def iso(offset_ms):
+        return epoch_ms_to_local_iso(now + offset_ms)[:19]
+
+    endpoints = {
+        "/data": ("GET", "/data", None),
+        "/logs": ("GET", "/logs?limit=50", None),
+        "history_raw": ("POST", "/data_page", {"dateStart": iso(-3600 * 1000), "dateStop": iso(0)}),
+        "history_rollup": ("POST", "/data_page", {"dateStart": iso(-timeline * 86400 * 1000), "dateStop": iso(0)}),
+        "/energy": ("GET", f"/energy?from={iso(-timeline * 86400 * 1000)}&to={iso(0)}", None)
+    }
+    local = threading.local()
+
+    def request(method, path, body):
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=30)
+        payload = json.dumps(body) if body is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            local.connection = None
+            status = 0
+        return time.perf_counter() - started, status
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name, (method, path, body) in endpoints.items():
+            started = time.perf_counter()
+            outcomes = list(pool.map(lambda _: request(method, path, body), range(requests_count)))
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                "requests": requests_count,
+                "errors": sum(1 for latency, status in outcomes if status != 200),
+                "rps": round(requests_count / elapsed, 1),
+                "latency_ms": percentiles([latency for latency, status in outcomes])
+            }
+    return results
+
+
+# Плоский список числовых метрик для сравнения запусков
+def flatten(result, prefix=""):
+    items = {}
+    for key, value in result.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[name] = value
+    return items
+
+
+def compare(baseline, result):
+    old, new = flatten(baseline), flatten(result)
+    for name in sorted(set(old) & set(new)):
+        if name.startswith("meta.") or old[name] == new[name]:
+            continue
+        change = f"{(new[name] - old[name]) / old[name] * 100:+.1f}%" if old[name] else "n/a"
+        print(f"{name}: {old[name]} -> {new[name]} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Набор измерений цикла опроса, БД, MQTT и HTTP")
+    parser.add_argument("--gateways", type=int, default=2)
+    parser.add_argument("--units", type=int, default=10, help="Счетчиков на шлюз")
+    parser.add_argument("--poll-seconds", type=float, default=10)
+    parser.add_argument("--poll-interval", type=float, default=1)
+    parser.add_argument("--db-cycles", type=int, default=500)
+    parser.add_argument("--mqtt-messages", type=int, default=20000)
+    parser.add_argument("--http-requests", type=int, default=500, help="Запросов на эндпоинт")
+    parser.add_argument("--http-concurrency", type=int, default=8)
+    parser.add_argument("--history-hours", type=int, default=2, help="Сырых данных для запросов истории")
+    parser.add_argument("--history-days", type=int, default=30, help="Агрегатов для запросов истории и /energy")
+    parser.add_argument("--skip", default="", help="Пропустить этапы через запятую: poll,db,mqtt,http")
+    parser.add_argument("--dir", help="Каталог для БД и файлов выборок (по умолчанию временный)")
+    parser.add_argument("--json", help="Сохранить результат в файл")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для сравнения")
+    args = parser.parse_args()
+    skip = set(filter(None, args.skip.split(",")))
+
+    workdir = args.dir or tempfile.mkdtemp(prefix="pmp-bench-")
+    modbus_port, mqtt_port = free_port(), free_port()
+    configure(workdir, args.gateways, args.units, modbus_port, mqtt_port)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    import app
+    import database
+    import log
+    import meters
+    import mqtt_handler
+    import poller
+    import scheduler
+    import snapshot
+    from werkzeug.serving import make_server
+
+    database.initialize_database()
+    log.set_logging_enabled(True)
+    broker = mqtt_stub.start_in_thread(mqtt_port)
+    mqtt_handler.connect_mqtt()
+    deadline = time.monotonic() + 5
+    while not mqtt_handler.mqtt_stats()["connected"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    registry = meters.REGISTRY
+    result = {"meta": {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "gateways": args.gateways,
+        "units_per_gateway": args.units
+    }}
+
+    if "poll" not in skip:
+        simulator = start_simulator(args.gateways, args.units, modbus_port)
+        try:
+            messages_before = broker.as_dict()["messages"]
+            result["poll"] = bench_poll(poller, scheduler, registry, args.poll_seconds, args.poll_interval)
+            result["poll"]["mqtt_messages_per_s"] = round(
+                (broker.as_dict()["messages"] - messages_before) / args.poll_seconds, 1)
+        finally:
+            simulator.terminate()
+            simulator.wait()
+
+    if "db" not in skip:
+        result["db"] = bench_db(poller, database, list(registry), args.db_cycles)
+
+    if "mqtt" not in skip:
+        result["mqtt"] = bench_mqtt(mqtt_handler, broker, args.mqtt_messages)
+
+    if "http" not in skip:
+        prefill_history(database, list(registry), args.history_hours, args.history_days)
+        if snapshot.get_snapshot() is None:
+            poller.process_cycle(synthetic_readings(list(registry), 0))
+        server_port = free_port()
+        server = make_server("127.0.0.1", server_port, app.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            result["http"] = bench_http(server_port, args.http_requests, args.http_concurrency,
+                                        min(14, args.history_days))
+        finally:
+            server.shutdown()
+
+    log.flush_logs()
+    database.close_database()
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(output)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            print("\nИзменения относительно", args.baseline)
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
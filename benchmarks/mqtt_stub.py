@@ -0,0 +1,140 @@
+# Минимальный брокер MQTT 3.1.1 для измерений: принимает подключения и PUBLISH (QoS 0/1/2),
+# отвечает на PING и SUBSCRIBE и только считает сообщения, никому их не пересылая.
+# Запуск: python benchmarks/mqtt_stub.py --port 1883 [--report 5]
+import argparse
+import asyncio
+import threading
+import time
+
+CONNECT, PUBLISH, PUBREL, SUBSCRIBE, PINGREQ, DISCONNECT = 1, 3, 6, 8, 12, 14
+
+
+class BrokerStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.payload_bytes = 0
+        self.topics = {}
+        self.first_at = None
+        self.last_at = None
+
+    def record(self, topic, size):
+        now = time.perf_counter()
+        with self._lock:
+            self.messages += 1
+            self.payload_bytes += size
+            self.topics[topic] = self.topics.get(topic, 0) + 1
+            if self.first_at is None:
+                self.first_at = now
+            self.last_at = now
+
+    def as_dict(self):
+        with self._lock:
+            return {"connections": self.connections, "messages": self.messages,
+                    "payload_bytes": self.payload_bytes, "topics": len(self.topics)}
+
+
+async def _read_packet(reader):
+    header = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    return header, await reader.readexactly(length) if length else b""
+
+
+async def _handle(reader, writer, stats):
+    stats.connections += 1
+    try:
+        while True:
+            header, body = await _read_packet(reader)
+            kind = header >> 4
+            if kind == CONNECT:
+                writer.write(b"\x20\x02\x00\x00")
+            elif kind == PUBLISH:
+                qos = (header >> 1) & 3
+                topic_length = int.from_bytes(body[:2], "big")
+                topic = body[2:2 + topic_length].decode("utf-8", "replace")
+                position = 2 + topic_length
+                if qos:
+                    packet_id = body[position:position + 2]
+                    position += 2
+                    writer.write((b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id)
+                stats.record(topic, len(body) - position)
+            elif kind == PUBREL:
+                writer.write(b"\x70\x02" + body[:2])
+            elif kind == SUBSCRIBE:
+                granted = bytes(_requested_qos(body))
+                writer.write(bytes([0x90, 2 + len(granted)]) + body[:2] + granted)
+            elif kind == PINGREQ:
+                writer.write(b"\xd0\x00")
+            elif kind == DISCONNECT:
+                break
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+# Запрошенные QoS фильтров из тела SUBSCRIBE (после каждого фильтра идет байт QoS)
+def _requested_qos(body):
+    position = 2
+    while position < len(body):
+        length = int.from_bytes(body[position:position + 2], "big")
+        position += 2 + length
+        yield body[position] & 3
+        position += 1
+
+
+async def serve(port=1883, host="127.0.0.1", stats=None, ready=None):
+    stats = stats or BrokerStats()
+    server = await asyncio.start_server(lambda reader, writer: _handle(reader, writer, stats), host, port)
+    if ready is not None:
+        ready()
+    async with server:
+        await server.serve_forever()
+
+
+# Брокер в фоновом потоке с собственным циклом событий (для запуска из набора тестов)
+def start_in_thread(port=1883, host="127.0.0.1"):
+    stats = BrokerStats()
+    started = threading.Event()
+    thread = threading.Thread(target=lambda: asyncio.run(serve(port, host, stats, started.set)),
+                              name="mqtt-stub", daemon=True)
+    thread.start()
+    if not started.wait(5):
+        raise RuntimeError(f"MQTT-заглушка не запустилась на порту {port}")
+    return stats
+
+
+async def _report(stats, interval):
+    previous = 0
+    while True:
+        await asyncio.sleep(interval)
+        current = stats.as_dict()
+        print(f"{current['messages'] - previous} сообщений за {interval} с, всего {current}", flush=True)
+        previous = current["messages"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT-заглушка для измерений")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--report", type=float, default=0, help="Печатать скорость каждые N секунд")
+    args = parser.parse_args()
+    stats = BrokerStats()
+
+    async def run():
+        if args.report:
+            asyncio.get_running_loop().create_task(_report(stats, args.report))
+        await serve(args.port, args.host, stats)
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
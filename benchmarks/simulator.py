@@ -0,0 +1,112 @@
+# Локальный симулятор шлюзов Modbus TCP с несколькими счетчиками PZEM-016 на каждом.
+# Значения регистров меняются во времени: напряжение и частота колеблются, мощность "дышит",
+# энергия растет и 16-битное младшее слово регулярно переполняется (начальные значения
+# подобраны у самой границы 65535).
+# Запуск: python benchmarks/simulator.py --gateways 2 --units 10 --port 15020
+# (шлюзы слушают порты port, port+1, ..., адреса устройств 1..units)
+import argparse
+import asyncio
+import math
+import random
+import time
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.server import ModbusTcpServer
+
+REGISTER_COUNT = 10
+INPUT_REGISTERS = 4  # Код функции read_input_registers для setValues
+
+
+# Состояние одного счетчика и его блок регистров (раскладка профиля pzem-016)
+class SimulatedMeter:
+    def __init__(self, unit_id, energy_rate):
+        self.unit_id = unit_id
+        self.phase = random.random() * 2 * math.pi
+        self.base_power = random.uniform(200, 4000)  # Вт
+        self.energy_rate = energy_rate  # Множитель скорости роста энергии (ускоряет переполнение)
+        self.energy = 65536 * random.randint(0, 3) + 65536 - random.randint(50, 2000)  # Wh
+        self._energy_fraction = 0.0
+
+    def registers(self, now, elapsed):
+        voltage = 230 + 4 * math.sin(now / 30 + self.phase) + random.uniform(-0.5, 0.5)
+        power = max(0.0, self.base_power * (1 + 0.3 * math.sin(now / 20 + self.phase)) + random.uniform(-20, 20))
+        power_factor = 0.9 + 0.08 * math.sin(now / 45 + self.phase)
+        current = power / (voltage * power_factor)
+        frequency = 50 + 0.05 * math.sin(now / 10 + self.phase)
+
+        self._energy_fraction += power * elapsed / 3600 * self.energy_rate
+        whole = int(self._energy_fraction)
+        self._energy_fraction -= whole
+        self.energy = (self.energy + whole) % (1 << 32)
+
+        current_raw = int(current * 1000)
+        power_raw = int(power * 10)
+        return [
+            int(voltage * 10),
+            current_raw & 0xFFFF, current_raw >> 16,
+            power_raw & 0xFFFF, power_raw >> 16,
+            self.energy & 0xFFFF, self.energy >> 16,
+            int(frequency * 10),
+            int(power_factor * 1000),
+            0
+        ]
+
+
+# silent - адреса устройств, которые не отвечают (как отключенный счетчик на шине)
+def build_gateway(units, energy_rate, silent=()):
+    meters = {unit_id: SimulatedMeter(unit_id, energy_rate) for unit_id in range(1, units + 1)
+              if unit_id not in silent}
+    # Блок начинается с адреса 0 и на один регистр длиннее: контекст сдвигает адрес на +1
+    # и при чтении, и при записи, поэтому запись setValues(.., 0, ..) читается клиентом с адреса 0
+    slaves = {unit_id: ModbusSlaveContext(ir=ModbusSequentialDataBlock(0, [0] * (REGISTER_COUNT + 1)))
+              for unit_id in meters}
+    return meters, ModbusServerContext(slaves=slaves, single=False)
+
+
+async def update_loop(gateways, interval):
+    previous = time.monotonic()
+    while True:
+        now = time.monotonic()
+        elapsed, previous = now - previous, now
+        for meters, context in gateways:
+            for unit_id, meter in meters.items():
+                context[unit_id].setValues(INPUT_REGISTERS, 0, meter.registers(time.time(), elapsed))
+        await asyncio.sleep(interval)
+
+
+async def run(gateways=1, units=3, port=15020, host="127.0.0.1", update_interval=0.5, energy_rate=50.0, ready=None,
+              silent=()):
+    built = [build_gateway(units, energy_rate, silent) for _ in range(gateways)]
+    for meters, context in built:
+        for unit_id, meter in meters.items():
+            context[unit_id].setValues(INPUT_REGISTERS, 0, meter.registers(time.time(), 0))
+    # Запрос к отсутствующему адресу остается без ответа, как на шине RS-485
+    servers = [ModbusTcpServer(context, address=(host, port + index), ignore_missing_slaves=True)
+               for index, (meters, context) in enumerate(built)]
+    for server in servers:
+        await server.serve_forever(background=True)
+    if ready is not None:
+        ready()
+    try:
+        await update_loop(built, update_interval)
+    finally:
+        for server in servers:
+            await server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симулятор шлюзов Modbus TCP со счетчиками PZEM-016")
+    parser.add_argument("--gateways", type=int, default=1)
+    parser.add_argument("--units", type=int, default=3, help="Счетчиков на шлюз")
+    parser.add_argument("--port", type=int, default=15020, help="Порт первого шлюза")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--update-interval", type=float, default=0.5, help="Период обновления регистров (с)")
+    parser.add_argument("--energy-rate", type=float, default=50.0, help="Ускорение роста энергии")
+    parser.add_argument("--silent", default="", help="Адреса неотвечающих устройств через запятую")
+    args = parser.parse_args()
+    silent = {int(unit) for unit in args.silent.split(",") if unit}
+    asyncio.run(run(args.gateways, args.units, args.port, args.host, args.update_interval, args.energy_rate,
+                    ready=lambda: print("ready", flush=True), silent=silent))
+
+
+if __name__ == "__main__":
+    main()
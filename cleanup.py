@@ -1,25 +1,132 @@
-# Очистка исторических данных
-import sqlite3
-from config import SQLITE_DB
-
-def cleanup_historical_data():
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        DELETE FROM historical_data 
-        WHERE timestamp < datetime('now', '-72 hours')
-    """)
-    conn.commit()
-    conn.close()
-
-# Очистка логов
-def cleanup_logs():
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-    cursor.execute("""
-        DELETE FROM logs 
-        WHERE timestamp < datetime('now', '-24 hours')
-    """)
-    conn.commit()
-    conn.close()
+# Фоновая очистка устаревших данных по политике хранения (RETENTION_POLICY в config.py).
+# Работает в отдельном потоке по своему расписанию, удаляет строки небольшими пачками,
+# каждая пачка - отдельная короткая транзакция потока-писателя, поэтому цикл опроса
+# не ждет долгих DELETE и сам никакой очистки не выполняет.
+import threading
+import time
+from datetime import datetime, timedelta
+from database import execute_query, run_in_writer, count_rows
+from log import log_message
+from metrics import Callback
+from samples import sample_store
+from timeutils import now_ms, get_log_timestamp, LOCAL_TIMEZONE
+from config import (RETENTION_POLICY, RETENTION_INTERVAL, RETENTION_BATCH_SIZE,
+                    RETENTION_INCREMENTAL_VACUUM, RETENTION_VACUUM_PAGES, SAMPLE_RETENTION_DAYS)
+
+
+# Граница хранения в формате колонки времени таблицы
+def retention_cutoff(policy):
+    if policy["format"] == "epoch_ms":
+        return now_ms() - policy["hours"] * 3600 * 1000
+    return get_log_timestamp(datetime.now(LOCAL_TIMEZONE) - timedelta(hours=policy["hours"]))
+
+
+# Удаление одной пачки, возвращает число удаленных строк
+def _delete_batch(sql, params):
+    return run_in_writer(lambda conn: conn.execute(sql, params).rowcount).result()
+
+
+# Очистка одной таблицы пачками по RETENTION_BATCH_SIZE строк
+def purge_table(table, policy, batch_size=RETENTION_BATCH_SIZE):
+    column = policy["column"]
+    cutoff = retention_cutoff(policy)
+    deleted = 0
+
+    if policy.get("per_meter"):
+        # Таблицы без rowid с ключом (meter_id, время): удаляем по первичному ключу для каждого счетчика
+        meters = [row[0] for row in execute_query(f"SELECT DISTINCT meter_id FROM {table}") or []]
+        jobs = [(f"""
+            DELETE FROM {table} WHERE meter_id = ? AND {column} IN (
+                SELECT {column} FROM {table} WHERE meter_id = ? AND {column} < ? LIMIT ?)
+        """, (meter, meter, cutoff, batch_size)) for meter in meters]
+    else:
+        jobs = [(f"""
+            DELETE FROM {table} WHERE rowid IN (
+                SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)
+        """, (cutoff, batch_size))]
+
+    for sql, params in jobs:
+        while True:
+            count = _delete_batch(sql, params)
+            count_rows(table, "delete", count)
+            deleted += count
+            if count < batch_size:
+                break
+    return deleted
+
+
+# Возврат свободных страниц файлу БД (только при auto_vacuum=INCREMENTAL)
+def incremental_vacuum(max_pages=RETENTION_VACUUM_PAGES):
+    def run(conn):
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = min(free_pages, max_pages)
+        # Модуль sqlite3 выполняет только первый шаг PRAGMA incremental_vacuum,
+        # а каждый шаг освобождает одну страницу, поэтому вызываем его постранично
+        for _ in range(pages):
+            conn.execute("PRAGMA incremental_vacuum(1)")
+        return free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return run_in_writer(run).result()
+
+
+# Один проход очистки по всем таблицам политики
+def run_retention(policy=RETENTION_POLICY):
+    started = time.monotonic()
+    report = {}
+    for table, table_policy in policy.items():
+        try:
+            report[table] = purge_table(table, table_policy)
+        except Exception as e:
+            log_message(f"Ошибка очистки таблицы {table}: {e}")
+    pages = incremental_vacuum() if RETENTION_INCREMENTAL_VACUUM and any(report.values()) else 0
+    # Полные выборки (samples.py) удаляются файлами-сегментами целиком, без обращения к БД
+    segments = 0
+    try:
+        segments = sample_store.drop_before(now_ms() - SAMPLE_RETENTION_DAYS * 86400 * 1000)
+    except OSError as e:
+        log_message(f"Ошибка очистки сегментов выборок: {e}")
+    return {"deleted": report, "vacuumed_pages": pages, "dropped_segments": segments,
+            "duration": round(time.monotonic() - started, 3)}
+
+
+# Поток очистки со своим расписанием
+class RetentionManager(threading.Thread):
+    def __init__(self, interval=RETENTION_INTERVAL):
+        super().__init__(name="retention", daemon=True)
+        self.interval = interval
+        self.last_report = None
+        self.total_deleted = {}
+        self.total_vacuumed_pages = 0
+        self.total_dropped_segments = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            report = run_retention()
+            self.last_report = report
+            for table, count in report["deleted"].items():
+                self.total_deleted[table] = self.total_deleted.get(table, 0) + count
+            self.total_vacuumed_pages += report["vacuumed_pages"]
+            self.total_dropped_segments += report["dropped_segments"]
+            if any(report["deleted"].values()):
+                deleted = ", ".join(f"{table}: {count}" for table, count in report["deleted"].items() if count)
+                log_message(f"Очистка БД: удалено строк - {deleted}; освобождено страниц: {report['vacuumed_pages']}",
+                            force=True)
+            if report["dropped_segments"]:
+                log_message(f"Очистка выборок: удалено сегментов - {report['dropped_segments']}", force=True)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+retention_manager = RetentionManager()
+
+# Итоги очистки отдаются на /metrics процесса опроса (в нем работает поток очистки)
+Callback("retention_deleted_rows_total", "Строки, удаленные очисткой по политике хранения",
+         lambda: {(table,): count for table, count in dict(retention_manager.total_deleted).items()},
+         ("table",), kind="counter")
+Callback("retention_vacuumed_pages_total", "Страницы, возвращенные файлу БД очисткой",
+         lambda: retention_manager.total_vacuumed_pages, kind="counter")
+Callback("retention_dropped_segments_total", "Сегменты полных выборок, удаленные очисткой",
+         lambda: retention_manager.total_dropped_segments, kind="counter")
+Callback("retention_last_run_seconds", "Длительность последнего прохода очистки",
+         lambda: retention_manager.last_report and retention_manager.last_report["duration"])
@@ -5,6 +5,7 @@ MQTT_BROKER = "10.0.6.122"
 MQTT_PORT = 1883
 MQTT_USERNAME = "home"  # Укажите ваш логин
 MQTT_PASSWORD = "home"  # Укажите ваш пароль
+MQTT_BASE_TOPIC = "home/PM"  # Топики счетчиков без явной записи в MQTT_TOPICS: {MQTT_BASE_TOPIC}/Full_data_{id}
 MQTT_TOPICS = {
     "full_kWh": "home/PM/full_kWh",
     "total_kWh": "home/PM/total_kWh",
@@ -15,30 +16,204 @@ MQTT_TOPICS = {
     "overflow_error": "home/PM/overflow_error"
 }
 
-# Настройки Modbus
-MODBUS_HOSTS = {
-    "L1": {"host": "10.0.6.84", "unit_id": 1},
-    "L2": {"host": "10.0.6.84", "unit_id": 2},
-    "L3": {"host": "10.0.6.84", "unit_id": 3}
+# Конвейер публикации MQTT
+MQTT_QOS = 0
+MQTT_HEARTBEAT_INTERVAL = 60  # Публиковать не реже, чем раз в столько секунд, даже без изменений
+# Зона нечувствительности по полям JSON (по окончанию имени поля, например L1U -> "U")
+# и по скалярным топикам (по последней части имени топика). Изменение в пределах зоны не публикуется.
+MQTT_DEADBANDS = {
+    "U": 0.5,  # Напряжение (В)
+    "A": 0.05,  # Ток (А)
+    "W": 0.01,  # Мощность (кВт)
+    "Wh": 1,  # Энергия (Wh)
+    "F_Wh": 0.1,  # Энергия (кВтч)
+    "Hz": 0.05,  # Частота (Гц)
+    "Pf": 0.01,  # Коэффициент мощности
+    "General-W": 0.01,
+    "total_kWh": 0.01
 }
+MQTT_DEADBAND_IGNORE = {"timestamp"}  # Поля, изменение которых само по себе не повод публиковать
+MQTT_OFFLINE_QUEUE_SIZE = 1000  # Сообщений в памяти, пока брокер недоступен
+MQTT_SPOOL_FILE = "mqtt_spool.jsonl"  # Файл для сообщений сверх очереди в памяти
+MQTT_SPOOL_MAX_BYTES = 5 * 1024 * 1024  # Максимальный размер файла, дальше сообщения отбрасываются
+MQTT_MAX_QUEUED = 100  # Сообщений, переданных paho и еще не отправленных брокеру (при любом MQTT_QOS)
 
-# Описание регистров
-MODBUS_REGISTER_MAP = {
-    "Voltage": (0, "uint16be", 0.1),  # Напряжение (V)
-    "CurrentLow": (1, "uint16be", 0.001),  # Ток (A) - младшие 16 бит
-    "PowerLow": (3, "uint16be", 1),  # Мощность (W) - младшие 16 бит
-    "EnergyLow": (5, "uint16be", 1),  # Энергия (Wh) - младшие 16 бит
-    "EnergyHigh": (6, "uint16be", 1),  # Энергия (Wh) - старшие 16 бит
-    "Frequency": (7, "uint16be", 0.1),  # Частота (Hz)
-    "PowerFactor": (8, "uint16be", 0.001),  # Коэффициент мощности
-    "AlarmStatus": (9, "int16be", 1)  # Статус тревоги
+# Шлюзы RS-485/TCP: имя -> адрес (port можно не указывать, тогда MODBUS_PORT).
+# Шлюзы опрашиваются параллельно, счетчики на шине одного шлюза - строго по очереди.
+MODBUS_GATEWAYS = {
+    "gw1": {"host": "10.0.6.84"}
 }
 
+# Реестр счетчиков: id -> шлюз, адрес устройства на шине, подпись для панели и профиль (METER_PROFILES).
+# id используется в БД (meter_id), в MQTT и в ключах JSON ({id}raw, {id}total), поэтому
+# после начала сбора данных его не меняют. Порядок записей - порядок карточек на панели.
+METERS = {
+    "L1": {"gateway": "gw1", "unit_id": 1, "name": "Фаза A"},
+    "L2": {"gateway": "gw1", "unit_id": 2, "name": "Фаза B", "header_class": "bg-success"},
+    "L3": {"gateway": "gw1", "unit_id": 3, "name": "Фаза C", "header_class": "bg-danger"}
+}
+
+# Период опроса счетчиков (секунды)
+POLL_INTERVAL = 10
+
+# Снимок показаний считается устаревшим, если он старше этого значения (секунды)
+SNAPSHOT_MAX_AGE = 3 * POLL_INTERVAL
+
+# Server-Sent Events (/stream): интервал комментариев keep-alive и максимум строк журнала в одном событии
+SSE_KEEPALIVE = 15
+SSE_MAX_LOG_LINES = 50
+
+# Процесс опроса (pmp-poller) и веб-процессы обмениваются последним снимком через таблицу live_state.
+# Веб-процесс перечитывает ее не чаще, чем раз в LIVE_STATE_REFRESH секунд (и с таким же шагом ждет
+# новый снимок для /stream)
+LIVE_STATE_REFRESH = 0.5
+# Метрики процесса опроса отдаются им самим на отдельном порту (None - не запускать)
+POLLER_METRICS_HOST = "127.0.0.1"
+POLLER_METRICS_PORT = 9105
+
+# Встроенные метрики (/metrics, текстовый формат Prometheus)
+METRICS_PREFIX = "pmp_"  # Префикс имен всех метрик
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы гистограмм задержек (с)
+
+# Параметры Modbus TCP подключений (одно постоянное подключение на шлюз)
+MODBUS_PORT = 502
+# Неответивший счетчик занимает шину шлюза на MODBUS_TIMEOUT * (MODBUS_RETRIES + 1) секунд, поэтому
+# таймаут должен быть намного меньше POLL_INTERVAL. Повтора внутри цикла нет: счетчик опрашивается
+# снова в следующем цикле
+MODBUS_TIMEOUT = 1  # Таймаут ответа (секунды)
+MODBUS_RETRIES = 0  # Повторы запроса без ответа (pymodbus по умолчанию повторяет 3 раза)
+MODBUS_RECONNECT_DELAY_MIN = 1  # Первая пауза перед повторным подключением (секунды)
+MODBUS_RECONNECT_DELAY_MAX = 60  # Максимальная пауза между попытками подключения (секунды)
+
+# Профили моделей счетчиков: блок input-регистров и преобразование его в показания.
+# Поле: (первый регистр от address, тип, множитель, знаков после запятой или None).
+# Типы: u16, s16 - один регистр; u32, s32 - два регистра, порядок слов задает word_order
+# ("little" - младшее слово первым, как у PZEM-016; "big" - старшее первым).
+# energy_field и power_field - поля, которые сохраняются в историю и агрегаты (энергия - 16-битный
+# счетчик Вт·ч, u16 без множителя), mqtt - суффиксы ключей {id}{суффикс} в полном наборе показаний
+# (поле без суффикса публикуется под своим именем).
+# Профили компилируются один раз при запуске (profiles.py); новая модель - новая запись здесь.
+METER_PROFILES = {
+    "pzem-016": {
+        "address": 0,
+        "count": 10,
+        "word_order": "little",
+        "fields": {
+            "Voltage": (0, "u16", 0.1, 1),  # Напряжение (В)
+            "Current": (1, "u32", 0.001, 1),  # Ток (А)
+            "Power": (3, "u32", 0.0001, 2),  # Мощность (кВт, регистр в 0.1 Вт)
+            "Energy": (5, "u16", 1, None),  # Энергия (Wh) - младшие 16 бит, по ним считается переполнение
+            "Energy_F": (5, "u32", 0.001, 1),  # Энергия (кВтч) - полное 32-битное значение
+            "Frequency": (7, "u16", 0.1, 1),  # Частота (Гц)
+            "PowerFactor": (8, "u16", 0.001, 2),  # Коэффициент мощности
+            "AlarmStatus": (9, "s16", 1, None)  # Статус тревоги
+        },
+        "energy_field": "Energy",
+        "power_field": "Power",
+        "mqtt": {"Voltage": "U", "Current": "A", "Power": "W", "Energy": "Wh", "Energy_F": "F_Wh",
+                 "Frequency": "Hz", "PowerFactor": "Pf", "AlarmStatus": "Alarm"}
+    }
+}
+DEFAULT_METER_PROFILE = "pzem-016"  # Профиль счетчиков, для которых в METERS не указан "profile"
+
+# Часовой пояс, в котором отображается и вводится время (UTC+3)
+UTC_OFFSET_HOURS = 3
+
 # Настройки SQLite
 SQLITE_DB = "power_manager.db"
+SQLITE_BUSY_TIMEOUT = 5  # Ожидание блокировки БД (секунды)
+DB_WRITE_BATCH_SIZE = 500  # Максимум заданий записи в одной транзакции
+DB_READ_POOL_SIZE = 8  # Сколько соединений только для чтения держать открытыми
+
+# Хранение сырых 10-секундных выборок meter_history (часы)
+HISTORY_RETENTION_HOURS = 72
+
+# Агрегаты (rollup) по интервалам: имя -> длительность интервала (секунды).
+# Обновляются инкрементально при каждой записи выборки и хранятся долго.
+ROLLUP_RESOLUTIONS = {
+    "1m": 60,
+    "1h": 3600,
+    "1d": 86400
+}
+
+# Политика хранения: таблица -> колонка времени, ее формат и срок хранения (часы).
+# Формат "epoch_ms" - миллисекунды Unix, "text" - строка 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' местного времени.
+# per_meter - таблица без rowid с ключом (meter_id, время), удаляется по ключу для каждого счетчика.
+# Таблицы, которых нет в списке (например rollup_1d), не очищаются.
+RETENTION_POLICY = {
+    "meter_history": {"column": "ts", "format": "epoch_ms", "hours": HISTORY_RETENTION_HOURS, "per_meter": True},
+    "logs": {"column": "timestamp", "format": "text", "hours": 24},
+    "rollup_1m": {"column": "bucket", "format": "epoch_ms", "hours": 30 * 24, "per_meter": True},
+    "rollup_1h": {"column": "bucket", "format": "epoch_ms", "hours": 5 * 365 * 24, "per_meter": True}
+}
+RETENTION_INTERVAL = 300  # Период запуска очистки (секунды)
+RETENTION_BATCH_SIZE = 1000  # Строк за одну транзакцию удаления
+RETENTION_INCREMENTAL_VACUUM = True  # Возвращать освободившиеся страницы файлу БД
+RETENTION_VACUUM_PAGES = 1000  # Максимум страниц за один запуск incremental_vacuum
+
+# Полные выборки всех полей счетчиков (samples.py): колоночные файлы-сегменты фиксированной
+# ширины, по каталогу на счетчик. Сегменты старше SAMPLE_RETENTION_DAYS удаляются целиком.
+SAMPLE_STORE_DIR = "samples"
+SAMPLE_SEGMENT_HOURS = 24  # Период, который покрывает один сегмент
+SAMPLE_RETENTION_DAYS = 60
+SAMPLE_MAX_POINTS = 5000  # Больше точек /samples не отдает (выборки прореживаются равномерно)
+
+# Недавние показания всех полей для живых графиков (recent.py, /recent): кольцевой буфер на счетчик
+# в файле, отображенном в память. Пишет процесс опроса, веб-процессы читают тот же файл.
+# В /dev/shm файл живет в оперативной памяти и не изнашивает SD-карту
+RECENT_BUFFER_DIR = "/dev/shm/pmp" if os.path.isdir("/dev/shm") else "recent"
+RECENT_HOURS = 6  # Сколько часов хранит буфер (емкость - RECENT_HOURS * 3600 / POLL_INTERVAL выборок)
+RECENT_MAX_POINTS = 2000  # Больше точек /recent не отдает даже без прореживания
+
+# Скользящая статистика показаний (stats.py, /stats): окно - имя -> длительность (секунды).
+# Окно хранит не больше длительность / POLL_INTERVAL выборок каждого поля
+STATS_WINDOWS = {"1m": 60, "15m": 900, "1h": 3600}
+STATS_FIELDS = ["Voltage", "Current", "Power", "PowerFactor", "Frequency"]
+# Правила событий: поле, окно и статистика (last - последнее значение, mean, min, max, stdev),
+# порог срабатывания above или below и порог снятия clear (гистерезис: у самого порога событие
+# не повторяется каждый цикл). type "imbalance" - перекос между счетчиками: наибольшее
+# отклонение статистики от среднего по счетчикам, % от среднего. meters - только эти счетчики.
+# События публикуются в {STATS_EVENTS_TOPIC}/{правило}/{счетчик} и пишутся в журнал
+STATS_RULES = [
+    {"name": "undervoltage", "field": "Voltage", "window": "1m", "stat": "mean", "below": 207, "clear": 212},
+    {"name": "overvoltage", "field": "Voltage", "window": "1m", "stat": "mean", "above": 253, "clear": 248},
+    {"name": "overcurrent", "field": "Current", "stat": "last", "above": 60, "clear": 55},
+    {"name": "phase_imbalance", "type": "imbalance", "field": "Voltage", "window": "1m", "stat": "mean",
+     "above": 4, "clear": 3}
+]
+STATS_EVENTS_TOPIC = f"{MQTT_BASE_TOPIC}/events"
+STATS_EVENT_HISTORY = 100  # Последние события в /stats
+
+# Статические ресурсы (assets.py, команда pmp-build-assets): каждый набор исходных файлов из static/
+# собирается в один минифицированный файл с хешем содержимого в имени, рядом - варианты .gz и .br.
+# Шаблоны ссылаются на наборы через asset_url(), файлы отдает /assets с неизменяемым кэшем
+ASSET_BUNDLES = {
+    "base.css": ["css/bootstrap.min.css", "css/styles.css"],
+    "base.js": ["js/jquery-3.7.1.min.js", "js/bootstrap.bundle.min.js"],
+    # jQuery UI нужен только календарю на странице истории
+    "datepicker.css": ["css/jquery-ui.css"],
+    "datepicker.js": ["js/jquery-ui.js"]
+}
+ASSET_OUTPUT_DIR = "static/dist"  # Относительно каталога проекта
+ASSET_MAX_AGE = 365 * 24 * 3600  # Срок кэширования в браузере (секунды)
+
+# Примерное число точек, которое должен вернуть запрос истории
+HISTORY_TARGET_POINTS = 500
+
+# Размер пачки строк при потоковой выгрузке истории (/export)
+EXPORT_BATCH_SIZE = 1000
+
+# Импорт истории из CSV/NDJSON (importer.py, команда pmp-import): строк в одной транзакции.
+# Вместе с каждой пачкой сохраняется позиция в файле, прерванный импорт продолжается с нее
+IMPORT_BATCH_SIZE = 50000
 
-# Глобальная переменная для управления логированием
-LOGGING_ENABLED = True
+# Журнал событий: сообщения копятся в очереди и записываются в БД пачками фоновым потоком,
+# последние LOG_RING_SIZE записей хранятся в памяти для /logs
+LOG_QUEUE_SIZE = 10000  # Максимум сообщений, ожидающих записи (лишние отбрасываются)
+LOG_BATCH_SIZE = 200  # Максимум сообщений в одной вставке
+LOG_FLUSH_INTERVAL = 1.0  # Как часто сбрасывать очередь в БД (секунды)
+LOG_RING_SIZE = 1000  # Сколько последних сообщений хранить в памяти
+LOGGING_STATE_TTL = 5  # Флаг "логирование включено" перечитывается из БД не реже, чем раз в столько секунд
 
-# Глобальные переменные для сохранения предыдущих значений энергии
-PREVIOUS_ENERGY = {"L1": 0, "L2": 0, "L3": 0}
\ No newline at end of file
+# Глобальные переменные для сохранения предыдущих значений энергии (по id счетчика)
+PREVIOUS_ENERGY = {}
\ No newline at end of file
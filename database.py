@@ -1,50 +1,416 @@
+import atexit
+import queue
 import sqlite3
-from config import SQLITE_DB
+import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from metrics import Callback, db_query_seconds, db_write_batch_seconds, db_rows
+from config import (SQLITE_DB, SQLITE_BUSY_TIMEOUT, DB_WRITE_BATCH_SIZE, DB_READ_POOL_SIZE, UTC_OFFSET_HOURS,
+                    ROLLUP_RESOLUTIONS, RETENTION_INCREMENTAL_VACUUM)
 
-def execute_query(query, params=(), fetchone=False):
+# Все записи в БД выполняет один поток-писатель с постоянным соединением в режиме WAL.
+# Задания из очереди, накопившиеся к моменту записи, выполняются в одной транзакции,
+# поэтому fsync выполняется один раз на пачку, а не на каждый оператор.
+# Веб-обработчики читают через отдельные соединения только для чтения и не ждут писателя.
+
+_READ_PREFIXES = ("SELECT", "WITH", "EXPLAIN")
+_WRITE_TARGET = re.compile(r"^\s*(INSERT|REPLACE|UPDATE|DELETE)\b(?:\s+OR\s+\w+)?(?:\s+INTO|\s+FROM)?\s+(\w+)", re.I)
+
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_read_pool = queue.LifoQueue()
+_local = threading.local()
+
+
+def _connect():
+    conn = sqlite3.connect(SQLITE_DB, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL synchronous=NORMAL не теряет целостность, а fsync выполняется только при checkpoint
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# Поток-писатель: забирает задания из очереди и выполняет их пачками в одной транзакции
+def _writer_loop():
+    conn = _connect()
+    while True:
+        item = _write_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            try:
+                item = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                _write_queue.put(None)  # Завершим работу после этой пачки
+                break
+            batch.append(item)
+        _run_batch(conn, batch)
+    conn.close()
+
+
+def _run_batch(conn, batch):
+    started = time.perf_counter()
+    results = []
     try:
-        conn = sqlite3.connect(SQLITE_DB)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = cursor.fetchone() if fetchone else cursor.fetchall()
-        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        for func, future in batch:
+            # Точка сохранения изолирует ошибку одного задания от остальных заданий пачки
+            conn.execute("SAVEPOINT job")
+            try:
+                results.append((future, func(conn), None))
+                conn.execute("RELEASE job")
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                results.append((future, None, e))
+        conn.execute("COMMIT")
+        db_write_batch_seconds.observe(time.perf_counter() - started)
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Ошибка при работе с БД: {e}")
+        for func, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for future, result, error in results:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+def _ensure_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+
+
+# Передача функции func(conn) потоку-писателю, возвращает Future с результатом
+def run_in_writer(func):
+    _ensure_writer()
+    future = Future()
+    _write_queue.put((func, future))
+    return future
+
+
+# Остановка писателя с дозаписью очереди (вызывается при завершении процесса)
+def close_database():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            _write_queue.put(None)
+            _writer_thread.join()
+        _writer_thread = None
+    while not _read_pool.empty():
+        _read_pool.get_nowait().close()
+
+
+atexit.register(close_database)
+
+Callback("db_write_queue", "Заданий в очереди потока-писателя", _write_queue.qsize)
+
+
+# Метки метрик оператора записи: (таблица, операция), разбор кэшируется по тексту запроса
+_write_targets = {}
+
+
+def _write_target(query):
+    target = _write_targets.get(query)
+    if target is None:
+        match = _WRITE_TARGET.match(query)
+        target = (match.group(2), match.group(1).lower()) if match else ("other", "other")
+        if len(_write_targets) < 1000:
+            _write_targets[query] = target
+    return target
+
+
+# Учет числа строк, измененных записью в таблицу (для вызовов conn.execute/executemany вне execute_query)
+def count_rows(table, op, rows):
+    if rows > 0:
+        db_rows.labels(table, op).inc(rows)
+
+
+def _execute_statements(statements):
+    def run(conn):
+        result = None
+        for query, params, fetchone in statements:
+            started = time.perf_counter()
+            cursor = conn.execute(query, params)
+            result = cursor.fetchone() if fetchone else cursor.fetchall()
+            db_query_seconds.observe(time.perf_counter() - started, "write")
+            count_rows(*_write_target(query), cursor.rowcount)
         return result
+    return run
+
+
+# Все записи внутри блока (из текущего потока) выполняются одной транзакцией при выходе из блока
+@contextmanager
+def write_batch():
+    if getattr(_local, "batch", None) is not None:
+        yield  # Вложенный блок входит во внешнюю транзакцию
+        return
+    statements = []
+    _local.batch = statements
+    try:
+        yield
+    finally:
+        _local.batch = None
+    if statements:
+        try:
+            run_in_writer(_execute_statements(statements)).result()
+        except sqlite3.Error as e:
+            print(f"Ошибка при работе с БД: {e}")
+
+
+# Соединение только для чтения из пула
+@contextmanager
+def read_connection():
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = sqlite3.connect(SQLITE_DB, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        if _read_pool.qsize() < DB_READ_POOL_SIZE:
+            _read_pool.put(conn)
+        else:
+            conn.close()
+
+
+def execute_query(query, params=(), fetchone=False):
+    try:
+        if query.lstrip().upper().startswith(_READ_PREFIXES):
+            with read_connection() as conn:
+                started = time.perf_counter()
+                cursor = conn.execute(query, params)
+                rows = cursor.fetchone() if fetchone else cursor.fetchall()
+                db_query_seconds.observe(time.perf_counter() - started, "read")
+                return rows
+
+        batch = getattr(_local, "batch", None)
+        if batch is not None:
+            batch.append((query, params, fetchone))
+            return None
+        return run_in_writer(_execute_statements([(query, params, fetchone)])).result()
     except sqlite3.Error as e:
         print(f"Ошибка при работе с БД: {e}")
         return None
-    finally:
-        conn.close()
+
+def _table_columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def _table_exists(cursor, table):
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+# Перевод historical_data с текстовых меток времени на целые миллисекунды Unix (колонка ts).
+# Таблица пересобирается внутри транзакции: id строк сохраняются, читатели WAL
+# до фиксации видят старую версию таблицы.
+def _migrate_historical_data(cursor):
+    if not _table_exists(cursor, "historical_data") or "ts" in _table_columns(cursor, "historical_data"):
+        return
+
+    # Старые строки записывались как местное время UTC+3 с ошибочной пометкой "+00:00",
+    # поэтому для них смещение вычитается; строки CURRENT_TIMESTAMP уже в UTC
+    offset_ms = UTC_OFFSET_HOURS * 3600 * 1000
+    cursor.execute("""
+        CREATE TABLE historical_data_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            L1history REAL,
+            L2history REAL,
+            L3history REAL,
+            ts INTEGER NOT NULL
+        );
+    """)
+    cursor.execute(f"""
+        INSERT INTO historical_data_new (id, L1history, L2history, L3history, ts)
+        SELECT id, L1history, L2history, L3history, COALESCE(
+            CAST(strftime('%s', timestamp) AS INTEGER) * 1000
+            + CAST(substr(strftime('%f', timestamp), 4) AS INTEGER)
+            - CASE WHEN timestamp LIKE '%T%+00:00' THEN {offset_ms} ELSE 0 END, 0)
+        FROM historical_data
+    """)
+    cursor.execute("DROP TABLE historical_data")
+    cursor.execute("ALTER TABLE historical_data_new RENAME TO historical_data")
+
+
+# Перенос данных из таблиц с фиксированными колонками L1/L2/L3 (historical_data, raw_data,
+# total_data) в нормализованные meter_history и meter_state. Колонки L1..L3 становятся
+# счетчиками с такими же id, старые таблицы удаляются.
+_LEGACY_METERS = ("L1", "L2", "L3")
+
+
+def _migrate_to_meter_tables(cursor):
+    migrated = False
+    if _table_exists(cursor, "historical_data"):
+        migrated = True
+        _migrate_historical_data(cursor)
+        for meter in _LEGACY_METERS:
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO meter_history (meter_id, ts, energy)
+                SELECT ?, ts, CAST({meter}history AS INTEGER) FROM historical_data
+                WHERE {meter}history IS NOT NULL
+            """, (meter,))
+        cursor.execute("DROP TABLE historical_data")
+
+    if _table_exists(cursor, "raw_data") and _table_exists(cursor, "total_data"):
+        for meter in _LEGACY_METERS:
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO meter_state (meter_id, raw, total, ts)
+                SELECT ?, r.{meter}raw, t.{meter}total,
+                       CAST(strftime('%s', 'now') AS INTEGER) * 1000
+                FROM raw_data r, total_data t WHERE r.id = 1 AND t.id = 1
+            """, (meter,))
+    for table in ("raw_data", "total_data"):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    return migrated
+
+
+# Заполнение energy_total (непрерывная накопленная энергия, Wh) для уже сохраненных строк.
+# Приросты между соседними выборками считаются как в calculate_difference (одно переполнение
+# 16-битного счетчика за 10 секунд), затем суммируются; значения сдвигаются так, чтобы
+# последняя строка счетчика совпала с накопленным значением meter_state.total,
+# и новые выборки продолжали ту же шкалу.
+def _backfill_meter_history_energy(cursor):
+    cursor.execute("""
+        WITH steps AS (
+            SELECT meter_id, ts, energy, LAG(energy) OVER (PARTITION BY meter_id ORDER BY ts) AS previous
+            FROM meter_history
+        ),
+        running AS (
+            SELECT meter_id, ts, SUM(CASE
+                WHEN previous IS NULL OR energy IS NULL THEN 0
+                WHEN energy >= previous THEN energy - previous
+                ELSE 65536 - previous + energy END) OVER (PARTITION BY meter_id ORDER BY ts) AS value
+            FROM steps
+        ),
+        shift AS (
+            SELECT running.meter_id, COALESCE(CAST(meter_state.total AS INTEGER), MAX(running.value)) - MAX(running.value) AS delta
+            FROM running LEFT JOIN meter_state ON meter_state.meter_id = running.meter_id
+            GROUP BY running.meter_id
+        )
+        UPDATE meter_history SET energy_total = running.value + shift.delta
+        FROM running JOIN shift ON shift.meter_id = running.meter_id
+        WHERE meter_history.meter_id = running.meter_id AND meter_history.ts = running.ts
+    """)
+
+
+# То же для агрегатов: energy_total интервала - накопленная энергия на его последней выборке
+def _backfill_rollup_energy(cursor, table):
+    cursor.execute(f"""
+        WITH running AS (
+            SELECT meter_id, bucket, SUM(energy) OVER (PARTITION BY meter_id ORDER BY bucket) AS value
+            FROM {table}
+        ),
+        shift AS (
+            SELECT running.meter_id, COALESCE(CAST(meter_state.total AS INTEGER), MAX(running.value)) - MAX(running.value) AS delta
+            FROM running LEFT JOIN meter_state ON meter_state.meter_id = running.meter_id
+            GROUP BY running.meter_id
+        )
+        UPDATE {table} SET energy_total = running.value + shift.delta
+        FROM running JOIN shift ON shift.meter_id = running.meter_id
+        WHERE {table}.meter_id = running.meter_id AND {table}.bucket = running.bucket
+    """)
+
+
+# Однократное заполнение только что созданной таблицы агрегатов по сохраненным сырым выборкам:
+# иначе по истечении срока хранения meter_history данные до обновления пропали бы из запросов
+# по агрегатам и /energy. Интервалы - как bucket_start в rollups.py (границы по местному времени),
+# прирост энергии между соседними выборками - как в _backfill_meter_history_energy.
+# samples считает только выборки с мощностью: у перенесенных из historical_data ее нет
+def _backfill_rollups(cursor, resolution, seconds):
+    size = seconds * 1000
+    offset_ms = UTC_OFFSET_HOURS * 3600 * 1000
+    cursor.execute(f"""
+        WITH steps AS (
+            SELECT meter_id, ts, energy, power, energy_total,
+                   LAG(energy) OVER (PARTITION BY meter_id ORDER BY ts) AS previous
+            FROM meter_history
+        )
+        INSERT INTO rollup_{resolution} (meter_id, bucket, samples, power_min, power_max, power_sum, energy,
+                                         energy_total)
+        SELECT meter_id, (ts + ?) / ? * ? - ? AS bucket, COUNT(power), MIN(power), MAX(power), SUM(power),
+               SUM(CASE
+                   WHEN previous IS NULL OR energy IS NULL THEN 0
+                   WHEN energy >= previous THEN energy - previous
+                   ELSE 65536 - previous + energy END),
+               MAX(energy_total)
+        FROM steps
+        GROUP BY meter_id, bucket
+    """, (offset_ms, size, size, offset_ms))
+
+
+# Добавление колонки energy_total в таблицы, созданные до ее появления, с заполнением
+def _migrate_energy_total(cursor, history_migrated):
+    if "energy_total" not in _table_columns(cursor, "meter_history"):
+        cursor.execute("ALTER TABLE meter_history ADD COLUMN energy_total INTEGER")
+        history_migrated = True
+    if history_migrated:
+        _backfill_meter_history_energy(cursor)
+    for resolution in ROLLUP_RESOLUTIONS:
+        table = f"rollup_{resolution}"
+        if "energy_total" not in _table_columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN energy_total INTEGER")
+            _backfill_rollup_energy(cursor, table)
+
 
 def initialize_database():
-    conn = sqlite3.connect(SQLITE_DB)
+    conn = _connect()
     cursor = conn.cursor()
 
+    # Режим auto_vacuum=INCREMENTAL нужен для постепенного возврата места после очистки.
+    # Для существующей БД он вступает в силу только после однократного VACUUM
+    if RETENTION_INCREMENTAL_VACUUM and cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+
+    cursor.execute("BEGIN")
+
     tables = {
-        "raw_data": """
-            CREATE TABLE IF NOT EXISTS raw_data (
-                id INTEGER PRIMARY KEY,
-                L1raw INTEGER DEFAULT 0,
-                L2raw INTEGER DEFAULT 0,
-                L3raw INTEGER DEFAULT 0,
-                timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+        # Последнее сырое значение 16-битного счетчика энергии и накопленная энергия (Wh)
+        "meter_state": """
+            CREATE TABLE IF NOT EXISTS meter_state (
+                meter_id TEXT PRIMARY KEY,
+                raw INTEGER NOT NULL DEFAULT 0,
+                total REAL NOT NULL DEFAULT 0,
+                ts INTEGER
             );
         """,
-        "total_data": """
-            CREATE TABLE IF NOT EXISTS total_data (
-                id INTEGER PRIMARY KEY,
-                L1total REAL DEFAULT 0,
-                L2total REAL DEFAULT 0,
-                L3total REAL DEFAULT 0,
-                timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-            );
+        # Сырые выборки. Ключ (meter_id, ts) без rowid: выборка счетчика за период
+        # читается одним диапазоном первичного ключа, отдельный индекс не нужен.
+        # energy - сырое 16-битное значение счетчика, energy_total - непрерывная
+        # накопленная энергия (Wh), по ней расход за период - разность двух выборок
+        "meter_history": """
+            CREATE TABLE IF NOT EXISTS meter_history (
+                meter_id TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                energy INTEGER,
+                power REAL,
+                energy_total INTEGER,
+                PRIMARY KEY (meter_id, ts)
+            ) WITHOUT ROWID;
         """,
-        "historical_data": """
-            CREATE TABLE IF NOT EXISTS historical_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                L1history REAL,
-                L2history REAL,
-                L3history REAL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        # Последний снимок показаний процесса опроса для веб-процессов (одна строка, см. snapshot.py)
+        "live_state": """
+            CREATE TABLE IF NOT EXISTS live_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                timestamp TEXT,
+                payload TEXT NOT NULL,
+                log_seq INTEGER NOT NULL DEFAULT 0
             );
         """,
         "logs": """
@@ -58,18 +424,53 @@ def initialize_database():
                 id INTEGER PRIMARY KEY,
                 logging_enabled BOOLEAN NOT NULL DEFAULT 0
             );
+        """,
+        # Позиция импорта файла истории (importer.py): сколько записей файла учтено и
+        # состояние счетчиков энергии после них. Обновляется в транзакции каждой пачки
+        "import_checkpoints": """
+            CREATE TABLE IF NOT EXISTS import_checkpoints (
+                source TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                records INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            );
         """
     }
 
+    # Агрегаты по интервалам (см. rollups.py), ключ (meter_id, bucket)
+    for resolution in ROLLUP_RESOLUTIONS:
+        tables[f"rollup_{resolution}"] = f"""
+            CREATE TABLE IF NOT EXISTS rollup_{resolution} (
+                meter_id TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                power_min REAL,
+                power_max REAL,
+                power_sum REAL,
+                energy INTEGER NOT NULL DEFAULT 0,
+                energy_total INTEGER,
+                PRIMARY KEY (meter_id, bucket)
+            ) WITHOUT ROWID;
+        """
+
+    created = [table for table in tables if not _table_exists(cursor, table)]
     for table, query in tables.items():
         cursor.execute(query)
-        if table in ["raw_data", "total_data"]:
-            cursor.execute(f"INSERT OR IGNORE INTO {table} (id, {', '.join(['L1' + ('raw' if table == 'raw_data' else 'total'), 'L2' + ('raw' if table == 'raw_data' else 'total'), 'L3' + ('raw' if table == 'raw_data' else 'total')])}) VALUES (1, 0, 0, 0)")
 
         # Инициализация таблицы settings
         if table == "settings":
             cursor.execute("INSERT OR IGNORE INTO settings (id, logging_enabled) VALUES (1, 0)")
 
+    _migrate_energy_total(cursor, _migrate_to_meter_tables(cursor))
+    # Агрегаты появились позже сырой истории: новые таблицы заполняются по уже сохраненным выборкам
+    for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+        if f"rollup_{resolution}" in created:
+            _backfill_rollups(cursor, resolution, seconds)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+
     conn.commit()
     conn.close()
 
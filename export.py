@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import zlib
+from database import read_connection
+from config import EXPORT_BATCH_SIZE, ROLLUP_RESOLUTIONS
+from timeutils import epoch_ms_to_local_iso
+
+# Потоковая выгрузка истории: строки читаются курсором пачками по EXPORT_BATCH_SIZE
+# и сразу отдаются клиенту, поэтому память не зависит от длины периода.
+
+RAW_COLUMNS = ["meter_id", "ts", "timestamp", "energy", "power", "energy_total"]
+ROLLUP_COLUMNS = ["meter_id", "ts", "timestamp", "samples", "power_min", "power_max", "power_avg", "energy",
+                  "energy_total"]
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson"
+}
+
+
+def export_columns(resolution):
+    return RAW_COLUMNS if resolution == "raw" else ROLLUP_COLUMNS
+
+
+# Запрос и преобразование строки для выбранного разрешения.
+# Порядок сортировки совпадает с индексом, чтобы SQLite не сортировал весь результат
+def _export_query(resolution):
+    if resolution == "raw":
+        query = """
+            SELECT meter_id, ts, energy, power, energy_total FROM meter_history
+            WHERE meter_id = ? AND ts BETWEEN ? AND ?
+            ORDER BY ts ASC
+        """
+
+        def convert(row):
+            meter_id, ts, energy, power, energy_total = row
+            return [meter_id, ts, epoch_ms_to_local_iso(ts), energy, power, energy_total]
+        return query, convert
+
+    if resolution not in ROLLUP_RESOLUTIONS:
+        raise ValueError(f"Неизвестное разрешение: {resolution}")
+    query = f"""
+        SELECT meter_id, bucket, samples, power_min, power_max, power_sum, energy, energy_total FROM rollup_{resolution}
+        WHERE meter_id = ? AND bucket BETWEEN ? AND ?
+        ORDER BY bucket ASC
+    """
+
+    def convert(row):
+        meter_id, bucket, samples, power_min, power_max, power_sum, energy, energy_total = row
+        # У интервалов из старых данных без мощности (samples = 0) среднего нет
+        power_avg = round(power_sum / samples, 4) if samples and power_sum is not None else None
+        return [meter_id, bucket, epoch_ms_to_local_iso(bucket), samples, power_min, power_max, power_avg, energy,
+                energy_total]
+    return query, convert
+
+
+# Пачки строк из БД (каждая пачка - список списков значений).
+# Каждый счетчик читается отдельно, диапазоном первичного ключа (meter_id, время)
+def iter_batches(resolution, start_ms, stop_ms, meters, batch_size=EXPORT_BATCH_SIZE):
+    query, convert = _export_query(resolution)
+    with read_connection() as conn:
+        for meter in meters:
+            cursor = conn.execute(query, (meter, start_ms, stop_ms))
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [convert(row) for row in rows]
+            finally:
+                cursor.close()
+
+
+# Кодирование пачек в текст CSV или NDJSON
+def iter_encoded(batches, columns, fmt):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    elif fmt == "ndjson":
+        for batch in batches:
+            yield "".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in batch)
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+
+# Потоковое сжатие gzip без накопления всего ответа в памяти
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Генератор тела ответа для /export
+def export_stream(resolution, start_ms, stop_ms, meters, fmt, compress=False):
+    chunks = iter_encoded(iter_batches(resolution, start_ms, stop_ms, meters), export_columns(resolution), fmt)
+    if compress:
+        return iter_gzip(chunks)
+    return (chunk.encode("utf-8") for chunk in chunks)
@@ -0,0 +1,446 @@
+import argparse
+import csv
+import gzip
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+from database import initialize_database, execute_query, run_in_writer, count_rows
+from cleanup import retention_cutoff
+from energy import calculate_difference
+from rollups import rollup_table, bucket_start
+from meters import REGISTRY, meter_profile
+from profiles import get_profile
+from timeutils import local_iso_to_epoch_ms
+from log import log_message, flush_logs
+from config import IMPORT_BATCH_SIZE, ROLLUP_RESOLUTIONS, RETENTION_POLICY, POLL_INTERVAL
+
+# Импорт истории счетчиков из CSV/NDJSON (команда pmp-import) и воспроизведение записанных
+# показаний через живой конвейер опроса.
+#
+# pmp-import load: файл читается потоком, записи копятся пачками по IMPORT_BATCH_SIZE, каждая
+# пачка - одна транзакция потока-писателя (executemany в meter_history и агрегаты, состояние
+# счетчиков в meter_state). В той же транзакции сохраняется позиция в файле и состояние
+# счетчиков энергии (import_checkpoints), поэтому прерванный импорт продолжается с последней
+# записанной пачки и ничего не учитывает дважды. Накопленная энергия восстанавливается по сырым
+# 16-битным значениям так же, как при опросе (calculate_difference).
+# Пока пишется одна пачка, следующая уже разбирается.
+#
+# pmp-import replay: записи группируются в циклы опроса и передаются process_cycle с исходными
+# паузами, ускоренными в N раз: БД, MQTT, снимок и статистика обновляются как при живом опросе
+# (с текущим временем). Одновременно с pmp-poller не запускается.
+#
+# Колонки: meter_id, ts (мс Unix) или timestamp (ISO, без смещения - местное время) и поля
+# профиля счетчика без учета регистра (energy, power, voltage, ...). Выгрузка /export?resolution=raw
+# читается как есть, ее energy_total пересчитывается заново.
+
+FORMATS = ("csv", "ndjson")
+
+_HISTORY_INSERT = """
+    INSERT OR REPLACE INTO meter_history (meter_id, ts, energy, power, energy_total)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Как update_rollups, но строка импорта уже содержит сумму многих выборок интервала
+_ROLLUP_UPSERT = """
+    INSERT INTO {table} (meter_id, bucket, samples, power_min, power_max, power_sum, energy, energy_total)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(meter_id, bucket) DO UPDATE SET
+        samples = samples + excluded.samples,
+        power_min = coalesce(min(power_min, excluded.power_min), excluded.power_min, power_min),
+        power_max = coalesce(max(power_max, excluded.power_max), excluded.power_max, power_max),
+        power_sum = coalesce(power_sum + excluded.power_sum, excluded.power_sum, power_sum),
+        energy = energy + excluded.energy,
+        energy_total = coalesce(max(energy_total, excluded.energy_total), excluded.energy_total, energy_total)
+"""
+
+# Состояние счетчика меняется, только если импорт новее его (история в прошлое его не трогает)
+_STATE_UPSERT = """
+    INSERT INTO meter_state (meter_id, raw, total, ts)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(meter_id) DO UPDATE SET
+        raw = excluded.raw,
+        total = excluded.total,
+        ts = excluded.ts
+    WHERE meter_state.ts IS NULL OR excluded.ts > meter_state.ts
+"""
+
+_CHECKPOINT_UPSERT = """
+    INSERT OR REPLACE INTO import_checkpoints (source, size, mtime, records, state, done, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+# Колонка файла -> (поле записи, преобразование). Поля профилей - без учета регистра
+def _known_columns():
+    columns = {"meter_id": ("meter_id", str), "ts": ("ts", _int), "timestamp": ("timestamp", str)}
+    for meter in REGISTRY.values():
+        for field, (offset, dtype, scale, digits) in get_profile(meter.profile).fields.items():
+            columns.setdefault(field.lower(), (field, _int if scale == 1 and digits is None else float))
+    return columns
+
+
+_COLUMNS = _known_columns()
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    raise ValueError(f"{path}: формат не определяется по расширению, укажите --format")
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+# Колонки записи, которые есть в файле: [(колонка, поле записи, преобразование), ...].
+# Время берется из ts, если такая колонка есть, иначе из timestamp
+def _plan(names):
+    plan = [(name, *_COLUMNS[name.strip().lower()]) for name in names if name.strip().lower() in _COLUMNS]
+    if any(field == "ts" for name, field, convert in plan):
+        plan = [column for column in plan if column[1] != "timestamp"]
+    return plan
+
+
+def _record(values, plan, meter):
+    record = {field: convert(values[key]) for key, field, convert in plan
+              if values[key] != "" and values[key] is not None}
+    if "timestamp" in record:
+        record["ts"] = local_iso_to_epoch_ms(record.pop("timestamp"))
+    if meter is not None:
+        record.setdefault("meter_id", meter)
+    return record
+
+
+# Записи файла по порядку: {"meter_id", "ts", поле профиля: значение} или None для
+# неразборчивой строки (учитывается в позиции импорта наравне с остальными).
+# meter - счетчик для файлов без колонки meter_id
+def iter_records(path, fmt=None, meter=None):
+    fmt = fmt or detect_format(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    with _open(path) as f:
+        if fmt == "csv":
+            reader = csv.reader(f)
+            header = next(reader, None)
+            # Колонки CSV сопоставляются полям один раз, по заголовку
+            plan = [(header.index(name), field, convert) for name, field, convert in _plan(header or [])]
+            for row in reader:
+                try:
+                    yield _record(row, plan, meter)
+                except (IndexError, TypeError, ValueError):
+                    yield None
+        else:
+            plans = {}
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    values = json.loads(line)
+                    keys = tuple(values)
+                    plan = plans.get(keys)
+                    if plan is None:
+                        plan = _plan(keys)
+                        if len(plans) < 100:
+                            plans[keys] = plan
+                    yield _record(values, plan, meter)
+                except (AttributeError, TypeError, ValueError):
+                    yield None
+
+
+# Значения агрегата с None для интервалов без данных
+def _nullable(values, missing):
+    return [None if absent else value for value, absent in zip(values.tolist(), missing.tolist())]
+
+
+class Importer:
+    def __init__(self, source, fmt=None, meter=None, batch_size=IMPORT_BATCH_SIZE, backfill=False):
+        self.path = source
+        self.backfill = backfill
+        self.source = os.path.abspath(source)
+        self.fmt = fmt or detect_format(source)
+        self.meter = meter
+        self.batch_size = batch_size
+        stat = os.stat(source)
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        self.counters = {"records": 0, "imported": 0, "invalid": 0, "unknown_meter": 0, "out_of_order": 0}
+        self.state = {}  # meter_id -> [сырое значение, накопленная энергия, ts] после последней записи
+        self.skip = 0
+        self._existing = {}
+        # Строки старше срока хранения таблицы все равно удалит очистка: их не записываем
+        self._history_cutoff = self._cutoff("meter_history")
+        self._rollups = [(resolution, seconds, self._cutoff(rollup_table(resolution)))
+                         for resolution, seconds in ROLLUP_RESOLUTIONS.items()]
+
+    @staticmethod
+    def _cutoff(table):
+        policy = RETENTION_POLICY.get(table)
+        return retention_cutoff(policy) if policy and policy["format"] == "epoch_ms" else None
+
+    # Продолжение прерванного импорта. False - файл уже импортирован целиком
+    def load_checkpoint(self, restart=False):
+        row = execute_query("SELECT size, mtime, records, state, done FROM import_checkpoints WHERE source = ?",
+                            (self.source,), fetchone=True)
+        if row is not None and not restart:
+            size, mtime, records, state, done = row
+            if (size, mtime) != (self.size, self.mtime):
+                raise ValueError(f"{self.path}: файл изменился после прерванного импорта "
+                                 f"({records} записей учтено); --restart начнет импорт заново")
+            if done:
+                return False
+            self.skip = self.counters["records"] = records
+            self.state = json.loads(state)
+        self._existing = {meter_id: (raw, total, ts) for meter_id, raw, total, ts in
+                          execute_query("SELECT meter_id, raw, total, ts FROM meter_state") or []}
+        return True
+
+    # Начальное состояние счетчика: продолжение meter_state, если импорт новее него, для нового
+    # счетчика - отсчет с нуля. Для истории в прошлое отправной точки нет: накопленная энергия
+    # импорта начнется с нуля и не совпадет с уже записанной, поэтому такой импорт выполняется
+    # только с backfill (--backfill). Без него - ошибка; записанные пачки сохранены, повторный
+    # запуск с --backfill продолжит с них
+    def _start(self, meter_id, ts):
+        existing = self._existing.get(meter_id)
+        if existing is not None and existing[2] is not None and ts > existing[2]:
+            return [existing[0], existing[1], existing[2]]
+        if existing is not None:
+            if not self.backfill:
+                message = (f"Импорт {self.path}: записи счетчика {meter_id} старше его текущего состояния, "
+                           f"накопленная энергия импорта отсчитывалась бы от нуля (--backfill - импортировать так)")
+                log_message(message, force=True)
+                raise ValueError(message)
+            log_message(f"Импорт {self.path}: записи счетчика {meter_id} старше его текущего состояния, "
+                        f"накопленная энергия импорта отсчитывается от нуля", force=True)
+        return [0, 0, -1]
+
+    def run(self):
+        started = time.monotonic()
+        pending = None
+        rows = []
+        batch = 0
+        records = itertools.islice(iter_records(self.path, self.fmt, self.meter), self.skip, None)
+        for record in records:
+            self.counters["records"] += 1
+            batch += 1
+            self._add(record, rows)
+            if batch >= self.batch_size:
+                # Следующая пачка разбирается, пока пишется эта
+                if pending is not None:
+                    pending.result()
+                pending = self._write(rows, False)
+                rows = []
+                batch = 0
+                elapsed = time.monotonic() - started
+                print(f"{self.path}: {self.counters['records']} записей, "
+                      f"{(self.counters['records'] - self.skip) / max(elapsed, 1e-9):.0f} записей/с")
+        if pending is not None:
+            pending.result()
+        self._write(rows, True).result()
+        return time.monotonic() - started
+
+    # Учет записи: выборка (meter_id, ts, сырое значение, мощность, накопленная энергия, прирост) в rows
+    def _add(self, record, rows):
+        if record is None:
+            self.counters["invalid"] += 1
+            return
+        meter_id = record.get("meter_id")
+        if meter_id not in REGISTRY:
+            self.counters["unknown_meter"] += 1
+            return
+        profile = meter_profile(meter_id)
+        ts, raw, power = record.get("ts"), record.get(profile.energy_field), record.get(profile.power_field)
+        # Мощность может отсутствовать (выгрузка перенесенной из historical_data истории): выборка
+        # пишется с NULL и не входит в агрегаты мощности
+        if ts is None or raw is None or raw < 0 or raw > 65535:
+            self.counters["invalid"] += 1
+            return
+        state = self.state.get(meter_id)
+        if state is None:
+            state = self.state[meter_id] = self._start(meter_id, ts)
+        if ts <= state[2]:
+            self.counters["out_of_order"] += 1
+            return
+
+        # Тот же расчет, что в update_meter_state: первая выборка только запоминает сырое значение
+        difference = 0 if state[0] == state[1] == 0 else calculate_difference(raw, state[0])
+        state[0], state[1], state[2] = raw, state[1] + difference, ts
+        self.counters["imported"] += 1
+        rows.append((meter_id, ts, raw, power, int(state[1]), difference))
+
+    # Строки агрегатов пачки: выборки сортируются по (счетчик, интервал), значения интервалов
+    # считаются векторно по границам групп
+    def _rollup_rows(self, rows):
+        result = {}
+        if not rows:
+            return result
+        meters = sorted({row[0] for row in rows})
+        index = {meter_id: code for code, meter_id in enumerate(meters)}
+        codes = np.array([index[row[0]] for row in rows])
+        ts, total, difference = (np.array([row[index] for row in rows]) for index in (1, 4, 5))
+        power = np.array([np.nan if row[3] is None else row[3] for row in rows], dtype=float)
+        for resolution, seconds, cutoff in self._rollups:
+            keep = slice(None) if cutoff is None else ts >= cutoff
+            buckets, group_codes = bucket_start(ts[keep], seconds), codes[keep]
+            if len(buckets) == 0:
+                continue
+            order = np.lexsort((buckets, group_codes))
+            buckets, group_codes = buckets[order], group_codes[order]
+            starts = np.concatenate(([0], np.flatnonzero((np.diff(buckets) != 0) | (np.diff(group_codes) != 0)) + 1))
+            column = {"power": power[keep][order], "total": total[keep][order], "difference": difference[keep][order]}
+            # Выборки без мощности (NaN) считаются только в энергии; samples - число выборок с мощностью,
+            # как в update_rollups. Интервал без мощности получает NULL в агрегатах мощности
+            known = ~np.isnan(column["power"])
+            samples = np.add.reduceat(known.astype(np.int64), starts)
+            missing = samples == 0
+            result[resolution] = list(zip(
+                [meters[code] for code in group_codes[starts].tolist()], buckets[starts].tolist(),
+                samples.tolist(),
+                _nullable(np.fmin.reduceat(column["power"], starts), missing),
+                _nullable(np.fmax.reduceat(column["power"], starts), missing),
+                _nullable(np.add.reduceat(np.where(known, column["power"], 0.0), starts), missing),
+                np.add.reduceat(column["difference"], starts).tolist(),
+                np.maximum.reduceat(column["total"], starts).tolist()))
+        return result
+
+    # Запись пачки вместе с позицией импорта одной транзакцией, возвращает Future
+    def _write(self, rows, done):
+        cutoff = self._history_cutoff
+        history = [row[:5] for row in rows if cutoff is None or row[1] >= cutoff]
+        rollup_rows = self._rollup_rows(rows)
+        states = [(meter_id, raw, total, ts) for meter_id, (raw, total, ts) in self.state.items()]
+        checkpoint = (self.source, self.size, self.mtime, self.counters["records"], json.dumps(self.state),
+                      int(done), time.time())
+
+        def run(conn):
+            conn.executemany(_HISTORY_INSERT, history)
+            count_rows("meter_history", "insert", len(history))
+            for resolution, rows in rollup_rows.items():
+                conn.executemany(_ROLLUP_UPSERT.format(table=rollup_table(resolution)), rows)
+                count_rows(rollup_table(resolution), "insert", len(rows))
+            conn.executemany(_STATE_UPSERT, states)
+            conn.execute(_CHECKPOINT_UPSERT, checkpoint)
+        return run_in_writer(run)
+
+
+def load(paths, fmt=None, meter=None, batch_size=IMPORT_BATCH_SIZE, restart=False, backfill=False):
+    for path in paths:
+        importer = Importer(path, fmt, meter, batch_size, backfill)
+        if not importer.load_checkpoint(restart):
+            print(f"{path}: уже импортирован (--restart - импортировать заново)")
+            continue
+        if importer.skip:
+            print(f"{path}: продолжение с записи {importer.skip}")
+        elapsed = importer.run()
+        counters = importer.counters
+        print(f"{path}: {counters['imported']} выборок за {elapsed:.1f} с "
+              f"({(counters['records'] - importer.skip) / max(elapsed, 1e-9):.0f} записей/с); пропущено: "
+              f"неразборчивых {counters['invalid']}, неизвестных счетчиков {counters['unknown_meter']}, "
+              f"не по порядку времени {counters['out_of_order']}")
+
+
+# Записи одного счетчика (по возрастанию времени внутри файла)
+def _meter_records(path, fmt, meter_id, meter):
+    energy_field = meter_profile(meter_id).energy_field
+    for record in iter_records(path, fmt, meter):
+        if record is not None and record.get("meter_id") == meter_id and "ts" in record and energy_field in record:
+            yield record
+
+
+# Циклы опроса из записей файла: (ts, {meter_id: показания}). Выборки счетчиков сливаются по
+# времени (файл /export идет по счетчикам, а не по времени), выборки ближе gap_ms - один цикл
+def iter_cycles(path, fmt=None, meter=None, gap_ms=POLL_INTERVAL * 500):
+    fmt = fmt or detect_format(path)
+    streams = [_meter_records(path, fmt, meter_id, meter) for meter_id in REGISTRY]
+    cycle_ts, readings = None, {}
+    for record in heapq.merge(*streams, key=lambda record: record["ts"]):
+        meter_id = record["meter_id"]
+        if readings and (record["ts"] - cycle_ts >= gap_ms or meter_id in readings):
+            yield cycle_ts, readings
+            readings = {}
+        if not readings:
+            cycle_ts = record["ts"]
+        fields = get_profile(REGISTRY[meter_id].profile).fields
+        readings[meter_id] = {field: record.get(field, 0) for field in fields}
+    if readings:
+        yield cycle_ts, readings
+
+
+# Воспроизведение файла через конвейер опроса с ускорением speed (0 - без пауз)
+def replay(path, fmt=None, meter=None, speed=1.0):
+    # Модули живого конвейера (MQTT, снимок, статистика) нужны только для воспроизведения
+    from poller import process_cycle
+    from mqtt_handler import connect_mqtt
+    from log import keep_recent_logs
+
+    keep_recent_logs()
+    connect_mqtt()
+    log_message(f"Воспроизведение {path} (ускорение {speed or 'без пауз'})", force=True)
+    started = time.monotonic()
+    first = None
+    cycles = 0
+    for ts, readings in iter_cycles(path, fmt, meter):
+        if first is None:
+            first = ts
+        if speed > 0:
+            delay = started + (ts - first) / 1000 / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        process_cycle(readings)
+        cycles += 1
+    log_message(f"Воспроизведение {path} завершено: {cycles} циклов", force=True)
+    print(f"{path}: {cycles} циклов за {time.monotonic() - started:.1f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт истории счетчиков из CSV/NDJSON (в том числе "
+                                                 "выгрузок /export) и воспроизведение записанных показаний")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load_parser = commands.add_parser("load", help="Импорт в meter_history, агрегаты и meter_state")
+    load_parser.add_argument("files", nargs="+", help="Файлы .csv, .ndjson (можно .gz)")
+    load_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Записей в транзакции")
+    load_parser.add_argument("--restart", action="store_true",
+                             help="Начать заново, не продолжая сохраненную позицию (агрегаты уже "
+                                  "импортированной части учтутся повторно)")
+    load_parser.add_argument("--backfill", action="store_true",
+                             help="Импортировать историю старше текущего состояния счетчика (накопленная "
+                                  "энергия таких записей отсчитывается от нуля)")
+    replay_parser = commands.add_parser("replay", help="Передать записанные показания в конвейер опроса "
+                                                       "(не запускать вместе с pmp-poller)")
+    replay_parser.add_argument("file")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Ускорение времени (0 - без пауз)")
+    for command in (load_parser, replay_parser):
+        command.add_argument("--format", choices=FORMATS, help="Формат, если не определяется по расширению")
+        command.add_argument("--meter", help="Счетчик для файлов без колонки meter_id")
+    args = parser.parse_args()
+
+    initialize_database()
+    try:
+        if args.command == "load":
+            load(args.files, args.format, args.meter, args.batch_size, args.restart, args.backfill)
+        else:
+            replay(args.file, args.format, args.meter, args.speed)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        parser.exit(1, f"Ошибка: {e}\n")
+    except KeyboardInterrupt:
+        parser.exit(130, "Прервано, повторный запуск продолжит импорт с последней записанной пачки\n")
+    finally:
+        flush_logs()
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,9 @@ if [ -f "pyproject.toml" ]; then
 
     uv pip install -e .
 
+    # Сборка статических ресурсов (наборы CSS/JS с хешем в имени и сжатые варианты)
+    uv run pmp-build-assets
+
 else
     echo "Ошибка: файл pyproject.toml не найден в $PROJECT_DIR"
     exit 1
@@ -64,10 +67,20 @@ if ! id pmp &>/dev/null; then
     useradd -rs /bin/false pmp
 fi
 
-# Systemd сервис
-cat > /etc/systemd/system/pmp.service <<EOF
+# Systemd сервисы: процесс опроса (единственный, владеет шиной Modbus, записью в БД и MQTT)
+# и веб-интерфейс под gunicorn (только чтение, число воркеров - по числу ядер)
+WEB_WORKERS=$(nproc)
+WEB_THREADS=8  # Потоки воркера: соединение /stream занимает поток все время работы панели
+
+# Сервис прежних версий запускал опрос и веб-интерфейс одним процессом
+if [ -f /etc/systemd/system/pmp.service ]; then
+    systemctl disable --now pmp.service || true
+    rm -f /etc/systemd/system/pmp.service
+fi
+
+cat > /etc/systemd/system/pmp-poller.service <<EOF
 [Unit]
-Description=PMP Service
+Description=PMP Poller
 After=network.target
 
 [Service]
@@ -77,7 +90,7 @@ WorkingDirectory=/usr/bin/pmp
 Environment="PATH=/root/.local/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
 Environment="PYTHONPATH=/usr/bin/pmp"
 Environment="HOME=/root"
-ExecStart=/root/.local/bin/uv run /usr/bin/pmp/app.py
+ExecStart=/root/.local/bin/uv run pmp-poller
 Restart=always
 RestartSec=5
 
@@ -85,20 +98,41 @@ RestartSec=5
 WantedBy=multi-user.target
 EOF
 
-# Запуск сервиса
+cat > /etc/systemd/system/pmp-web.service <<EOF
+[Unit]
+Description=PMP Web
+After=network.target pmp-poller.service
+Wants=pmp-poller.service
+
+[Service]
+User=root
+Group=root
+WorkingDirectory=/usr/bin/pmp
+Environment="PATH=/root/.local/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+Environment="PYTHONPATH=/usr/bin/pmp"
+Environment="HOME=/root"
+ExecStart=/root/.local/bin/uv run gunicorn -k gthread -w ${WEB_WORKERS} --threads ${WEB_THREADS} -b 0.0.0.0:5000 app:app
+Restart=always
+RestartSec=5
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# Запуск сервисов
 systemctl daemon-reload
-systemctl enable pmp.service
-systemctl start pmp.service
+systemctl enable pmp-poller.service pmp-web.service
+systemctl start pmp-poller.service pmp-web.service
 
 # Проверка
 echo "Установка завершена"
-systemctl status pmp.service --no-pager
+systemctl status pmp-poller.service pmp-web.service --no-pager
 
-# После успешного запуска сервиса
-if systemctl is-active --quiet pmp.service; then
+# После успешного запуска сервисов
+if systemctl is-active --quiet pmp-poller.service && systemctl is-active --quiet pmp-web.service; then
     echo "Удаление временных файлов..."
     rm -rf "/tmp/${PMP_VERSION}" "/tmp/pmp.tar.gz"
 else
-    echo "Ошибка: сервис не запущен. Проверьте журналы: journalctl -u pmp.service -b"
+    echo "Ошибка: сервисы не запущены. Проверьте журналы: journalctl -u pmp-poller.service -u pmp-web.service -b"
     exit 1
-fi
\ No newline at end of file
+fi
@@ -1,22 +1,146 @@
-from datetime import datetime
-from database import execute_query
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from database import execute_query, run_in_writer, count_rows, get_logging_state, set_logging_state
+from timeutils import get_log_timestamp
+from metrics import Callback
+from config import LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_RING_SIZE, LOGGING_STATE_TTL
 
+# Единый журнал событий проекта.
+# Флаг "логирование включено" хранится в памяти и перечитывается из БД по истечении
+# LOGGING_STATE_TTL (его может переключить другой процесс).
+# Сообщения попадают в кольцевой буфер (для /logs и строк журнала в снимке) и в ограниченную
+# очередь, которую фоновый поток записывает в БД пачками. Буфер отвечает на /logs только там,
+# где в нем все сообщения - в процессе опроса (см. keep_recent_logs), то есть при запуске
+# app.py одним процессом. Веб-процессы WSGI-сервера видят лишь свои сообщения и читают /logs из БД.
 
-def log_message(message: str):
+_enabled = None
+_enabled_at = 0.0
+_ring_complete = False
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_ring = deque(maxlen=LOG_RING_SIZE)  # (seq, timestamp, message)
+_ring_lock = threading.Lock()
+_seq = itertools.count(1)
+_flusher = None
+_flusher_lock = threading.Lock()
+dropped_messages = 0
+
+Callback("log_dropped_messages_total", "Сообщения журнала, отброшенные из-за переполнения очереди",
+         lambda: dropped_messages, kind="counter")
+Callback("log_queue", "Сообщений журнала, ожидающих записи в БД", _queue.qsize)
+
+
+# Состояние логирования из кэша (БД читается при первом обращении и раз в LOGGING_STATE_TTL)
+def is_logging_enabled():
+    global _enabled, _enabled_at
+    now = time.monotonic()
+    if _enabled is None or now - _enabled_at > LOGGING_STATE_TTL:
+        _enabled = bool(get_logging_state())
+        _enabled_at = now
+    return _enabled
+
+
+# Включение/выключение логирования с записью в БД и обновлением кэша
+def set_logging_enabled(enabled):
+    global _enabled, _enabled_at
+    set_logging_state(enabled)
+    _enabled = bool(enabled)
+    _enabled_at = time.monotonic()
+
+
+# Кольцевой буфер содержит все сообщения журнала (вызывается процессом опроса)
+def keep_recent_logs():
+    global _ring_complete
+    _ring_complete = True
+
+
+def log_message(message: str, force=False):
     """
-    Записывает сообщение в таблицу logs базы данных, если логирование включено в настройках.
+    Записывает сообщение в журнал, если логирование включено в настройках.
 
     :param message: Текст сообщения для логирования
+    :param force: Записать сообщение даже при выключенном логировании
     """
+    global dropped_messages
+    if not force and not is_logging_enabled():
+        return
+
+    timestamp = get_log_timestamp()
+    with _ring_lock:
+        _ring.append((next(_seq), timestamp, message))
     try:
-        # Проверяем, включено ли логирование в настройках
-        query = "SELECT logging_enabled FROM settings WHERE id = 1"
-        result = execute_query(query, fetchone=True)
-
-        if result and result[0]:  # Если логирование включено
-            # Вставляем сообщение в таблицу logs
-            insert_query = "INSERT INTO logs (timestamp, message) VALUES (?, ?)"
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            execute_query(insert_query, (timestamp, message))
-    except Exception as e:
-        print(f"Ошибка при записи лога: {e}")
\ No newline at end of file
+        _queue.put_nowait((timestamp, message))
+    except queue.Full:
+        # БД не успевает: теряем сообщение, но не блокируем горячий путь
+        dropped_messages += 1
+    _ensure_flusher()
+
+
+# Фоновая запись очереди в БД пачками
+def _flush_loop():
+    while True:
+        try:
+            batch = [_queue.get(timeout=LOG_FLUSH_INTERVAL)]
+        except queue.Empty:
+            continue
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            run_in_writer(lambda conn: conn.executemany(
+                "INSERT INTO logs (timestamp, message) VALUES (?, ?)", batch)).result()
+            count_rows("logs", "insert", len(batch))
+        except Exception as e:
+            print(f"Ошибка при записи лога: {e}")
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_loop, name="log-flusher", daemon=True)
+            _flusher.start()
+
+
+# Ожидание записи всех накопленных сообщений в БД
+def flush_logs():
+    if _flusher is not None and _flusher.is_alive():
+        _queue.join()
+
+
+# Последние limit сообщений (новые первыми): из памяти в процессе опроса, если их там достаточно,
+# иначе (и всегда в веб-процессах) - из БД
+def recent_logs(limit):
+    with _ring_lock:
+        if _ring_complete and limit <= len(_ring):
+            entries = list(itertools.islice(reversed(_ring), limit))
+            return [{"timestamp": timestamp, "message": message} for _, timestamp, message in entries]
+    flush_logs()
+    rows = execute_query("SELECT timestamp, message FROM logs ORDER BY timestamp DESC, rowid DESC LIMIT ?", (limit,)) or []
+    return [{"timestamp": row[0], "message": row[1]} for row in rows]
+
+
+# Сообщения, появившиеся после номера seq (не больше limit последних)
+def logs_since(seq, limit=None):
+    with _ring_lock:
+        entries = [entry for entry in _ring if entry[0] > seq]
+    if limit is not None:
+        entries = entries[-limit:]
+    return [{"seq": s, "timestamp": timestamp, "message": message} for s, timestamp, message in entries]
+
+
+# Очистка журнала в памяти и в БД
+def clear_logs():
+    flush_logs()
+    with _ring_lock:
+        _ring.clear()
+    execute_query("DELETE FROM logs")
@@ -0,0 +1,64 @@
+from collections import namedtuple
+from config import MODBUS_GATEWAYS, METERS, MODBUS_PORT, MQTT_TOPICS, MQTT_BASE_TOPIC, DEFAULT_METER_PROFILE
+from profiles import PROFILES, get_profile
+
+# Реестр счетчиков, собранный из MODBUS_GATEWAYS и METERS (config.py).
+# Остальные модули не знают, сколько счетчиков и шлюзов настроено, и работают только с реестром.
+Meter = namedtuple("Meter", ["id", "name", "gateway", "host", "port", "unit_id", "header_class", "profile"])
+
+
+# Проверка конфигурации и сборка реестра (порядок счетчиков из METERS сохраняется)
+def load_registry(gateways=MODBUS_GATEWAYS, meters=METERS):
+    registry = {}
+    addresses = {}
+    for meter_id, config in meters.items():
+        gateway_name = config["gateway"]
+        if gateway_name not in gateways:
+            raise ValueError(f"Счетчик {meter_id}: неизвестный шлюз {gateway_name}")
+        profile = config.get("profile", DEFAULT_METER_PROFILE)
+        if profile not in PROFILES:
+            raise ValueError(f"Счетчик {meter_id}: неизвестный профиль {profile}")
+        address = (gateway_name, config["unit_id"])
+        if address in addresses:
+            raise ValueError(f"Счетчик {meter_id}: адрес {config['unit_id']} на шлюзе {gateway_name} "
+                             f"уже занят счетчиком {addresses[address]}")
+        addresses[address] = meter_id
+        gateway = gateways[gateway_name]
+        registry[meter_id] = Meter(meter_id, config.get("name", meter_id), gateway_name, gateway["host"],
+                                   gateway.get("port", MODBUS_PORT), config["unit_id"],
+                                   config.get("header_class", ""), profile)
+    return registry
+
+
+REGISTRY = load_registry()
+
+
+def meter_ids(registry=REGISTRY):
+    return list(registry)
+
+
+# Счетчики, сгруппированные по шлюзам: {имя шлюза: [Meter, ...]}
+def meters_by_gateway(registry=REGISTRY):
+    grouped = {}
+    for meter in registry.values():
+        grouped.setdefault(meter.gateway, []).append(meter)
+    return grouped
+
+
+# Описание счетчиков для шаблонов и /meters
+def meters_info(registry=REGISTRY):
+    return [{"id": meter.id, "name": meter.name, "gateway": meter.gateway, "host": meter.host,
+             "port": meter.port, "unit_id": meter.unit_id, "header_class": meter.header_class,
+             "profile": meter.profile}
+            for meter in registry.values()]
+
+
+# Профиль счетчика (для id, которого нет в реестре, например из старого снимка, - профиль по умолчанию)
+def meter_profile(meter_id, registry=REGISTRY):
+    meter = registry.get(meter_id)
+    return get_profile(meter.profile if meter else DEFAULT_METER_PROFILE)
+
+
+# Топик полного набора показаний счетчика
+def meter_topic(meter_id):
+    return MQTT_TOPICS.get(f"Full_data_{meter_id}", f"{MQTT_BASE_TOPIC}/Full_data_{meter_id}")
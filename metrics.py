@@ -0,0 +1,201 @@
+import threading
+from bisect import bisect_left
+from config import METRICS_PREFIX, METRICS_LATENCY_BUCKETS
+
+# Встроенные метрики в текстовом формате Prometheus (отдаются на /metrics).
+# Горячие пути только увеличивают числа под короткой блокировкой: без выделения памяти
+# после первого обращения к набору меток и без форматирования строк. Текст собирается
+# только при чтении /metrics. Значения, которые уже хранит другой модуль (счетчики MQTT,
+# возраст снимка, длина очереди записи), не дублируются, а читаются функцией при сборе.
+
+_metrics = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Общая часть метрик: имя, описание, имена меток и значения по наборам меток
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"Метрика {self.name}: ожидались метки {self.label_names}")
+            with self._lock:
+                child = self._children.setdefault(tuple(str(value) for value in values), self._new_child())
+                self._children[values] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    # Наборы меток без дублей (labels() кэширует и исходные, и строковые значения)
+    def _samples(self):
+        with self._lock:
+            items = list(self._children.items())
+        seen = set()
+        for values, child in items:
+            if id(child) not in seen:
+                seen.add(id(child))
+                yield tuple(str(value) for value in values), child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._samples(), key=lambda item: item[0]):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+# Монотонно растущий счетчик
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}"
+
+
+# Текущее значение
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Buckets:
+    __slots__ = ("counts", "sum", "count", "lock")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+
+# Гистограмма с фиксированными границами интервалов (по умолчанию - задержки в секундах)
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, description, labels)
+
+    def _new_child(self):
+        return _Buckets(len(self.bounds) + 1)
+
+    def observe(self, value, *labels):
+        child = self.labels(*labels)
+        index = bisect_left(self.bounds, value)
+        with child.lock:
+            child.counts[index] += 1
+            child.sum += value
+            child.count += 1
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        cumulative = 0
+        for bound, bucket in zip(self.bounds + (float("inf"),), counts):
+            cumulative += bucket
+            labels = _format_labels(self.label_names, values, (("le", _format_value(float(bound))),))
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.label_names, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {count}"
+
+
+# Значения, вычисляемые при сборе: func() возвращает число или {кортеж меток: число}
+class Callback(_Metric):
+    def __init__(self, name, description, func, labels=(), kind="gauge"):
+        self.kind = kind
+        self.func = func
+        super().__init__(name, description, labels)
+
+    def _samples(self):
+        values = self.func()
+        if values is None:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if value is not None:
+                yield tuple(str(label) for label in labels), value
+
+    def _render_child(self, values, value):
+        yield f"{self.name}{_format_labels(self.label_names, values)} {_format_value(value)}"
+
+
+# Все метрики в текстовом формате экспозиции Prometheus 0.0.4
+def render():
+    with _registry_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f"# {metric.name}: ошибка сбора: {_escape(e)}")
+    return "\n".join(lines) + "\n"
+
+
+# Метрики горячих путей (модули импортируют их отсюда и только обновляют)
+modbus_request_seconds = Histogram("modbus_request_seconds", "Время ответа Modbus на чтение блока регистров",
+                                   ("host", "unit"))
+modbus_errors = Counter("modbus_errors_total", "Неудачные чтения Modbus (ошибка, таймаут, неполный ответ)",
+                        ("host", "unit"))
+poll_cycle_seconds = Histogram("poll_cycle_seconds", "Длительность цикла опроса (чтение и обработка)")
+poll_lag_seconds = Histogram("poll_lag_seconds", "Отклонение старта цикла опроса от дедлайна")
+poll_missed_deadlines = Counter("poll_missed_deadlines_total", "Пропущенные дедлайны цикла опроса")
+poll_readings = Gauge("poll_readings", "Счетчиков, ответивших в последнем цикле опроса")
+db_query_seconds = Histogram("db_query_seconds", "Время выполнения оператора SQL", ("op",))
+db_write_batch_seconds = Histogram("db_write_batch_seconds", "Время транзакции пачки заданий потока-писателя")
+db_rows = Counter("db_rows_total", "Строки, измененные операторами записи", ("table", "op"))
+stats_events = Counter("stats_events_total", "События правил статистики (срабатывание и снятие)", ("rule", "state"))
@@ -1,60 +1,113 @@
-from pymodbus.client import ModbusTcpClient
+import asyncio
+import time
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException
 from log import log_message
-from config import MODBUS_REGISTER_MAP
-
-
-# # Описание регистров
-# MODBUS_REGISTER_MAP = {
-#     "Voltage": (0, "uint16be", 0.1),  # Напряжение (V)
-#     "CurrentLow": (1, "uint16be", 0.001),  # Ток (A) - младшие 16 бит
-#     "PowerLow": (3, "uint16be", 1),  # Мощность (W) - младшие 16 бит
-#     "EnergyLow": (5, "uint16be", 1),  # Энергия (Wh) - младшие 16 бит
-#     "EnergyHigh": (6, "uint16be", 1),  # Энергия (Wh) - старшие 16 бит
-#     "Frequency": (7, "uint16be", 0.1),  # Частота (Hz)
-#     "PowerFactor": (8, "uint16be", 0.001),  # Коэффициент мощности
-#     "AlarmStatus": (9, "int16be", 1)  # Статус тревоги
-# }
-
-# Чтение данных из Modbus
-def read_modbus_data(host, unit_id):
-    client = ModbusTcpClient(host)
-    if not client.connect():
-        log_message(f"Failed to connect to Modbus host: {host}")
+from profiles import get_profile
+from metrics import modbus_request_seconds, modbus_errors
+from config import (MODBUS_PORT, MODBUS_TIMEOUT, MODBUS_RETRIES, MODBUS_RECONNECT_DELAY_MIN,
+                    MODBUS_RECONNECT_DELAY_MAX, DEFAULT_METER_PROFILE)
+
+
+# Постоянное подключение к шлюзу: один асинхронный клиент на шлюз, общий для всех unit_id.
+# Доступ к шлюзу сериализуется блокировкой, чтобы кадры разных запросов не перемешивались
+# в одном сокете. После сбоя подключения или обрыва связи сокет закрывается, а повторное
+# подключение выполняется с экспоненциально растущей паузой. Собственное переподключение
+# pymodbus выключено (reconnect_delay=0): паузы задает только этот класс. Повторы запроса
+# (retries) тоже: неответивший счетчик не должен держать шину дольше одного таймаута.
+class ModbusConnection:
+    def __init__(self, host, port=MODBUS_PORT, timeout=MODBUS_TIMEOUT, retries=MODBUS_RETRIES,
+                 delay_min=MODBUS_RECONNECT_DELAY_MIN, delay_max=MODBUS_RECONNECT_DELAY_MAX):
+        self.host = host
+        self.port = port
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.lock = asyncio.Lock()
+        self.client = AsyncModbusTcpClient(host, port=port, timeout=timeout, retries=retries, reconnect_delay=0)
+        self._retry_at = 0.0  # Время следующей попытки подключения
+        self._delay = 0.0  # Текущая пауза
+
+    @property
+    def connected(self):
+        return self.client.connected
+
+    # Подключение, если его нет и пауза после сбоя истекла. False - шлюз недоступен.
+    # Вызывать только под блокировкой шлюза
+    async def connect(self):
+        if self.client.connected:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        if await self.client.connect():
+            self._delay = 0.0
+            return True
+        self.mark_failed()
+        log_message(f"Failed to connect to Modbus host: {self.host}")
+        return False
+
+    # Закрывает сокет и назначает следующую попытку подключения
+    def mark_failed(self):
+        self._delay = min(self.delay_max, self._delay * 2) if self._delay else self.delay_min
+        self._retry_at = time.monotonic() + self._delay
+        self.client.close()
+
+    def close(self):
+        self.client.close()
+
+
+# Разбор блоков нескольких счетчиков: [(Meter, registers), ...] -> {meter_id: показания}.
+# Блоки одного профиля разбираются одним вызовом
+def decode_blocks(blocks):
+    grouped = {}
+    for meter, registers in blocks:
+        grouped.setdefault(meter.profile, []).append((meter, registers))
+    readings = {}
+    for profile, items in grouped.items():
+        records = get_profile(profile).decode_many([registers for meter, registers in items])
+        for (meter, registers), data in zip(items, records):
+            readings[meter.id] = data
+    return readings
+
+
+# Проверка ответа: блок регистров или None при ошибке
+def _checked_registers(result, profile):
+    if result is None:
+        return None
+    if result.isError():
+        log_message(f"Modbus error: {result}")
+        return None
+    if len(result.registers) < profile.count:
+        log_message(f"Modbus error: ожидалось {profile.count} регистров, получено {len(result.registers)}")
         return None
+    return result.registers
+
+
+# Время ответа и ошибки чтения блока в метриках (метки - шлюз и адрес устройства)
+def _observe_read(host, unit_id, started, registers):
+    modbus_request_seconds.observe(time.perf_counter() - started, host, unit_id)
+    if registers is None:
+        modbus_errors.labels(host, unit_id).inc()
 
+
+# Чтение блока регистров счетчика через подключение к шлюзу (под его блокировкой).
+# Разбор выполняет вызывающий (см. decode_blocks), чтобы разобрать блоки всего шлюза разом.
+# Нет ответа от одного устройства - сокет остается открытым для остальных на той же шине,
+# обрыв связи - сокет закрывается и следующее подключение ждет паузы
+async def read_registers_async(connection, unit_id, profile=DEFAULT_METER_PROFILE):
+    started = time.perf_counter()
+    registers = None
     try:
-        result = client.read_input_registers(address=0, count=10, slave=unit_id)
-        if result.isError():
-            log_message(f"Modbus error: {result}")
-            return None
-
-        registers = result.registers
-        raw_data = {}
-
-        for key, (offset, dtype, scale) in MODBUS_REGISTER_MAP.items():
-            value = registers[offset]
-            if dtype == "uint16be":
-                raw_data[key] = value
-            elif dtype == "int16be":
-                value = value if value < 32768 else value - 65536
-                raw_data[key] = value
-
-        # Обработка данных
-        data = {
-            "Voltage": round(raw_data["Voltage"] * 0.1, 1),
-            "Current": round(raw_data["CurrentLow"] * 0.001, 1),
-            "Power": round(raw_data["PowerLow"] * 0.0001, 2),
-            "Energy": raw_data["EnergyLow"],
-            "Energy_F": round(((raw_data["EnergyHigh"] << 16) + raw_data["EnergyLow"]) * 0.001, 1),
-            "Frequency": round(raw_data["Frequency"] * 0.1, 1),
-            "PowerFactor": round(raw_data["PowerFactor"] * 0.001, 2),
-            "AlarmStatus": raw_data["AlarmStatus"]
-        }
-
-        log_message(f"Обработанные данные из Modbus {host} (Адрес устройства: {unit_id}): {data}")
-        return data
+        meter_profile = get_profile(profile)
+        result = await connection.client.read_input_registers(
+            address=meter_profile.address, count=meter_profile.count, slave=unit_id)
+        registers = _checked_registers(result, meter_profile)
+    except ConnectionException as e:
+        connection.mark_failed()
+        log_message(f"Exception while reading Modbus registers: {e}")
     except Exception as e:
         log_message(f"Exception while reading Modbus registers: {e}")
-        return None
-    finally:
-        client.close()
\ No newline at end of file
+        if not connection.connected:
+            connection.mark_failed()
+    _observe_read(connection.host, unit_id, started, registers)
+    return registers
+
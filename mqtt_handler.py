@@ -1,43 +1,263 @@
-import sqlite3
+import json
+import os
+import threading
 import time
-from config import (LOGGING_ENABLED, PREVIOUS_ENERGY)
+from collections import deque
 import paho.mqtt.client as mqtt
-from config import MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, SQLITE_DB
+from config import (MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, MQTT_QOS, MQTT_HEARTBEAT_INTERVAL,
+                    MQTT_DEADBANDS, MQTT_DEADBAND_IGNORE, MQTT_OFFLINE_QUEUE_SIZE, MQTT_SPOOL_FILE,
+                    MQTT_SPOOL_MAX_BYTES, MQTT_MAX_QUEUED)
+from log import log_message
+from metrics import Callback
 
 
-# Логирование сообщений
-def log_message(message):
-    if LOGGING_ENABLED:
-        print(f"[LOG] {time.strftime('%Y-%m-%d %H:%M:%S')} - {message}")
-        save_log_to_db(message)
-
-# Сохранение логов в SQLite
-def save_log_to_db(message):
-    conn = sqlite3.connect(SQLITE_DB)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO logs (message) VALUES (?)", (message,))
-    conn.commit()
-    conn.close()
-
 # Инициализация MQTT клиента
-mqtt_client = mqtt.Client()
+mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+mqtt_client.max_queued_messages_set(MQTT_MAX_QUEUED)
+
+
+# Зона нечувствительности для поля или топика: самое длинное подходящее окончание имени
+_deadband_keys = sorted(MQTT_DEADBANDS, key=len, reverse=True)
+
+
+def _deadband(name):
+    for key in _deadband_keys:
+        if name.endswith(key):
+            return MQTT_DEADBANDS[key]
+    return 0
+
+
+# Изменилось ли значение больше, чем на зону нечувствительности
+def _changed(name, new, old):
+    if isinstance(new, (int, float)) and isinstance(old, (int, float)):
+        return abs(new - old) > _deadband(name)
+    return new != old
+
+
+# Конвейер публикации:
+#  - значения, не вышедшие за зону нечувствительности, не публикуются (но не реже MQTT_HEARTBEAT_INTERVAL);
+#  - пока публикация ждет отправки, для топика хранится только самое новое значение;
+#  - пока брокер недоступен, сообщения копятся в ограниченной очереди в памяти,
+#    затем в файле MQTT_SPOOL_FILE ограниченного размера, дальше отбрасываются;
+#  - сообщений, переданных paho и еще не отправленных брокеру, не больше MQTT_MAX_QUEUED,
+#    остальные ждут в той же ограниченной очереди.
+class MqttPublisher:
+    def __init__(self, client):
+        self.client = client
+        self.connected = False
+        self.counters = {"published": 0, "suppressed": 0, "coalesced": 0, "queued_offline": 0,
+                         "spilled": 0, "dropped": 0, "failed": 0}
+        self._last = {}  # topic -> (время публикации, значение)
+        self._pending = {}  # topic -> payload, ожидающие отправки
+        self._offline = deque()
+        self._inflight = 0  # Отправлено, но еще не передано брокеру (см. acknowledge)
+        self._spooled = os.path.exists(MQTT_SPOOL_FILE)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # Разбор payload: словарь для JSON-объектов, число для скаляров
+    @staticmethod
+    def _parse(payload):
+        try:
+            return json.loads(payload)
+        except (TypeError, ValueError):
+            return payload
+
+    # Нужно ли публиковать значение (с учетом зон нечувствительности и heartbeat)
+    def _should_publish(self, topic, value, now):
+        last = self._last.get(topic)
+        if last is None or now - last[0] >= MQTT_HEARTBEAT_INTERVAL:
+            return True
+        old = last[1]
+        if isinstance(value, dict) and isinstance(old, dict):
+            if value.keys() != old.keys():
+                return True
+            return any(_changed(key, value[key], old[key]) for key in value if key not in MQTT_DEADBAND_IGNORE)
+        return _changed(topic.rsplit("/", 1)[-1], value, old)
+
+    def publish(self, topic, payload):
+        now = time.monotonic()
+        value = self._parse(payload)
+        with self._cond:
+            if not self._should_publish(topic, value, now):
+                self.counters["suppressed"] += 1
+                return
+            self._last[topic] = (now, value)
+            if topic in self._pending:
+                self.counters["coalesced"] += 1
+            self._pending[topic] = payload
+            self._cond.notify()
+        self._ensure_sender()
+
+    def set_connected(self, connected):
+        with self._cond:
+            self.connected = connected
+            if not connected:
+                # Неотправленные сообщения qos 0 paho отбрасывает, подтверждений по ним не будет
+                self._inflight = 0
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, offline_queue=len(self._offline), connected=self.connected)
+
+    def _ensure_sender(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._cond:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._send_loop, name="mqtt-publisher", daemon=True)
+                    self._thread.start()
 
-# Подключение к MQTT брокеру
+    # Сообщение в очередь на время недоступности брокера (вызывается под self._cond).
+    # Сверх очереди в памяти - строка в spill: ее пишет в файл _spool уже без блокировки
+    def _enqueue_offline(self, topic, payload, spill):
+        self.counters["queued_offline"] += 1
+        if len(self._offline) < MQTT_OFFLINE_QUEUE_SIZE:
+            self._offline.append((topic, payload))
+            return
+        spill.append(json.dumps({"topic": topic, "payload": payload}, ensure_ascii=False) + "\n")
+
+    # Запись строк в файл вне блокировки: медленный диск не задерживает publish() и цикл опроса.
+    # Файл пишет и читает только поток отправки, поэтому порядок сообщений сохраняется
+    def _spool(self, lines):
+        if not lines:
+            return
+        spilled = 0
+        try:
+            size = os.path.getsize(MQTT_SPOOL_FILE) if os.path.exists(MQTT_SPOOL_FILE) else 0
+            with open(MQTT_SPOOL_FILE, "a", encoding="utf-8") as f:
+                for line in lines:
+                    length = len(line.encode("utf-8"))
+                    if size + length > MQTT_SPOOL_MAX_BYTES:
+                        break
+                    f.write(line)
+                    size += length
+                    spilled += 1
+        except OSError:
+            pass
+        with self._cond:
+            self.counters["spilled"] += spilled
+            self.counters["dropped"] += len(lines) - spilled
+            if spilled:
+                self._spooled = True
+
+    # Сообщения из файла (файл удаляется после чтения; вызывается без блокировки)
+    def _read_spool(self):
+        try:
+            with open(MQTT_SPOOL_FILE, encoding="utf-8") as f:
+                messages = [json.loads(line) for line in f if line.strip()]
+            os.remove(MQTT_SPOOL_FILE)
+        except (OSError, ValueError):
+            return []
+        return [(message["topic"], message["payload"]) for message in messages]
+
+    # Отправка сообщений вне блокировки, чтобы publish() и set_connected() не ждали сети.
+    # Неподтвержденных сообщений не больше MQTT_MAX_QUEUED при любом qos (при qos 0 paho свою
+    # очередь не ограничивает): при достижении предела ждем подтверждений. Пачка уже ограничена
+    # очередью на время недоступности и файлом. Возвращает неотправленный остаток и код ошибки
+    def _send_batch(self, messages):
+        for index, (topic, payload) in enumerate(messages):
+            with self._cond:
+                self._cond.wait_for(lambda: self._inflight < MQTT_MAX_QUEUED or not self.connected)
+                if not self.connected:
+                    return messages[index:], mqtt.MQTT_ERR_NO_CONN
+                self._inflight += 1
+            rc = self.client.publish(topic, payload, qos=MQTT_QOS).rc
+            with self._cond:
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.counters["published"] += 1
+                    continue
+                self._inflight -= 1
+                if rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                    self.counters["failed"] += 1
+            return messages[index:], rc
+        return [], mqtt.MQTT_ERR_SUCCESS
+
+    # Сообщение передано брокеру (qos 0 - записано в сокет, иначе - подтверждено)
+    def acknowledge(self):
+        with self._cond:
+            self._inflight = max(0, self._inflight - 1)
+            self._cond.notify()
+
+    def _send_loop(self):
+        while True:
+            spill = []
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or (self.connected and (self._offline or self._spooled)))
+                pending = list(self._pending.items())
+                self._pending.clear()
+                connected = self.connected
+                if not connected:
+                    for topic, payload in pending:
+                        self._enqueue_offline(topic, payload, spill)
+                else:
+                    backlog = list(self._offline)
+                    self._offline.clear()
+                    spooled, self._spooled = self._spooled, False
+
+            if not connected:
+                self._spool(spill)
+                continue
+            # Сначала накопленное за время недоступности (в порядке поступления), затем новые значения
+            if spooled:
+                backlog += self._read_spool()
+            rest, rc = self._send_batch(backlog + pending)
+            if not rest:
+                continue
+            # Остаток возвращается в ограниченную очередь (очередь отправителя пуста, порядок сохраняется)
+            with self._cond:
+                for topic, payload in rest:
+                    self._enqueue_offline(topic, payload, spill)
+                if rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                    self.connected = False
+            self._spool(spill)
+            if rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                # Очередь paho заполнена: ждем подтверждений отправки
+                with self._cond:
+                    self._cond.wait(0.1)
+
+
+publisher = MqttPublisher(mqtt_client)
+
+Callback("mqtt_messages_total", "Сообщения конвейера публикации MQTT по результату",
+         lambda: {(result,): count for result, count in publisher.stats().items()
+                  if result in publisher.counters}, ("result",), kind="counter")
+Callback("mqtt_offline_queue", "Сообщений MQTT в очереди на время недоступности брокера",
+         lambda: publisher.stats()["offline_queue"])
+Callback("mqtt_connected", "Подключение к брокеру MQTT (1 - есть)", lambda: int(publisher.connected))
+
+
+# Подключение к MQTT брокеру (переподключение выполняет сетевой поток paho)
 def connect_mqtt():
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
+    def on_connect(client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
             log_message("Connected to MQTT Broker!")
+            publisher.set_connected(True)
         else:
-            log_message(f"Failed to connect, return code {rc}")
+            log_message(f"Failed to connect, return code {reason_code}")
+
+    def on_disconnect(client, userdata, flags, reason_code, properties):
+        publisher.set_connected(False)
+        log_message(f"Disconnected from MQTT Broker, reason: {reason_code}")
+
+    def on_publish(client, userdata, mid, reason_code, properties):
+        publisher.acknowledge()
 
     mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.on_publish = on_publish
     try:
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
+        mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT)
     except Exception as e:
         log_message(f"MQTT connection error: {e}")
     mqtt_client.loop_start()
 
 # Публикация данных в MQTT
 def publish_mqtt(topic, payload):
-    mqtt_client.publish(topic, payload)
+    publisher.publish(topic, payload)
+
+
+# Счетчики конвейера публикации
+def mqtt_stats():
+    return publisher.stats()
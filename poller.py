@@ -0,0 +1,178 @@
+import asyncio
+import json
+import threading
+from werkzeug.serving import make_server
+from config import (MQTT_TOPICS, PREVIOUS_ENERGY, SSE_MAX_LOG_LINES, POLLER_METRICS_HOST,
+                    POLLER_METRICS_PORT)
+from database import initialize_database, execute_query, write_batch
+from mqtt_handler import connect_mqtt, publish_mqtt
+from log import log_message, logs_since, keep_recent_logs
+from timeutils import now_ms, get_current_time_utc_plus_3
+from cleanup import retention_manager
+from snapshot import store_snapshot, set_snapshot, get_snapshot
+from scheduler import run_polling
+from rollups import update_rollups
+from samples import sample_store
+from recent import recent_buffer
+from stats import stats_engine
+from meters import meter_ids, meter_topic, meter_profile
+from energy import calculate_difference
+from metrics import render as render_metrics
+
+# Процесс опроса (консольная команда pmp-poller): единственный владелец шины Modbus, записи
+# в БД и публикации в MQTT. Веб-процессы (app.py под WSGI-сервером) только читают БД
+# и последний снимок из таблицы live_state, поэтому их можно запускать в любом количестве.
+
+
+# Сохранение выборки всех ответивших счетчиков одним оператором.
+# totals - накопленная энергия счетчиков после этой выборки (колонка energy_total)
+def save_history(readings, ts=None, totals=None):
+    totals = totals or {}
+    rows = []
+    for meter_id, data in readings.items():
+        profile = meter_profile(meter_id)
+        rows.append((meter_id, data[profile.energy_field], data[profile.power_field], totals.get(meter_id)))
+    if not rows:
+        return
+    ts = ts if ts is not None else now_ms()
+    execute_query(f"""
+        INSERT OR REPLACE INTO meter_history (meter_id, ts, energy, power, energy_total)
+        VALUES {", ".join("(?, ?, ?, ?, ?)" for _ in rows)}
+    """, tuple(value for meter_id, energy, power, total in rows
+               for value in (meter_id, ts, energy, power, None if total is None else int(total))))
+
+
+# Обновление накопленной энергии счетчиков в meter_state.
+# Возвращает накопленные значения всех счетчиков реестра и прирост энергии с прошлой выборки
+def update_meter_state(readings, ts=None):
+    ts = ts if ts is not None else now_ms()
+    state = {meter_id: (raw, total) for meter_id, raw, total in
+             execute_query("SELECT meter_id, raw, total FROM meter_state") or []}
+
+    totals = {meter_id: state[meter_id][1] for meter_id in meter_ids() if meter_id in state}
+    differences = {}
+    for meter_id, data in readings.items():
+        raw = data[meter_profile(meter_id).energy_field]
+        if raw < 0 or raw > 65535:
+            continue  # Если данные невалидны, счетчик пропускаем
+
+        old_raw, old_total = state.get(meter_id, (0, 0))
+        # Первая выборка счетчика только запоминает сырое значение
+        differences[meter_id] = 0 if old_raw == old_total == 0 else calculate_difference(raw, old_raw)
+        totals[meter_id] = old_total + differences[meter_id]
+        execute_query("""
+            INSERT INTO meter_state (meter_id, raw, total, ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(meter_id) DO UPDATE SET
+                raw = excluded.raw,
+                total = excluded.total,
+                ts = excluded.ts
+        """, (meter_id, raw, totals[meter_id], ts))
+
+    total_kWh = round(sum(totals.values()) / 1000, 2)
+    publish_mqtt(MQTT_TOPICS["total_kWh"], str(total_kWh))
+    return totals, differences
+
+
+# Обработка показаний одного цикла опроса и публикация в MQTT
+def process_cycle(readings):
+    global PREVIOUS_ENERGY
+
+    full_data = {}
+    overflow = {}
+
+    total_power = 0.0  # Инициализация переменной для общей мощности
+
+    for meter_id, data in readings.items():
+        profile = meter_profile(meter_id)
+        energy = data[profile.energy_field]
+        total_power += round((data[profile.power_field]), 2)  # Суммируем мощность
+
+        # Полный набор показаний - по полям профиля счетчика
+        publish_mqtt(meter_topic(meter_id), json.dumps(profile.mqtt_payload(meter_id, data)))
+
+        previous_energy = PREVIOUS_ENERGY.get(meter_id, 0)
+        diff_energy = calculate_difference(energy, previous_energy)
+        # Переполнение 16-битного счетчика энергии с прошлого опроса
+        overflow[meter_id] = int(energy < previous_energy)
+        full_data.update({f"{meter_id}_diff_Energy": diff_energy})
+        PREVIOUS_ENERGY[meter_id] = energy
+
+    # Все записи цикла (история, агрегаты и снимок в live_state) выполняются одной транзакцией
+    # потока-писателя; в памяти снимок публикуется после ее фиксации
+    ts = now_ms()
+    with write_batch():
+        totals, differences = update_meter_state(readings, ts)
+        save_history(readings, ts, totals)
+        update_rollups(ts, readings, differences, totals)
+        # Все поля показаний - в сегменты полных выборок (в БД остаются только энергия и мощность)
+        sample_store.append(ts, readings)
+        recent_buffer.append(ts, readings)
+        # Скользящая статистика и правила событий (пороги, перекос фаз) - в памяти, без запросов к БД
+        stats_engine.update(ts, readings, totals)
+
+        # Снимок для веб-интерфейса: эндпоинты чтения больше не опрашивают счетчики
+        # Вместе со снимком передаются новые строки журнала для /stream.
+        # Ключи {id}raw и {id}total сохранены для совместимости с /raw_data и /total_data
+        timestamp = get_current_time_utc_plus_3()
+        raw_data = {f"{meter_id}raw": data[meter_profile(meter_id).energy_field] for meter_id, data in readings.items()}
+        total_data = {f"{meter_id}total": total for meter_id, total in totals.items()}
+        previous = get_snapshot()
+        new_logs = logs_since(previous.log_seq if previous else 0, SSE_MAX_LOG_LINES)
+        log_seq = new_logs[-1]["seq"] if new_logs else (previous.log_seq if previous else 0)
+        snapshot = store_snapshot(readings, dict(raw_data, id=1, timestamp=timestamp),
+                                  dict(total_data, id=1, timestamp=timestamp), timestamp, new_logs, log_seq,
+                                  stats_engine.summary())
+    set_snapshot(snapshot)
+
+    # Признаки переполнения счетчиков в этом цикле
+    overflow_results = {f"{meter_id}_overflow_error": value for meter_id, value in overflow.items()}
+    overflow_results["timestamp"] = get_current_time_utc_plus_3()
+    publish_mqtt(MQTT_TOPICS["overflow_error"], json.dumps(overflow_results))
+
+    # Публикация общей мощности в MQTT
+    publish_mqtt(MQTT_TOPICS["General-W"], str(round(total_power, 2)))
+
+
+# Метрики процесса опроса (время Modbus, цикла, записи в БД, MQTT) на отдельном порту:
+# веб-процессы их не видят
+def _metrics_app(environ, start_response):
+    if environ.get("PATH_INFO") != "/metrics":
+        start_response("404 Not Found", [("Content-Type", "text/plain; charset=utf-8")])
+        return [b"Not Found"]
+    start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")])
+    return [render_metrics().encode("utf-8")]
+
+
+def start_metrics_server(host=POLLER_METRICS_HOST, port=POLLER_METRICS_PORT):
+    if port is None:
+        return None
+    try:
+        server = make_server(host, port, _metrics_app)
+    except OSError as e:
+        log_message(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="poller-metrics", daemon=True).start()
+    return server
+
+
+# Цикл опроса: асинхронный планировщик с фиксированным периодом (POLL_INTERVAL в config.py).
+# БД должна быть уже инициализирована
+def run():
+    keep_recent_logs()
+    connect_mqtt()
+    retention_manager.start()  # Очистка устаревших данных идет по своему расписанию, вне цикла опроса
+    start_metrics_server()
+    asyncio.run(run_polling(process_cycle))
+
+
+def main():
+    initialize_database()  # Проверка и создание базы данных
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
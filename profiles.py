@@ -0,0 +1,147 @@
+import struct
+import numpy as np
+from config import METER_PROFILES, DEFAULT_METER_PROFILE
+
+# Компиляция профилей счетчиков (METER_PROFILES в config.py) в декодеры.
+# Тип, порядок слов и множитель каждого поля разбираются один раз при запуске:
+#  - одиночный блок упаковывается в байты и читается одним заранее собранным Struct;
+#  - пачка блоков многих счетчиков разбирается NumPy по колонкам, одна векторная
+#    операция на поле для всей пачки.
+
+_TYPES = {
+    "u16": ("H", 1),
+    "s16": ("h", 1),
+    "u32": ("I", 2),
+    "s32": ("i", 2)
+}
+
+# Регистры упаковываются в том же порядке байт, что и 32-битные поля: при "little"
+# пара регистров (младшее слово, старшее слово) читается как одно значение "<I"
+_WORD_ORDERS = {
+    "big": ">",
+    "little": "<"
+}
+
+# Меньше стольких блоков векторный разбор не окупает создание массивов
+_VECTOR_MIN_BLOCKS = 32
+
+
+# Колонка значений поля для пачки блоков (массив регистров формы (блоки, count), uint32)
+def _column(array, offset, dtype, word_order):
+    if dtype in ("u16", "s16"):
+        column = array[:, offset]
+    elif word_order == "little":
+        column = array[:, offset] | (array[:, offset + 1] << 16)
+    else:
+        column = (array[:, offset] << 16) | array[:, offset + 1]
+    if dtype == "s16":
+        return column.astype(np.int32) - ((column & 0x8000).astype(np.int32) << 1)
+    if dtype == "s32":
+        return column.view(np.int32)
+    return column
+
+
+class MeterProfile:
+    def __init__(self, name, address, count, word_order, fields, energy_field, power_field, mqtt=None):
+        if word_order not in _WORD_ORDERS:
+            raise ValueError(f"Профиль {name}: неизвестный порядок слов {word_order}")
+        mqtt = mqtt or {}
+        roles = [("energy_field", energy_field), ("power_field", power_field)] + [("mqtt", key) for key in mqtt]
+        for role, field in roles:
+            if field not in fields:
+                raise ValueError(f"Профиль {name}: поле {field} ({role}) не описано в fields")
+        # Переполнение и прирост энергии считаются по 16-битному счетчику (energy.calculate_difference)
+        if fields[energy_field][1:] != ("u16", 1, None):
+            raise ValueError(f"Профиль {name}: поле энергии {energy_field} должно быть u16 без множителя и округления")
+        order = _WORD_ORDERS[word_order]
+        self.name = name
+        self.address = address
+        self.count = count
+        self.word_order = word_order
+        self.field_names = tuple(fields)
+        self.fields = dict(fields)  # Поле -> (смещение, тип, множитель, знаков после запятой)
+        self.energy_field = energy_field  # Накопленная энергия (Вт·ч, младшие 16 бит): история, итоги, переполнение
+        self.power_field = power_field  # Мощность: история, агрегаты, общая мощность
+        self.mqtt_keys = tuple((field, mqtt.get(field, field)) for field in self.field_names)
+        self._block = struct.Struct(f"{order}{count}H")
+
+        for field, (offset, dtype, scale, digits) in fields.items():
+            if dtype not in _TYPES:
+                raise ValueError(f"Профиль {name}: неизвестный тип {dtype} поля {field}")
+            if offset < 0 or offset + _TYPES[dtype][1] > count:
+                raise ValueError(f"Профиль {name}: поле {field} выходит за пределы блока из {count} регистров")
+
+        # Неперекрывающиеся поля читаются одним Struct (промежутки - байты заполнения),
+        # перекрывающиеся (например младшее слово 32-битного значения) - отдельными unpack_from
+        layout, position, main, extra = order, 0, [], []
+        for field in sorted(fields, key=lambda item: fields[item][0]):
+            offset, dtype = fields[field][:2]
+            code, size = _TYPES[dtype]
+            if offset >= position:
+                layout += "x" * (2 * (offset - position)) + code
+                position = offset + size
+                main.append(field)
+            else:
+                extra.append(field)
+        self._main = struct.Struct(layout + "x" * (2 * (count - position)))
+        self._extra = tuple((struct.Struct(order + _TYPES[fields[field][1]][0]).unpack_from, fields[field][0] * 2)
+                            for field in extra)
+
+        # Преобразование значений в порядке полей профиля. Округление как в NumPy
+        # (умножение, округление до четного, деление), чтобы одиночный и пакетный
+        # разбор давали одинаковый результат
+        source = main + extra
+        self._convert = tuple(
+            (field, source.index(field), offset, dtype, None if scale == 1 else scale,
+             None if digits is None else 10 ** digits, digits)
+            for field, (offset, dtype, scale, digits) in fields.items())
+
+    # Полный набор показаний для MQTT: ключи {id счетчика}{суффикс поля} в порядке полей профиля
+    def mqtt_payload(self, meter_id, record):
+        return {f"{meter_id}{suffix}": record[field] for field, suffix in self.mqtt_keys if field in record}
+
+    # Показания одного счетчика из блока регистров
+    def decode(self, registers):
+        buffer = self._block.pack(*registers[:self.count])
+        values = self._main.unpack(buffer)
+        if self._extra:
+            values += tuple(unpack_from(buffer, offset)[0] for unpack_from, offset in self._extra)
+        record = {}
+        for field, index, offset, dtype, scale, factor, digits in self._convert:
+            value = values[index]
+            if scale is not None:
+                value *= scale
+            if factor is not None:
+                value = round(value * factor) / factor
+            record[field] = value
+        return record
+
+    # Показания нескольких счетчиков одним вызовом
+    def decode_many(self, blocks):
+        if len(blocks) < _VECTOR_MIN_BLOCKS:
+            return [self.decode(registers) for registers in blocks]
+
+        array = np.array([registers[:self.count] for registers in blocks], dtype=np.uint32)
+        columns = []
+        for field, index, offset, dtype, scale, factor, digits in self._convert:
+            column = _column(array, offset, dtype, self.word_order)
+            if scale is not None:
+                column = column * scale
+            if digits is not None:
+                column = np.round(column, digits)
+            columns.append(column.tolist())
+        return [dict(zip(self.field_names, values)) for values in zip(*columns)]
+
+
+def compile_profiles(profiles=METER_PROFILES):
+    return {name: MeterProfile(name, **spec) for name, spec in profiles.items()}
+
+
+PROFILES = compile_profiles()
+
+
+def get_profile(name=DEFAULT_METER_PROFILE):
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестный профиль счетчика: {name}") from None
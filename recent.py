@@ -0,0 +1,167 @@
+import math
+import os
+import threading
+import numpy as np
+from meters import REGISTRY
+from profiles import get_profile
+from samples import record_fields
+from config import RECENT_BUFFER_DIR, RECENT_HOURS, POLL_INTERVAL
+
+# Кольцевой буфер недавних показаний для живых графиков (/recent) без обращения к БД.
+# На каждый счетчик - файл фиксированного размера: заголовок (емкость, число записанных
+# выборок) и массив записей той же ширины, что и в samples.py. Процесс опроса пишет выборку
+# в ячейку written % capacity и только потом увеличивает written; веб-процессы отображают
+# тот же файл в память только для чтения и копируют нужное окно.
+# Самая старая ячейка окна может перезаписываться в момент чтения, поэтому читатели видят
+# не больше capacity - 1 последних выборок.
+
+MAGIC = b"PMPRING1"
+_HEADER = np.dtype([("magic", "S8"), ("capacity", "<u8"), ("written", "<u8"), ("itemsize", "<u8"),
+                    ("reserved", "S32")])
+
+
+class RingFile:
+    def __init__(self, path, dtype, capacity, writable=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.writable = writable
+        self._inode = None
+        self.header = None
+        self.records = None
+
+    # Проверка заголовка существующего файла: тот же формат записи и емкость
+    def _compatible(self):
+        try:
+            header = np.fromfile(self.path, dtype=_HEADER, count=1)
+        except (OSError, ValueError):
+            return False
+        return (len(header) == 1 and header["magic"][0] == MAGIC and header["capacity"][0] == self.capacity
+                and header["itemsize"][0] == self.dtype.itemsize
+                and os.path.getsize(self.path) == _HEADER.itemsize + self.capacity * self.dtype.itemsize)
+
+    # Новый файл создается рядом и подменяет старый атомарно: читатели со старым
+    # отображением увидят смену inode и переоткроют файл
+    def _create(self):
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            header = np.zeros(1, dtype=_HEADER)
+            header["magic"], header["capacity"], header["itemsize"] = MAGIC, self.capacity, self.dtype.itemsize
+            f.write(header.tobytes())
+            f.truncate(_HEADER.itemsize + self.capacity * self.dtype.itemsize)
+        os.replace(temporary, self.path)
+
+    # Отображение файла в память; для читателя - повторно, если файл был пересоздан. False, если файла нет
+    def open(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self.records is not None and inode == self._inode:
+            return True
+
+        if self.writable:
+            if inode is None or not self._compatible():
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._create()
+            inode = os.stat(self.path).st_ino
+        elif inode is None or not self._compatible():
+            return False
+
+        mode = "r+" if self.writable else "r"
+        self.header = np.memmap(self.path, dtype=_HEADER, mode=mode, shape=(1,))
+        self.records = np.memmap(self.path, dtype=self.dtype, mode=mode, offset=_HEADER.itemsize,
+                                 shape=(self.capacity,))
+        self._inode = inode
+        return True
+
+    def append(self, record):
+        written = int(self.header["written"][0])
+        self.records[written % self.capacity] = record
+        self.header["written"] = written + 1
+
+    # Выборки с ts >= since_ms в хронологическом порядке (копия)
+    def read(self, since_ms, fields=None):
+        if not self.open():
+            return None
+        written = int(self.header["written"][0])
+        count = min(written, self.capacity - 1)
+        first = (written - count) % self.capacity
+        records = self.records if fields is None else self.records[fields]
+        if first + count <= self.capacity:
+            window = np.array(records[first:first + count])
+        else:
+            window = np.concatenate((records[first:], records[:first + count - self.capacity]))
+        return window[np.searchsorted(window["ts"], since_ms, "left"):]
+
+
+# Прореживание по min/max: выборки делятся на buckets интервалов равной длительности,
+# для каждого непустого интервала - время первой выборки, минимум и максимум каждого поля.
+# Пики, которые потерялись бы при простом прореживании, остаются на графике
+def min_max_buckets(window, names, start_ms, stop_ms, buckets):
+    ts = window["ts"]
+    span = max(1, stop_ms - start_ms)
+    index = np.clip((ts - start_ms) * buckets // span, 0, buckets - 1)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(index)) + 1))
+    result = {"ts": ts[starts].tolist()}
+    for name in names:
+        column = window[name]
+        result[name] = {"min": _values(np.minimum.reduceat(column, starts)),
+                        "max": _values(np.maximum.reduceat(column, starts))}
+    return result
+
+
+def _values(column):
+    if column.dtype.kind == "f":
+        # float32 хранит около 7 значащих цифр, лишние знаки двоичного представления отбрасываются
+        return np.round(column.astype(np.float64), 4).tolist()
+    return column.tolist()
+
+
+class RecentBuffer:
+    def __init__(self, directory=RECENT_BUFFER_DIR, hours=RECENT_HOURS, interval=POLL_INTERVAL, registry=REGISTRY):
+        self.directory = directory
+        self.capacity = math.ceil(hours * 3600 / interval) + 1
+        self.fields = {meter_id: record_fields(get_profile(meter.profile)) for meter_id, meter in registry.items()}
+        self._rings = {}  # (meter_id, writable) -> RingFile
+        self._lock = threading.Lock()
+
+    def _ring(self, meter_id, writable):
+        key = (meter_id, writable)
+        ring = self._rings.get(key)
+        if ring is None:
+            with self._lock:
+                ring = self._rings.get(key)
+                if ring is None:
+                    path = os.path.join(self.directory, f"{meter_id}.ring")
+                    ring = self._rings[key] = RingFile(path, self.fields[meter_id], self.capacity, writable)
+        return ring
+
+    # Запись выборки цикла опроса (вызывает только процесс опроса)
+    def append(self, ts, readings):
+        for meter_id, data in readings.items():
+            fields = self.fields.get(meter_id)
+            if fields is None:
+                continue
+            ring = self._ring(meter_id, True)
+            ring.open()
+            ring.append((ts, *(data.get(name, 0) for name, dtype in fields[1:])))
+
+    # Ряды полей счетчиков за последние window_ms до now_ms. Больше points выборок
+    # прореживаются по min/max (points/2 интервалов, в каждом минимум и максимум)
+    def series(self, meter_ids, names, window_ms, now_ms, points):
+        result = {}
+        for meter_id in meter_ids:
+            available = [name for name, dtype in self.fields[meter_id][1:] if names is None or name in names]
+            window = self._ring(meter_id, False).read(now_ms - window_ms, ["ts"] + available)
+            if window is None or len(window) == 0:
+                result[meter_id] = {"ts": [], **{name: [] for name in available}}
+            elif len(window) <= points:
+                result[meter_id] = {"ts": window["ts"].tolist(), **{name: _values(window[name]) for name in available}}
+            else:
+                result[meter_id] = min_max_buckets(window, available, now_ms - window_ms, now_ms, max(1, points // 2))
+                result[meter_id]["downsampled"] = True
+        return result
+
+
+recent_buffer = RecentBuffer()
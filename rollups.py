@@ -0,0 +1,91 @@
+from database import execute_query
+from config import ROLLUP_RESOLUTIONS, HISTORY_RETENTION_HOURS, HISTORY_TARGET_POINTS, POLL_INTERVAL, UTC_OFFSET_HOURS
+from timeutils import now_ms, epoch_ms_to_local_iso
+from meters import meter_profile
+
+# Агрегаты по счетчикам: минимум, максимум и сумма мощности (для среднего) и прирост энергии
+# за интервал. Каждая выборка обновляет текущий интервал каждой таблицы одним UPSERT,
+# поэтому стоимость записи постоянна, а длинные периоды читаются из небольших таблиц.
+# samples - число выборок с мощностью, по которым посчитаны минимум, максимум и сумма. У интервалов
+# из старых данных без мощности (historical_data) samples = 0 и значения мощности NULL, поэтому
+# объединение берет известное значение, если с другой стороны NULL.
+
+_OFFSET_MS = UTC_OFFSET_HOURS * 3600 * 1000
+
+
+def rollup_table(resolution):
+    return f"rollup_{resolution}"
+
+
+# Начало интервала для метки времени. Границы суток считаются по местному времени (UTC+3)
+def bucket_start(ts, seconds):
+    size = seconds * 1000
+    return (ts + _OFFSET_MS) // size * size - _OFFSET_MS
+
+
+# Инкрементальное обновление всех агрегатов новой выборкой.
+# readings: {id счетчика: показания}, differences: {id счетчика: прирост энергии с прошлой выборки},
+# totals: {id счетчика: накопленная энергия после выборки} - в агрегате хранится значение на конец интервала
+def update_rollups(ts, readings, differences, totals=None):
+    totals = totals or {}
+    for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+        bucket = bucket_start(ts, seconds)
+        for meter_id, data in readings.items():
+            power = data[meter_profile(meter_id).power_field]
+            energy_total = totals.get(meter_id)
+            execute_query(f"""
+                INSERT INTO {rollup_table(resolution)} (meter_id, bucket, samples, power_min, power_max, power_sum,
+                                                        energy, energy_total)
+                VALUES (?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT(meter_id, bucket) DO UPDATE SET
+                    samples = samples + 1,
+                    power_min = coalesce(min(power_min, excluded.power_min), excluded.power_min, power_min),
+                    power_max = coalesce(max(power_max, excluded.power_max), excluded.power_max, power_max),
+                    power_sum = coalesce(power_sum + excluded.power_sum, excluded.power_sum, power_sum),
+                    energy = energy + excluded.energy,
+                    energy_total = coalesce(max(energy_total, excluded.energy_total), excluded.energy_total, energy_total)
+            """, (meter_id, bucket, power, power, power, differences.get(meter_id, 0),
+                  None if energy_total is None else int(energy_total)))
+
+
+# Выбор разрешения: самое подробное, которое дает не больше points точек за окно.
+# Сырые данные используются только если окно целиком в пределах их хранения.
+def select_resolution(start_ms, stop_ms, points=HISTORY_TARGET_POINTS):
+    window = max(0, stop_ms - start_ms)
+    raw_from = now_ms() - HISTORY_RETENTION_HOURS * 3600 * 1000
+    if start_ms >= raw_from and window <= points * POLL_INTERVAL * 1000:
+        return "raw"
+    resolutions = sorted(ROLLUP_RESOLUTIONS.items(), key=lambda item: item[1])
+    for resolution, seconds in resolutions:
+        if window <= points * seconds * 1000:
+            return resolution
+    return resolutions[-1][0]
+
+
+# Агрегаты за период, сгруппированные по интервалам
+def query_rollups(resolution, start_ms, stop_ms, meters):
+    seconds = ROLLUP_RESOLUTIONS[resolution]
+    placeholders = ", ".join("?" for _ in meters)
+    rows = execute_query(f"""
+        SELECT meter_id, bucket, samples, power_min, power_max, power_sum, energy
+        FROM {rollup_table(resolution)}
+        WHERE meter_id IN ({placeholders}) AND bucket BETWEEN ? AND ?
+        ORDER BY bucket ASC
+    """, (*meters, bucket_start(start_ms, seconds), stop_ms)) or []
+
+    buckets = {}
+    for meter_id, bucket, samples, power_min, power_max, power_sum, energy in rows:
+        row = buckets.get(bucket)
+        if row is None:
+            row = buckets[bucket] = {
+                "ts": bucket,
+                "timestamp": epoch_ms_to_local_iso(bucket),
+                "resolution": resolution
+            }
+        row[meter_id] = {
+            "power_min": power_min,
+            "power_max": power_max,
+            "power_avg": round(power_sum / samples, 4) if samples and power_sum is not None else None,
+            "energy": energy
+        }
+    return list(buckets.values())
@@ -0,0 +1,229 @@
+import json
+import os
+import struct
+import threading
+import numpy as np
+from meters import REGISTRY
+from profiles import get_profile
+from config import SAMPLE_STORE_DIR, SAMPLE_SEGMENT_HOURS
+
+# Хранилище полных выборок счетчиков (все поля профиля, а не только энергия).
+# Выборки дописываются в конец файлов-сегментов: каталог на счетчик, файл на период
+# SAMPLE_SEGMENT_HOURS. Запись фиксированной ширины: ts (мс, int64) и поля профиля
+# (float32 для масштабированных значений, целые для сырых счетчиков), для PZEM-016 - 40 байт.
+# Чтение отображает файл в память (np.memmap) и возвращает срезы без копирования,
+# диапазон по времени находится двоичным поиском по колонке ts.
+# Хранение ограничивается удалением сегментов целиком.
+#
+# Файл: MAGIC, длина заголовка (uint32), JSON-заголовок (поля, начало и конец периода),
+# выравнивание до _ALIGN байт, затем записи. Недописанная запись в конце (сбой питания)
+# отбрасывается при чтении и обрезается при следующей записи.
+
+MAGIC = b"PMPSEG1\n"
+_ALIGN = 64
+_LENGTH = struct.Struct("<I")
+_STRUCT_CODES = {"<i8": "q", "<i4": "i", "<u4": "I", "<f4": "f"}
+
+
+# Тип колонки поля: целое для сырых значений без множителя, иначе float32
+def _field_dtype(dtype, scale, digits):
+    if scale == 1 and digits is None:
+        return "<u4" if dtype == "u32" else "<i4"
+    return "<f4"
+
+
+# Колонки записи для профиля счетчика: [(имя, тип numpy), ...]
+def record_fields(profile):
+    return [("ts", "<i8")] + [(field, _field_dtype(dtype, scale, digits))
+                              for field, (offset, dtype, scale, digits) in profile.fields.items()]
+
+
+def _header_bytes(header):
+    body = json.dumps(header).encode("utf-8")
+    size = len(MAGIC) + _LENGTH.size + len(body)
+    return MAGIC + _LENGTH.pack(len(body)) + body + b"\0" * (-size % _ALIGN)
+
+
+# Заголовок сегмента: (словарь заголовка, смещение первой записи)
+def _read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: не файл сегмента")
+        length = _LENGTH.unpack(f.read(_LENGTH.size))[0]
+        header = json.loads(f.read(length))
+    size = len(MAGIC) + _LENGTH.size + length
+    return header, size + (-size % _ALIGN)
+
+
+class SampleStore:
+    def __init__(self, directory=SAMPLE_STORE_DIR, segment_hours=SAMPLE_SEGMENT_HOURS, registry=REGISTRY):
+        self.directory = directory
+        self.segment_ms = int(segment_hours * 3600 * 1000)
+        self.fields = {meter_id: record_fields(get_profile(meter.profile)) for meter_id, meter in registry.items()}
+        self._packers = {meter_id: struct.Struct("<" + "".join(_STRUCT_CODES[dtype] for name, dtype in fields))
+                         for meter_id, fields in self.fields.items()}
+        self._writers = {}  # meter_id -> (конец периода сегмента, открытый файл)
+        self._headers = {}  # путь -> (numpy dtype, смещение записей, начало, конец)
+        self._lock = threading.Lock()
+
+    def _meter_dir(self, meter_id):
+        return os.path.join(self.directory, meter_id)
+
+    # Последний файл периода start: {start}.seg или более поздний {start}_{ts}.seg (после смены профиля)
+    def _latest_segment(self, meter_id, start):
+        prefix = f"{start}_"
+        latest, latest_ts = None, None
+        for name in os.listdir(self._meter_dir(meter_id)):
+            if name == f"{start}.seg":
+                name_ts = -1
+            elif name.startswith(prefix) and name.endswith(".seg"):
+                name_ts = int(name[len(prefix):-len(".seg")])
+            else:
+                continue
+            if latest_ts is None or name_ts > latest_ts:
+                latest, latest_ts = name, name_ts
+        return None if latest is None else os.path.join(self._meter_dir(meter_id), latest)
+
+    # Файл сегмента для записи выборки с меткой ts (открывается или создается при смене периода)
+    def _writer(self, meter_id, ts):
+        end, f = self._writers.get(meter_id, (None, None))
+        if f is not None and ts < end:
+            return f
+        if f is not None:
+            f.close()
+
+        start = ts - ts % self.segment_ms
+        end = start + self.segment_ms
+        fields = self.fields[meter_id]
+        os.makedirs(self._meter_dir(meter_id), exist_ok=True)
+        path = self._latest_segment(meter_id, start)
+        if path is None:
+            path = os.path.join(self._meter_dir(meter_id), f"{start}.seg")
+        else:
+            header, offset = _read_header(path)
+            if [list(field) for field in fields] != header["fields"]:
+                # Профиль счетчика изменился: продолжаем период в новом файле со своим заголовком.
+                # При прежнем профиле (перезапуск опроса) дописывается последний файл периода
+                path = os.path.join(self._meter_dir(meter_id), f"{start}_{ts}.seg")
+        if os.path.exists(path):
+            itemsize = np.dtype(fields).itemsize
+            f = open(path, "r+b")
+            f.truncate(offset + (os.path.getsize(path) - offset) // itemsize * itemsize)
+            f.seek(0, os.SEEK_END)
+        else:
+            f = open(path, "wb")
+            f.write(_header_bytes({"meter": meter_id, "start": start, "end": end,
+                                   "fields": [list(field) for field in fields]}))
+        self._writers[meter_id] = (end, f)
+        return f
+
+    # Дописывание выборки цикла опроса: {meter_id: показания}
+    def append(self, ts, readings):
+        with self._lock:
+            for meter_id, data in readings.items():
+                packer = self._packers.get(meter_id)
+                if packer is None:
+                    continue
+                record = packer.pack(ts, *(data.get(name, 0) for name, dtype in self.fields[meter_id][1:]))
+                f = self._writer(meter_id, ts)
+                f.write(record)
+                f.flush()
+
+    def close(self):
+        with self._lock:
+            for end, f in self._writers.values():
+                f.close()
+            self._writers.clear()
+
+    # Сегменты счетчика по возрастанию начала периода: [(путь, dtype, смещение, начало, конец), ...]
+    def segments(self, meter_id):
+        directory = self._meter_dir(meter_id)
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith(".seg")]
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            path = os.path.join(directory, name)
+            cached = self._headers.get(path)
+            if cached is None:
+                try:
+                    header, offset = _read_header(path)
+                except (OSError, ValueError):
+                    continue
+                cached = self._headers[path] = (np.dtype([tuple(field) for field in header["fields"]]), offset,
+                                                header["start"], header["end"])
+            result.append((path, *cached))
+        return sorted(result, key=lambda segment: (segment[3], segment[0]))
+
+    # Записи сегмента как массив, отображенный в память (только полные записи)
+    @staticmethod
+    def _map(path, dtype, offset):
+        count = (os.path.getsize(path) - offset) // dtype.itemsize
+        if count <= 0:
+            return None
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+    # Записи счетчика в диапазоне [start_ms, stop_ms] срезами сегментов без копирования.
+    # fields - нужные колонки (ts добавляется всегда)
+    def iter_range(self, meter_id, start_ms, stop_ms, fields=None):
+        for path, dtype, offset, start, end in self.segments(meter_id):
+            if end <= start_ms or start > stop_ms:
+                continue
+            try:
+                records = self._map(path, dtype, offset)
+            except (OSError, ValueError):
+                continue  # Сегмент удален очисткой во время чтения
+            if records is None:
+                continue
+            ts = records["ts"]
+            lo = np.searchsorted(ts, start_ms, "left")
+            hi = np.searchsorted(ts, stop_ms, "right")
+            if hi <= lo:
+                continue
+            chunk = records[lo:hi]
+            if fields is not None:
+                chunk = chunk[["ts"] + [name for name in fields if name in dtype.names and name != "ts"]]
+            yield chunk
+
+    # Записи диапазона одним массивом (копия делается, только если диапазон занимает несколько сегментов)
+    def read_range(self, meter_id, start_ms, stop_ms, fields=None):
+        chunks = list(self.iter_range(meter_id, start_ms, stop_ms, fields))
+        if not chunks:
+            return None
+        if len(chunks) == 1:
+            return chunks[0]
+        # Колонки сегментов с разными профилями приводятся к общему набору
+        names = [name for name in chunks[0].dtype.names if all(name in chunk.dtype.names for chunk in chunks)]
+        return np.concatenate([np.asarray(chunk[names]).astype(chunks[0][names].dtype) for chunk in chunks])
+
+    # Удаление сегментов, период которых целиком закончился до cutoff_ms. Возвращает число файлов
+    def drop_before(self, cutoff_ms):
+        dropped = 0
+        try:
+            meters = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for meter_id in meters:
+            for path, dtype, offset, start, end in self.segments(meter_id):
+                if end > cutoff_ms:
+                    break
+                with self._lock:
+                    writer = self._writers.get(meter_id)
+                    if writer is not None and writer[1].name == path:
+                        writer[1].close()
+                        del self._writers[meter_id]
+                    os.remove(path)
+                self._headers.pop(path, None)
+                dropped += 1
+        return dropped
+
+    # Размер хранилища в байтах (для отчетов)
+    def size(self):
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        return total
+
+
+sample_store = SampleStore()
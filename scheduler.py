@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from collections import deque
+from log import log_message
+from modbus_handler import ModbusConnection, read_registers_async, decode_blocks
+from meters import REGISTRY, meters_by_gateway
+from metrics import poll_cycle_seconds, poll_lag_seconds, poll_missed_deadlines, poll_readings
+from config import POLL_INTERVAL
+
+
+# Статистика планировщика: отклонение старта цикла от дедлайна и пропущенные дедлайны
+class PollStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cycles = 0
+        self.missed_deadlines = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.mean_lag = 0.0
+        self.last_duration = 0.0
+        self.recent = deque(maxlen=1000)  # (отклонение старта, длительность) последних циклов для перцентилей
+
+    def record_start(self, lag):
+        with self._lock:
+            self.cycles += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            # Скользящее среднее джиттера без хранения истории
+            self.mean_lag += (lag - self.mean_lag) / min(self.cycles, 100)
+        poll_lag_seconds.observe(lag)
+
+    def record_end(self, duration, missed):
+        with self._lock:
+            self.last_duration = duration
+            self.missed_deadlines += missed
+            self.recent.append((self.last_lag, duration))
+        poll_cycle_seconds.observe(duration)
+        if missed:
+            poll_missed_deadlines.inc(missed)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "cycles": self.cycles,
+                "missed_deadlines": self.missed_deadlines,
+                "last_lag": round(self.last_lag, 4),
+                "max_lag": round(self.max_lag, 4),
+                "mean_lag": round(self.mean_lag, 4),
+                "last_duration": round(self.last_duration, 4)
+            }
+
+
+poll_stats = PollStats()
+
+
+# Один шлюз RS-485/TCP: постоянное подключение с блокировкой шины и паузами переподключения
+# (ModbusConnection). Запросы к unit_id одного шлюза выполняются строго по очереди.
+class Gateway:
+    def __init__(self, name, host, port, meters):
+        self.name = name
+        self.host = host
+        self.meters = meters  # [Meter, ...] в порядке реестра
+        self.connection = ModbusConnection(host, port)
+
+    async def poll(self):
+        blocks = []
+        async with self.connection.lock:
+            if not await self.connection.connect():
+                return {}
+            for meter in self.meters:
+                if not self.connection.connected:
+                    break  # Связь оборвалась: остальные счетчики шлюза - в следующем цикле
+                registers = await read_registers_async(self.connection, meter.unit_id, meter.profile)
+                if registers is not None:
+                    blocks.append((meter, registers))
+
+        # Разбор после освобождения шины: блоки всех счетчиков шлюза одним вызовом на профиль
+        readings = decode_blocks(blocks)
+        for meter, registers in blocks:
+            log_message(f"Обработанные данные из Modbus {self.host} (Адрес устройства: {meter.unit_id}): "
+                        f"{readings[meter.id]}")
+        return readings
+
+    def close(self):
+        self.connection.close()
+
+
+# Шлюзы из реестра счетчиков
+def build_gateways(registry=REGISTRY):
+    return [Gateway(name, meters[0].host, meters[0].port, meters)
+            for name, meters in meters_by_gateway(registry).items()]
+
+
+# Основной цикл опроса с абсолютными дедлайнами.
+# Шлюзы опрашиваются параллельно, поэтому длительность цикла определяется самой
+# загруженной шиной, а не числом шлюзов. Обработка результатов (БД, MQTT) выполняется
+# в отдельном потоке, чтобы не блокировать цикл событий.
+async def run_polling(handle_cycle, interval=POLL_INTERVAL, registry=REGISTRY):
+    loop = asyncio.get_running_loop()
+    gateways = build_gateways(registry)
+    deadline = loop.time()
+    try:
+        while True:
+            started = loop.time()
+            poll_stats.record_start(started - deadline)
+
+            results = await asyncio.gather(*(gateway.poll() for gateway in gateways))
+            readings = {}
+            for gateway_readings in results:
+                readings.update(gateway_readings)
+            # Восстанавливаем порядок счетчиков из реестра
+            readings = {meter_id: readings[meter_id] for meter_id in registry if meter_id in readings}
+            poll_readings.set(len(readings))
+
+            try:
+                await asyncio.to_thread(handle_cycle, readings)
+            except Exception as e:
+                log_message(f"Ошибка обработки цикла опроса: {e}")
+
+            # Следующий дедлайн считается от предыдущего, а не от текущего времени,
+            # поэтому время чтения и обработки не накапливается в период опроса
+            deadline += interval
+            now = loop.time()
+            missed = 0
+            if now > deadline:
+                missed = int((now - deadline) // interval) + 1
+                deadline += missed * interval
+                log_message(f"Цикл опроса не уложился в период {interval} с, пропущено дедлайнов: {missed}")
+            poll_stats.record_end(now - started, missed)
+
+            await asyncio.sleep(deadline - loop.time())
+    finally:
+        for gateway in gateways:
+            gateway.close()
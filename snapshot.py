@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from config import SNAPSHOT_MAX_AGE, LIVE_STATE_REFRESH
+from database import execute_query
+from metrics import Callback
+from meters import meter_profile
+
+# Неизменяемый снимок последних показаний, который публикует поток опроса.
+# Веб-обработчики только читают ссылку на текущий снимок и никогда не обращаются к счетчикам.
+# Снимок также сохраняется в таблицу live_state: из нее его читают веб-процессы, запущенные
+# отдельно от процесса опроса (несколько воркеров WSGI-сервера).
+Snapshot = namedtuple("Snapshot", ["version", "created_at", "timestamp", "phases", "raw", "total", "logs", "log_seq",
+                                   "stats"])
+
+_lock = threading.Lock()
+_published = threading.Condition(_lock)
+_current = None
+_publisher = False  # Снимки публикует этот процесс
+_loaded = (0.0, None)  # (время проверки live_state, снимок) в процессе без опроса
+_payload_cache = (0, None)
+
+
+# Рекурсивная "заморозка" словарей, чтобы снимок нельзя было изменить после публикации
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+# Обратное преобразование в обычные словари для jsonify
+def _thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+# Новый снимок с записью в live_state (вызывается только потоком опроса). Снимок еще не текущий:
+# внутри write_batch запись входит в транзакцию цикла опроса, после ее фиксации снимок
+# публикуется через set_snapshot.
+# logs - новые строки журнала с прошлого снимка, log_seq - номер последней из них,
+# stats - сводка скользящей статистики (stats.py)
+def store_snapshot(phases, raw, total, timestamp, logs=(), log_seq=0, stats=None):
+    # Номера продолжают сохраненный в БД, чтобы клиенты /stream не ждали после перезапуска опроса
+    version = _current.version + 1 if _current else _stored_version() + 1
+    created_at = time.time()
+    stats = stats or {}
+    payload = json.dumps({"phases": phases, "raw": raw, "total": total, "logs": list(logs), "stats": stats},
+                         ensure_ascii=False)
+    execute_query("""
+        INSERT OR REPLACE INTO live_state (id, version, created_at, timestamp, payload, log_seq)
+        VALUES (1, ?, ?, ?, ?, ?)
+    """, (version, created_at, timestamp, payload, log_seq))
+    return Snapshot(version, created_at, timestamp, _freeze(phases), _freeze(raw), _freeze(total),
+                    _freeze(logs), log_seq, _freeze(stats))
+
+
+# Публикация снимка в памяти процесса опроса
+def set_snapshot(snapshot):
+    global _current, _publisher
+    with _lock:
+        _publisher = True
+        # Замена ссылки атомарна, читатели видят либо старый, либо новый снимок целиком
+        _current = snapshot
+        _published.notify_all()
+    return snapshot
+
+
+def _stored_version():
+    row = execute_query("SELECT version FROM live_state WHERE id = 1", fetchone=True)
+    return row[0] if row else 0
+
+
+# Последний снимок из live_state: таблица читается не чаще раза в LIVE_STATE_REFRESH секунд,
+# JSON разбирается только при смене версии
+def _load_live_state():
+    global _loaded
+    checked_at, snapshot = _loaded
+    now = time.monotonic()
+    if now - checked_at < LIVE_STATE_REFRESH:
+        return snapshot
+    row = execute_query("SELECT version, created_at, timestamp, payload, log_seq FROM live_state WHERE id = 1",
+                        fetchone=True)
+    if row is None:
+        snapshot = None
+    elif snapshot is None or snapshot.version != row[0]:
+        version, created_at, timestamp, payload, log_seq = row
+        data = json.loads(payload)
+        snapshot = Snapshot(version, created_at, timestamp, _freeze(data["phases"]), _freeze(data["raw"]),
+                            _freeze(data["total"]), _freeze(data["logs"]), log_seq, _freeze(data.get("stats", {})))
+    _loaded = (now, snapshot)
+    return snapshot
+
+
+# Ожидание снимка новее версии version; None, если за timeout секунд его не появилось
+def wait_for_snapshot(version, timeout):
+    if _publisher:
+        with _lock:
+            _published.wait_for(lambda: _current is not None and _current.version > version, timeout)
+            if _current is not None and _current.version > version:
+                return _current
+        return None
+
+    # Опрос идет в другом процессе: проверяем live_state
+    deadline = time.monotonic() + timeout
+    while True:
+        snapshot = get_snapshot()
+        if snapshot is not None and snapshot.version > version:
+            return snapshot
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(LIVE_STATE_REFRESH, remaining))
+
+
+# Текущий снимок или None, если опрос еще не завершил ни одного цикла
+def get_snapshot():
+    return _current if _publisher else _load_live_state()
+
+
+Callback("snapshot_age_seconds", "Возраст последнего снимка показаний",
+         lambda: snapshot_status(get_snapshot())["age"])
+Callback("snapshot_version", "Номер последнего снимка показаний",
+         lambda: getattr(get_snapshot(), "version", 0))
+
+
+# Возраст снимка в секундах и признак устаревания
+def snapshot_status(snapshot):
+    if snapshot is None:
+        return {"age": None, "stale": True}
+    age = max(0.0, time.time() - snapshot.created_at)
+    return {"age": round(age, 3), "stale": age > SNAPSHOT_MAX_AGE}
+
+
+# Ответ для эндпоинтов: нужная часть снимка и отдельно возраст и признак устаревания.
+# Метаданные не смешиваются с данными: ключи ответа /data - только id счетчиков
+def snapshot_view(part):
+    snapshot = get_snapshot()
+    return (_thaw(getattr(snapshot, part)) if snapshot else {}), snapshot_status(snapshot)
+
+
+# Компактное обновление для /stream. Кодируется в JSON один раз на версию снимка,
+# поэтому нагрузка не зависит от числа подключенных панелей
+def stream_payload(snapshot):
+    global _payload_cache
+    version, payload = _payload_cache
+    if version == snapshot.version:
+        return payload
+
+    phases = _thaw(snapshot.phases)
+    total = _thaw(snapshot.total)
+    payload = json.dumps({
+        "version": snapshot.version,
+        "timestamp": snapshot.timestamp,
+        "phases": phases,
+        "general_w": round(sum(data.get(meter_profile(meter_id).power_field, 0)
+                               for meter_id, data in phases.items()), 2),
+        "total_kwh": round(sum(value for key, value in total.items() if key.endswith("total")) / 1000, 1),
+        "logs": _thaw(snapshot.logs)
+    }, ensure_ascii=False)
+    _payload_cache = (snapshot.version, payload)
+    return payload
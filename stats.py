@@ -0,0 +1,236 @@
+import json
+import math
+from collections import deque
+from meters import meter_ids
+from mqtt_handler import publish_mqtt
+from log import log_message
+from timeutils import get_current_time_utc_plus_3
+from metrics import Callback, stats_events
+from config import STATS_WINDOWS, STATS_FIELDS, STATS_RULES, STATS_EVENTS_TOPIC, STATS_EVENT_HISTORY, POLL_INTERVAL
+
+# Скользящая статистика показаний и правила событий (процесс опроса, каждый цикл).
+# Для каждого счетчика, поля STATS_FIELDS и окна STATS_WINDOWS - среднее, стандартное
+# отклонение, минимум и максимум за последние N секунд; для энергии - средняя мощность по
+# приросту накопленного счетчика. Обновление за выборку - O(1) (амортизированно), память
+# окна ограничена числом выборок за его длительность. Без запросов к истории в БД.
+# Результат передается веб-процессам в снимке (snapshot.py) и отдается /stats.
+
+STATS = ("mean", "stdev", "min", "max")
+
+
+# Окно последних выборок одного ряда.
+# Среднее и сумма квадратов отклонений обновляются по Уэлфорду при добавлении и удалении
+# выборки; минимум и максимум - монотонные очереди (голова - экстремум окна, каждая выборка
+# входит и выходит из очереди один раз). Ошибка округления от удалений не накапливается:
+# раз в размер окна удалений среднее пересчитывается заново.
+class SlidingWindow:
+    def __init__(self, duration_ms, capacity):
+        self.duration_ms = duration_ms
+        self.capacity = capacity
+        self.samples = deque()  # (ts, значение)
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._min = deque()  # Значения по возрастанию
+        self._max = deque()  # Значения по убыванию
+        self._removed = 0
+
+    def add(self, ts, value):
+        self.samples.append((ts, value))
+        delta = value - self.mean
+        self.mean += delta / len(self.samples)
+        self._m2 += delta * (value - self.mean)
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((ts, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((ts, value))
+        # Емкость ограничивает окно и при скачке системных часов назад
+        while len(self.samples) > self.capacity:
+            self._pop()
+        self.expire(ts)
+
+    # Удаление выборок старше длительности окна, отсчитанной от now_ms
+    def expire(self, now_ms):
+        cutoff = now_ms - self.duration_ms
+        while self.samples and self.samples[0][0] <= cutoff:
+            self._pop()
+
+    def _pop(self):
+        ts, value = self.samples.popleft()
+        count = len(self.samples)
+        if count == 0:
+            self.mean = self._m2 = 0.0
+        else:
+            delta = value - self.mean
+            self.mean -= delta / count
+            self._m2 -= delta * (value - self.mean)
+        if self._min[0][0] <= ts:
+            self._min.popleft()
+        if self._max[0][0] <= ts:
+            self._max.popleft()
+        self._removed += 1
+        if self._removed >= max(count, 64):
+            self._recompute()
+
+    def _recompute(self):
+        self._removed = 0
+        count = len(self.samples)
+        self.mean = math.fsum(value for ts, value in self.samples) / count if count else 0.0
+        self._m2 = math.fsum((value - self.mean) ** 2 for ts, value in self.samples)
+
+    def stat(self, name):
+        if not self.samples:
+            return None
+        if name == "mean":
+            return self.mean
+        if name == "stdev":
+            return math.sqrt(max(self._m2, 0.0) / len(self.samples))
+        if name == "min":
+            return self._min[0][1]
+        if name == "max":
+            return self._max[0][1]
+        raise ValueError(f"Неизвестная статистика {name}")
+
+    # Скорость изменения ряда в единицах в час (для накопленной энергии в Вт·ч - средняя мощность, Вт)
+    def rate(self):
+        if len(self.samples) < 2:
+            return None
+        (first_ts, first), (last_ts, last) = self.samples[0], self.samples[-1]
+        if last_ts <= first_ts:
+            return None
+        return (last - first) * 3600000 / (last_ts - first_ts)
+
+
+# Проверка правил конфигурации (ошибка - при запуске, а не при первом срабатывании)
+def check_rules(rules, windows, fields):
+    for rule in rules:
+        name = rule.get("name")
+        if not name:
+            raise ValueError(f"Правило без имени: {rule}")
+        if rule.get("field") not in fields:
+            raise ValueError(f"Правило {name}: поле {rule.get('field')} не входит в STATS_FIELDS")
+        stat = rule.get("stat", "last")
+        if stat != "last" and stat not in STATS:
+            raise ValueError(f"Правило {name}: неизвестная статистика {stat}")
+        if stat != "last" and rule.get("window") not in windows:
+            raise ValueError(f"Правило {name}: неизвестное окно {rule.get('window')}")
+        if ("above" in rule) == ("below" in rule):
+            raise ValueError(f"Правило {name}: нужен ровно один порог above или below")
+        if rule.get("type", "threshold") not in ("threshold", "imbalance"):
+            raise ValueError(f"Правило {name}: неизвестный тип {rule['type']}")
+    return rules
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+class StatsEngine:
+    def __init__(self, windows=STATS_WINDOWS, fields=STATS_FIELDS, rules=STATS_RULES, interval=POLL_INTERVAL):
+        self.windows = {name: int(seconds * 1000) for name, seconds in windows.items()}
+        self.fields = list(fields)
+        self.rules = check_rules(rules, self.windows, self.fields)
+        self.interval = interval
+        self._series = {}  # (meter_id, поле, окно) -> SlidingWindow; поле "energy" - накопленная энергия
+        self._last = {}  # meter_id -> последние показания полей
+        self.active = {}  # (правило, счетчик) -> событие срабатывания
+        self.events = deque(maxlen=STATS_EVENT_HISTORY)
+
+    def _window(self, meter_id, field, window):
+        key = (meter_id, field, window)
+        series = self._series.get(key)
+        if series is None:
+            duration = self.windows[window]
+            series = self._series[key] = SlidingWindow(duration, math.ceil(duration / 1000 / self.interval) + 1)
+        return series
+
+    # Учет выборки цикла опроса и проверка правил. totals - накопленная энергия счетчиков (Вт·ч)
+    def update(self, ts, readings, totals=None):
+        totals = totals or {}
+        for meter_id, data in readings.items():
+            last = self._last.setdefault(meter_id, {})
+            for field in self.fields:
+                value = data.get(field)
+                if value is None:
+                    continue
+                last[field] = value = float(value)
+                for window in self.windows:
+                    self._window(meter_id, field, window).add(ts, value)
+            if meter_id in totals:
+                for window in self.windows:
+                    self._window(meter_id, "energy", window).add(ts, float(totals[meter_id]))
+        # Окна счетчиков, не ответивших в этом цикле, тоже сдвигаются
+        for series in self._series.values():
+            series.expire(ts)
+        for rule in self.rules:
+            self._evaluate(rule, ts, readings)
+
+    # Значение статистики правила для счетчика или None, если выборок нет
+    def value(self, rule, meter_id):
+        stat = rule.get("stat", "last")
+        if stat == "last":
+            return self._last.get(meter_id, {}).get(rule["field"])
+        series = self._series.get((meter_id, rule["field"], rule["window"]))
+        return series.stat(stat) if series is not None else None
+
+    def _evaluate(self, rule, ts, readings):
+        meters = rule.get("meters") or meter_ids()
+        if rule.get("type") == "imbalance":
+            values = [value for value in (self.value(rule, meter_id) for meter_id in meters) if value is not None]
+            if len(values) < 2:
+                return
+            average = sum(values) / len(values)
+            if average == 0:
+                return
+            self._check(rule, "all", max(abs(value - average) for value in values) / abs(average) * 100, ts)
+            return
+        for meter_id in meters:
+            # Правило проверяется только по свежим показаниям счетчика
+            if meter_id in readings:
+                value = self.value(rule, meter_id)
+                if value is not None:
+                    self._check(rule, meter_id, value, ts)
+
+    # Срабатывание при выходе за порог, снятие - при возврате за порог clear
+    def _check(self, rule, meter_id, value, ts):
+        above = "above" in rule
+        limit = rule["above"] if above else rule["below"]
+        key = (rule["name"], meter_id)
+        if key not in self.active:
+            if value > limit if above else value < limit:
+                self.active[key] = self._emit(rule, meter_id, "active", value, limit, ts)
+        else:
+            clear = rule.get("clear", limit)
+            if value <= clear if above else value >= clear:
+                del self.active[key]
+                self._emit(rule, meter_id, "cleared", value, clear, ts)
+
+    def _emit(self, rule, meter_id, state, value, limit, ts):
+        event = {"rule": rule["name"], "meter": meter_id, "state": state, "field": rule["field"],
+                 "stat": rule.get("stat", "last"), "window": rule.get("window"), "value": _round(value),
+                 "threshold": limit, "ts": ts, "timestamp": get_current_time_utc_plus_3()}
+        publish_mqtt(f"{STATS_EVENTS_TOPIC}/{rule['name']}/{meter_id}", json.dumps(event, ensure_ascii=False))
+        action = "сработало" if state == "active" else "снято"
+        log_message(f"Правило {rule['name']} ({meter_id}) {action}: {rule['field']} {event['stat']} = "
+                    f"{event['value']}, порог {limit}", force=True)
+        stats_events.labels(rule["name"], state).inc()
+        self.events.append(event)
+        return event
+
+    # Сводка для снимка: статистика окон по счетчикам, активные события и последние события
+    def summary(self):
+        meters = {}
+        for (meter_id, field, window), series in self._series.items():
+            values = meters.setdefault(meter_id, {}).setdefault(window, {})
+            if field == "energy":
+                values["energy_rate"] = _round(series.rate())
+            else:
+                values[field] = {"count": len(series.samples), **{stat: _round(series.stat(stat)) for stat in STATS}}
+        return {"windows": {name: duration // 1000 for name, duration in self.windows.items()},
+                "meters": meters, "active": list(self.active.values()), "events": list(self.events)}
+
+
+stats_engine = StatsEngine()
+
+Callback("stats_active_events", "Активные события правил статистики", lambda: len(stats_engine.active))
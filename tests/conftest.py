@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import tempfile
+import pytest
+import config
+
+# Файлы, которые модули открывают при импорте (сегменты выборок, кольцевые буферы, очередь MQTT),
+# перенаправляются во временный каталог до импорта модулей проекта
+_workdir = tempfile.mkdtemp(prefix="pmp-tests-")
+config.SQLITE_DB = os.path.join(_workdir, "test.db")
+config.MQTT_SPOOL_FILE = os.path.join(_workdir, "mqtt_spool.jsonl")
+config.SAMPLE_STORE_DIR = os.path.join(_workdir, "samples")
+config.RECENT_BUFFER_DIR = os.path.join(_workdir, "recent")
+
+import database  # noqa: E402
+
+
+def _use_database(monkeypatch, path):
+    database.close_database()
+    monkeypatch.setattr(database, "SQLITE_DB", str(path))
+
+
+# Пустая БД текущей схемы для каждого теста
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    _use_database(monkeypatch, tmp_path / "test.db")
+    database.initialize_database()
+    yield tmp_path / "test.db"
+    database.close_database()
+
+
+# БД старой схемы (historical_data с колонками L1..L3, без мощности), перенесенная initialize_database.
+# Выборки L1 каждые 10 секунд с начала суток base_ms; энергия растет на 3 Вт·ч, с переполнением
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    _use_database(monkeypatch, path)
+    base_ms = 1799960400000  # 2027-01-15 00:00 по местному времени (UTC+3)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE historical_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            L1history REAL,
+            L2history REAL,
+            L3history REAL,
+            ts INTEGER NOT NULL
+        )
+    """)
+    conn.executemany("INSERT INTO historical_data (L1history, ts) VALUES (?, ?)",
+                     [((65500 + index * 3) % 65536, base_ms + index * 10000) for index in range(600)])
+    conn.commit()
+    conn.close()
+    database.initialize_database()
+    yield base_ms
+    database.close_database()
@@ -0,0 +1,28 @@
+import csv
+import io
+import json
+from database import execute_query
+from export import export_stream
+
+
+def _export(resolution, start_ms, stop_ms, fmt):
+    return b"".join(export_stream(resolution, start_ms, stop_ms, ["L1"], fmt)).decode("utf-8")
+
+
+def test_export_of_legacy_buckets(legacy_db):
+    stop_ms = legacy_db + 86400 * 1000
+    rows = list(csv.DictReader(io.StringIO(_export("1h", legacy_db, stop_ms, "csv"))))
+    assert len(rows) == 2
+    assert all(row["samples"] == "0" and row["power_avg"] == "" for row in rows)
+    assert sum(int(row["energy"]) for row in rows) == 599 * 3
+
+    lines = _export("1d", legacy_db, stop_ms, "ndjson").splitlines()
+    assert [json.loads(line)["power_avg"] for line in lines] == [None]
+
+
+# Интервалы, заполненные прежней версией переноса: выборки посчитаны, мощности нет
+def test_export_of_buckets_without_power_sum(db):
+    bucket = 1799960400000
+    execute_query("INSERT INTO rollup_1h (meter_id, bucket, samples, energy) VALUES ('L1', ?, 360, 1000)", (bucket,))
+    rows = list(csv.DictReader(io.StringIO(_export("1h", bucket, bucket + 3600 * 1000, "csv"))))
+    assert [(row["samples"], row["power_avg"], row["energy"]) for row in rows] == [("360", "", "1000")]
@@ -0,0 +1,45 @@
+import pytest
+import database
+from database import execute_query
+from export import export_stream
+from importer import Importer
+
+
+# Сырая выгрузка перенесенной истории (колонка мощности пустая) импортируется в новую БД целиком:
+# выборки с NULL мощностью, агрегаты энергии как в исходной БД, агрегаты мощности пустые
+@pytest.mark.parametrize("fmt", ["csv", "ndjson"])
+def test_import_of_raw_export(legacy_db, tmp_path, monkeypatch, fmt):
+    stop = legacy_db + 24 * 3600 * 1000
+    dump = tmp_path / f"export.{fmt}"
+    dump.write_bytes(b"".join(export_stream("raw", legacy_db, stop, ["L1"], fmt)))
+    expected = execute_query("SELECT bucket, samples, power_sum, energy FROM rollup_1h ORDER BY bucket")
+
+    database.close_database()
+    monkeypatch.setattr(database, "SQLITE_DB", str(tmp_path / "imported.db"))
+    database.initialize_database()
+    importer = Importer(str(dump))
+    assert importer.load_checkpoint()
+    importer.run()
+
+    assert importer.counters["imported"] == 600
+    assert importer.counters["invalid"] == 0
+    assert execute_query("SELECT count(*), count(power) FROM meter_history", fetchone=True) == (600, 0)
+    assert execute_query("SELECT bucket, samples, power_sum, energy FROM rollup_1h ORDER BY bucket") == expected
+    assert execute_query("SELECT samples, power_min, power_max, power_sum, energy FROM rollup_1d") == \
+        [(0, None, None, None, 599 * 3)]
+
+
+# В одном интервале выборки с мощностью и без: агрегаты мощности только по первым
+def test_import_of_partial_power(db, tmp_path):
+    dump = tmp_path / "partial.csv"
+    dump.write_text("meter_id,ts,energy,power\n"
+                    "L1,1799960400000,10,2.0\n"
+                    "L1,1799960410000,13,\n"
+                    "L1,1799960420000,16,1.0\n")
+    importer = Importer(str(dump))
+    importer.load_checkpoint()
+    importer.run()
+
+    assert importer.counters["imported"] == 3
+    assert execute_query("SELECT samples, power_min, power_max, power_sum, energy FROM rollup_1m") == \
+        [(2, 1.0, 2.0, 3.0, 6)]
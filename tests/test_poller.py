@@ -0,0 +1,23 @@
+import database
+import poller
+import snapshot
+from database import execute_query
+
+
+def _reading(energy, power):
+    return {"Voltage": 230.0, "Current": 1.0, "Power": power, "Energy": energy, "Energy_F": 1.0,
+            "Frequency": 50.0, "PowerFactor": 0.9, "AlarmStatus": 0}
+
+
+# История, агрегаты и снимок live_state цикла опроса - одна транзакция потока-писателя
+def test_cycle_writes_in_one_transaction(db, monkeypatch):
+    transactions = []
+    run_in_writer = database.run_in_writer
+    monkeypatch.setattr(database, "run_in_writer", lambda func: transactions.append(func) or run_in_writer(func))
+
+    poller.process_cycle({"L1": _reading(100, 0.5), "L2": _reading(200, 1.0)})
+
+    assert len(transactions) == 1
+    assert execute_query("SELECT count(*) FROM meter_history", fetchone=True)[0] == 2
+    version = execute_query("SELECT version FROM live_state WHERE id = 1", fetchone=True)[0]
+    assert version == snapshot.get_snapshot().version
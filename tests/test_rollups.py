@@ -0,0 +1,34 @@
+from database import execute_query
+from rollups import update_rollups, query_rollups
+
+
+def _rollup(table, meter_id="L1"):
+    return execute_query(f"SELECT samples, power_min, power_max, power_sum, energy FROM {table} "
+                         f"WHERE meter_id = ? ORDER BY bucket", (meter_id,))
+
+
+def test_backfill_of_legacy_history_has_no_power_aggregates(legacy_db):
+    rows = _rollup("rollup_1h")
+    assert len(rows) == 2
+    assert all(samples == 0 and power_min is None and power_max is None and power_sum is None
+               for samples, power_min, power_max, power_sum, energy in rows)
+    # 599 приростов по 3 Вт·ч, в том числе через переполнение 16-битного счетчика
+    assert sum(row[4] for row in rows) == 599 * 3
+    assert _rollup("rollup_1d") == [(0, None, None, None, 599 * 3)]
+
+
+def test_new_sample_fills_power_of_legacy_bucket(legacy_db):
+    ts = legacy_db + 2 * 3600 * 1000
+    update_rollups(ts, {"L1": {"Energy": 100, "Power": 1.5}}, {"L1": 3}, {"L1": 5000})
+    update_rollups(ts + 10000, {"L1": {"Energy": 103, "Power": 0.5}}, {"L1": 3}, {"L1": 5003})
+
+    assert _rollup("rollup_1d") == [(2, 0.5, 1.5, 2.0, 599 * 3 + 6)]
+    day = query_rollups("1d", legacy_db, ts + 3600 * 1000, ["L1"])
+    assert day[0]["L1"]["power_avg"] == 1.0
+
+
+def test_new_samples_merge_power(db):
+    ts = 1799960400000
+    for index, power in enumerate((2.0, 1.0, 3.0)):
+        update_rollups(ts + index * 10000, {"L1": {"Energy": index, "Power": power}}, {"L1": 1}, {"L1": index})
+    assert _rollup("rollup_1m") == [(3, 1.0, 3.0, 6.0, 3)]
@@ -0,0 +1,42 @@
+import os
+import config
+import meters
+import profiles
+from samples import SampleStore
+
+TS = 1799884800000  # Начало суточного сегмента (полночь UTC)
+
+
+def _store(directory, profile):
+    registry = meters.load_registry({"gw1": {"host": "127.0.0.1"}},
+                                    {"L1": {"gateway": "gw1", "unit_id": 1, "profile": profile}})
+    return SampleStore(str(directory), registry=registry)
+
+
+def _append(directory, profile, ts):
+    store = _store(directory, profile)
+    store.append(ts, {"L1": {"Energy": ts % 1000, "Power": 1.5}})
+    store.close()
+
+
+# Перезапуск с прежним профилем дописывает последний файл периода, новый файл - только при
+# смене набора полей
+def test_segment_rolls_only_on_layout_change(tmp_path, monkeypatch):
+    spec = dict(config.METER_PROFILES["pzem-016"], mqtt=None)
+    spec["fields"] = {field: spec["fields"][field] for field in ("Power", "Energy")}
+    monkeypatch.setitem(profiles.PROFILES, "short", profiles.MeterProfile("short", **spec))
+
+    _append(tmp_path, "pzem-016", TS)
+    _append(tmp_path, "pzem-016", TS + 1000)
+    assert os.listdir(tmp_path / "L1") == [f"{TS}.seg"]
+
+    _append(tmp_path, "short", TS + 2000)
+    _append(tmp_path, "short", TS + 3000)
+    assert sorted(os.listdir(tmp_path / "L1")) == [f"{TS}.seg", f"{TS}_{TS + 2000}.seg"]
+
+    _append(tmp_path, "pzem-016", TS + 4000)
+    _append(tmp_path, "pzem-016", TS + 5000)
+    assert sorted(os.listdir(tmp_path / "L1")) == [f"{TS}.seg", f"{TS}_{TS + 2000}.seg", f"{TS}_{TS + 4000}.seg"]
+
+    records = _store(tmp_path, "pzem-016").read_range("L1", TS, TS + 10000, ["Energy"])
+    assert records["ts"].tolist() == [TS + step * 1000 for step in range(6)]
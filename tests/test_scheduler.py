@@ -0,0 +1,44 @@
+import asyncio
+import os
+import socket
+import sys
+import meters
+import scheduler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import simulator  # noqa: E402
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Неответивший счетчик занимает шину только на один таймаут: цикл укладывается в период,
+# остальные счетчики того же шлюза читаются в каждом цикле
+def test_dead_unit_does_not_miss_deadlines(db):
+    port = _free_port()
+    registry = meters.load_registry({"gw1": {"host": "127.0.0.1", "port": port}},
+                                    {meter_id: {"gateway": "gw1", "unit_id": unit}
+                                     for meter_id, unit in (("A", 1), ("B", 2), ("C", 3))})
+    cycles = []
+
+    async def scenario():
+        ready = asyncio.Event()
+        server = asyncio.create_task(simulator.run(units=3, port=port, update_interval=0.1, ready=ready.set,
+                                                   silent={2}))
+        await ready.wait()
+        try:
+            await asyncio.wait_for(scheduler.run_polling(cycles.append, 1.5, registry), 5)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            server.cancel()
+
+    before = scheduler.poll_stats.as_dict()["missed_deadlines"]
+    asyncio.run(scenario())
+
+    assert len(cycles) >= 3
+    assert all(sorted(readings) == ["A", "C"] for readings in cycles)
+    assert scheduler.poll_stats.as_dict()["missed_deadlines"] == before
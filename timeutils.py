@@ -0,0 +1,34 @@
+import time
+from datetime import datetime, timezone, timedelta
+from config import UTC_OFFSET_HOURS
+
+# Часовой пояс интерфейса (UTC+3)
+LOCAL_TIMEZONE = timezone(timedelta(hours=UTC_OFFSET_HOURS))
+
+
+# Текущее время в миллисекундах Unix (UTC), формат хранения временных рядов
+def now_ms():
+    return int(time.time() * 1000)
+
+
+# Функция для получения текущего времени в формате UTC+3
+def get_current_time_utc_plus_3():
+    return datetime.now(LOCAL_TIMEZONE).isoformat()
+
+
+# Миллисекунды Unix -> ISO-строка в часовом поясе интерфейса
+def epoch_ms_to_local_iso(ms):
+    return datetime.fromtimestamp(ms / 1000, LOCAL_TIMEZONE).isoformat(timespec="seconds")
+
+
+# ISO-строка -> миллисекунды Unix. Время без смещения считается местным (UTC+3)
+def local_iso_to_epoch_ms(value):
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=LOCAL_TIMEZONE)
+    return int(moment.timestamp() * 1000)
+
+
+# Метка времени журнала событий (местное время)
+def get_log_timestamp(moment=None):
+    return (moment or datetime.now(LOCAL_TIMEZONE)).astimezone(LOCAL_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")